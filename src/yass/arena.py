@@ -0,0 +1,152 @@
+"""
+Read-only arrays shared by the parallel workers of a pipeline step
+
+Large inputs (templates, spike trains, shifts, scales) are registered once
+by the step as .npy files and attached by file name in every worker. They
+are opened as read-only memory maps, so all workers share the same pages
+instead of each one loading its own copy.
+"""
+import os
+import numpy as np
+
+
+# memory maps opened in this process, keyed by file name and checked
+# against the file identity so that a rewritten file is reopened
+_ARRAYS = {}
+
+
+def attach(fname):
+    '''
+    return a read-only memory map of a .npy file. the map is opened once
+    per process and reused afterwards; it is reopened if the file was
+    replaced or its size changed
+    '''
+    stat = os.stat(fname)
+    key = os.path.abspath(fname)
+    identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    cached = _ARRAYS.get(key)
+    if cached is not None and cached[0] == identity:
+        return cached[1]
+
+    array = np.load(fname, mmap_mode='r')
+    _ARRAYS[key] = (identity, array)
+
+    return array
+
+
+def unit_index_fnames(fname_spike_train):
+    '''
+    names of the files of the SpikeTrainIndex of a spike train, saved
+    next to it
+    '''
+    root = os.path.splitext(fname_spike_train)[0]
+    return [root + '_' + name + '.npy' for name in SpikeTrainIndex.arrays]
+
+
+class SpikeTrainIndex(object):
+    '''
+    index of a (n_spikes, 2) spike train (time, unit) for per unit and
+    per time window queries without scanning it.
+
+    rows are grouped by unit with a stable argsort, so rows of unit k are
+    unit_order[unit_ptr[k]:unit_ptr[k+1]] in their original order. rows are
+    also sorted by time (time_order, sorted_times) so that the rows in a
+    time window are found by binary search.
+    '''
+
+    arrays = ['unit_order', 'unit_ptr', 'time_order', 'sorted_times']
+
+    def __init__(self, spike_train, n_units=None, **arrays):
+
+        self.spike_train = spike_train
+        if len(arrays) > 0:
+            for name in self.arrays:
+                setattr(self, name, arrays[name])
+            return
+
+        units = spike_train[:, 1]
+        if n_units is None:
+            n_units = units.max() + 1 if len(units) > 0 else 0
+        self.unit_order = np.argsort(units, kind='stable')
+        self.unit_ptr = np.searchsorted(units[self.unit_order],
+                                        np.arange(n_units + 1))
+        self.time_order = np.argsort(spike_train[:, 0], kind='stable')
+        self.sorted_times = spike_train[self.time_order, 0]
+
+    @property
+    def n_units(self):
+        return len(self.unit_ptr) - 1
+
+    def n_spikes(self):
+        '''number of spikes of every unit'''
+        return np.diff(self.unit_ptr)
+
+    def unit_rows(self, unit):
+        '''rows of a unit, in their original order'''
+        if unit >= self.n_units:
+            return np.zeros(0, 'int64')
+
+        return self.unit_order[self.unit_ptr[unit]:self.unit_ptr[unit+1]]
+
+    def unit_times(self, unit):
+        '''spike times of a unit, in their original order'''
+        return self.spike_train[self.unit_rows(unit), 0]
+
+    def split_times(self):
+        '''list of spike times of every unit'''
+        times = self.spike_train[self.unit_order, 0]
+        return np.split(times, self.unit_ptr[1:-1])
+
+    def window_rows(self, start, end):
+        '''rows with start <= time < end, sorted by time'''
+        lo, hi = np.searchsorted(self.sorted_times, [start, end])
+        return self.time_order[lo:hi]
+
+    def save(self, fname_spike_train):
+        '''
+        save the index next to the spike train. arrays are written to
+        temporary names first so that workers never attach a half written
+        index
+        '''
+        for name, fname in zip(self.arrays,
+                               unit_index_fnames(fname_spike_train)):
+            np.save(fname + '.tmp.npy', getattr(self, name))
+            os.replace(fname + '.tmp.npy', fname)
+
+    @classmethod
+    def load(cls, fname_spike_train):
+        '''
+        attach the index saved next to a spike train (and the spike train)
+        as read-only memory maps. the index is built and saved first if it
+        is missing or older than the spike train
+        '''
+        fnames = unit_index_fnames(fname_spike_train)
+        mtime = os.path.getmtime(fname_spike_train)
+        if not all(os.path.exists(fname) and os.path.getmtime(fname) >= mtime
+                   for fname in fnames):
+            cls(np.load(fname_spike_train)).save(fname_spike_train)
+
+        arrays = {name: attach(fname)
+                  for name, fname in zip(cls.arrays, fnames)}
+
+        return cls(attach(fname_spike_train), **arrays)
+
+
+def register_spike_train(fname_spike_train):
+    '''
+    build the SpikeTrainIndex of a spike train once, before it is used by
+    parallel workers.
+
+    returns the number of units
+    '''
+    return SpikeTrainIndex.load(fname_spike_train).n_units
+
+
+def unit_rows(fname_spike_train, unit):
+    '''
+    row indices of a unit in a registered spike train, in their original
+    order. this is a slice of the memory mapped index, no copy or scan of
+    the spike train is made
+    '''
+    return SpikeTrainIndex.load(fname_spike_train).unit_rows(unit)
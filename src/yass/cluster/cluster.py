@@ -1,13 +1,14 @@
 # Class to do parallelized clustering
 import os
 import numpy as np
-import networkx as nx
 from sklearn.decomposition import PCA
+from sklearn.utils import check_random_state
 from scipy.spatial import cKDTree
 from scipy.stats import chi2
 
 from yass.template import shift_chans, align_get_shifts_with_ref
 from yass import mfm
+from yass.linkage import SingleLinkage
 from yass.util import absolute_path_to_asset
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -654,7 +655,9 @@ class Cluster(object):
             #if self.full_run:
             if True:
                 idx_subsampled = coreset(
-                    pca_wf, self.max_mfm_spikes)
+                    pca_wf, self.max_mfm_spikes,
+                    random_state=np.random.RandomState(
+                        [int(self.channel), gen]))
             else:
                 idx_subsampled = np.random.choice(np.arange(pca_wf.shape[0]),
                                  size=self.max_mfm_spikes,
@@ -784,59 +787,20 @@ class Cluster(object):
         return stability
 
     def get_k_cc(self, maha, maha_thresh_min, k_target):
-
-        # it assumes that maha_thresh_min gives 
-        # at least k+1 number of connected components
-        k_now = k_target + 1
-        if len(self.get_cc(maha, maha_thresh_min)) != k_now:
+        '''
+        connected components of maha < maha_thresh with exactly k_target
+        of them and maha_thresh. maha_thresh_min must give k_target+1
+        '''
+        linkage = SingleLinkage(maha)
+        if linkage.n_components(maha_thresh_min) != k_target + 1:
             raise ValueError("something is not right")
 
-        maha_thresh = maha_thresh_min
-        while k_now > k_target:
-            maha_thresh += 1
-            cc = self.get_cc(maha, maha_thresh)
-            k_now = len(cc)
-
-        if k_now == k_target:
-            return cc, maha_thresh
-
-        else:
-            maha_thresh_max = maha_thresh
-            maha_thresh_min = maha_thresh - 1
-            if len(self.get_cc(maha, maha_thresh_min)) <= k_target:
-                raise ValueError("something is not right")
-
-            ctr = 0
-            maha_thresh_max_init = maha_thresh_max
-            while True:
-                ctr += 1
-                maha_thresh = (maha_thresh_max + maha_thresh_min)/2.0
-                cc = self.get_cc(maha, maha_thresh)
-                k_now = len(cc)
-                if k_now == k_target:
-                    return cc, maha_thresh
-                elif k_now > k_target:
-                    maha_thresh_min = maha_thresh
-                elif k_now < k_target:
-                    maha_thresh_max = maha_thresh
-
-                if ctr > 1000:
-                    print(k_now, k_target, maha_thresh, maha_thresh_max_init)
-                    print(cc)
-                    print(len(self.get_cc(maha, maha_thresh+0.001)))
-                    print(len(self.get_cc(maha, maha_thresh-0.001)))
-                    raise ValueError("something is not right")
-
+        return linkage.k_components(k_target)
 
     def get_cc(self, maha, maha_thresh):
-        row, column = np.where(maha<maha_thresh)
-        G = nx.DiGraph()
-        for i in range(maha.shape[0]):
-            G.add_node(i)
-        for i, j in zip(row,column):
-            G.add_edge(i, j)
-        cc = [list(units) for units in nx.strongly_connected_components(G)]
-        return cc
+        # maha is symmetric, so strongly connected components of the
+        # directed graph are the connected components of the undirected one
+        return SingleLinkage(maha).components(maha_thresh)
 
     def cluster_annealing(self, vbParam):
 
@@ -858,10 +822,12 @@ class Cluster(object):
         # decrease number of connected components one at a time.
         # in any step if all components are stables, stop and return
         # otherwise, go until there are only two connected components and return it
-        maha_thresh_min = 0
+        # single-linkage dendrogram of maha: the components for every
+        # k_target are lookups in it
+        linkage = SingleLinkage(maha)
         for k_target in range(K-1, 1, -1):
             # get connected components with k_target number of them
-            cc, maha_thresh_min = self.get_k_cc(maha, maha_thresh_min, k_target)
+            cc, _ = linkage.k_components(k_target)
             # calculate soft assignment for each cc
             rhat_cc = np.zeros([N,len(cc)])
             for i, units in enumerate(cc):
@@ -1011,10 +977,7 @@ class Cluster(object):
         spike_train = [self.spike_times_original[indices] - self.shifts[indices] for indices in indices_train]
         
         if True:
-            np.savez(self.filename_postclustering,
-                 spiketime=spike_train,
-                 templates=templates
-                )
+            save_units(self.filename_postclustering, spike_train, templates)
         else:
             pca_post_triage_post_recovery = np.empty(
                 len(self.pca_post_triage_post_recovery), dtype=object)
@@ -1057,10 +1020,25 @@ class Cluster(object):
     def save_result_local(self, indices_train, templates, fname_save):
 
         spike_train = [self.spike_times_original[indices] - self.shifts[indices] for indices in indices_train]
-        np.savez(fname_save,
-                 spiketime=spike_train,
-                 templates=templates
-                )
+        save_units(fname_save, spike_train, templates)
+
+def save_units(fname, spike_train, templates):
+    '''
+    save the spike times of every unit, concatenated, with the number of
+    spikes of every unit, so that the sizes can be read from the npz
+    headers without loading the file
+    '''
+    n_spikes = np.array([len(spike_times) for spike_times in spike_train],
+                        'int64')
+    if len(spike_train) > 0:
+        spike_times = np.hstack(spike_train)
+    else:
+        spike_times = np.zeros(0, 'int32')
+
+    np.savez(fname,
+             spike_times=spike_times,
+             n_spikes=n_spikes,
+             templates=templates)
 
 def knn_triage(th, pca_wf):
 
@@ -1093,51 +1071,82 @@ def connecting_points(points, index, neighbors, t_diff, keep=None):
 
         return keep
 
-def coreset(data, m, K=3, delta=0.01):
+def coreset(data, m, K=3, delta=0.01, random_state=None, chunk_size=None):
+    '''
+    sample m points with probability given by their sensitivity to a
+    k-means++ solution with K centers.
+
+    random_state is a seed or a RandomState (None uses the global numpy
+    state). with chunk_size, distances are computed chunk_size points at a
+    time, so no (N, K) distance matrix is built
+    '''
+    random_state = check_random_state(random_state)
+
     p = int(np.ceil(np.log2(1/delta)))
-    B = kmeans_init(data, K, p)
+    B = kmeans_init(data, K, p, random_state)
     a = 16*(np.log2(K) + 2)
 
     N = data.shape[0]
-    dists = np.sum(np.square(data[:, None] - B[None]), axis=2)
-    label = dists.argmin(1)
-    dists = dists.min(1)
+    label, dists = nearest_center(data, B, chunk_size)
 
     dists_sum = np.sum(dists)
-    dists_sum_k = np.zeros(K)
-    for j in range(N):
-        dists_sum_k[label[j]] += dists[j]
-    _, n_data_k  = np.unique(label, return_counts=True)
+    dists_sum_k = np.bincount(label, dists, minlength=K)
+    n_data_k = np.bincount(label, minlength=K)
 
+    # clusters without points have no point to weight
+    n_data_k = np.maximum(n_data_k, 1)
     s = a*dists + 2*(a*dists_sum_k/n_data_k + dists_sum/n_data_k)[label]
-    p = s/sum(s)
+    p = s/np.sum(s)
 
-    idx_coreset = np.random.choice(N, size=m, replace=False, p=p)
+    idx_coreset = random_state.choice(N, size=m, replace=False, p=p)
     #weights = 1/(m*p[idx_coreset])
     #weights[weights<1] = 1
     #weights = np.ones(m)
 
     return idx_coreset#, weights
 
-def kmeans_init(data, K, n_iter):
+
+def nearest_center(data, centers, chunk_size=None):
+    '''
+    index of, and squared distance to, the nearest center of every point.
+    distances are expanded as |x|^2 - 2 x.c + |c|^2, chunk_size points at
+    a time (all at once if None)
+    '''
+    N = data.shape[0]
+    if chunk_size is None:
+        chunk_size = max(N, 1)
+
+    centers_sq = np.sum(np.square(centers), axis=1)
+    label = np.zeros(N, 'int64')
+    dists = np.zeros(N, 'float64')
+    for start in range(0, N, chunk_size):
+        chunk = data[start:start+chunk_size]
+        d = centers_sq - 2*np.matmul(chunk, centers.T)
+        label[start:start+chunk_size] = d.argmin(1)
+        dists[start:start+chunk_size] = np.maximum(
+            d.min(1) + np.sum(np.square(chunk), axis=1), 0)
+
+    return label, dists
+
+
+def kmeans_init(data, K, n_iter, random_state=None):
+    random_state = check_random_state(random_state)
+
     N, D = data.shape
     centers = np.zeros((n_iter, K, D))
     dists = np.zeros(n_iter)
     for ctr in range(n_iter):
-        ii = np.random.choice(N, size=1, replace=True, p=np.ones(N)/float(N))
+        ii = random_state.choice(N, size=1, replace=True,
+                                 p=np.ones(N)/float(N))
         C = data[ii]
-        L = np.zeros(N, 'int16')
+        # squared distance of every point to its nearest center so far
+        D = np.sum(np.square(data - C[0]), axis=1)
         for i in range(1, K):
-            D = data - C[L]
-            D = np.sum(D*D, axis=1) #L2 dist
-            ii = np.random.choice(N, size=1, replace=True, p=D/np.sum(D))
+            ii = random_state.choice(N, size=1, replace=True, p=D/np.sum(D))
             C = np.concatenate((C, data[ii]), axis=0)
-            L = np.argmax(
-                2 * np.dot(C, data.T) - np.sum(C*C, axis=1)[:, np.newaxis],
-                axis=0)
+            D = np.minimum(D, np.sum(np.square(data - C[-1]), axis=1))
 
         centers[ctr] = C
-        D = data - C[L]
-        dists[ctr] = np.sum(np.square(D))
+        dists[ctr] = np.sum(D)
 
     return centers[np.argmin(dists)]
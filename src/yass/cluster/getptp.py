@@ -1,6 +1,7 @@
 import numpy as np
 import torch
 import os
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 # from yass import read_config, set_config
@@ -10,168 +11,156 @@ from tqdm import tqdm
 # CONFIG = read_config()
 # os.environ["CUDA_VISIBLE_DEVICES"] = str(CONFIG.resources.gpu_id)
 
-class GETPTP(object):
-    def __init__(self, fname_spike_index, reader, CONFIG, denoiser=None):
-        
-        os.environ["CUDA_VISIBLE_DEVICES"] = str(CONFIG.resources.gpu_id)
-        
-        self.spike_index = np.load(fname_spike_index)
-        self.spike_index = torch.from_numpy(self.spike_index).long().cuda()
-        self.reader = reader
-        self.denoiser = denoiser
-        
-        if denoiser is not None:
-            self.n_times = denoiser.out.weight.shape[0]
-        else:
-            self.n_times = reader.spike_size
-        
-    def compute_ptps(self):
 
-        t_range = torch.arange(-(self.n_times//2), self.n_times//2+1).cuda()
-        
-        ptps_raw = torch.zeros(self.spike_index.shape[0]).float().cuda()
-        if self.denoiser is not None:
-            ptps_denoised = torch.zeros(self.spike_index.shape[0]).float().cuda()
-        else:
-            ptps_denoised = None
-        
-        # batch offsets
-        offsets = torch.from_numpy(self.reader.idx_list[:, 0] - self.reader.buffer).cuda().long()
+def spikes_in_batches(spike_times, idx_list):
+    '''
+    indices of the spikes whose time falls in [start, end) of every batch,
+    found by binary search on the time sorted spike times
+    '''
+    order = np.argsort(spike_times, kind='stable')
+    spike_times_sorted = spike_times[order]
+    starts = np.searchsorted(spike_times_sorted, idx_list[:, 0], 'left')
+    ends = np.searchsorted(spike_times_sorted, idx_list[:, 1], 'left')
+
+    return [order[start:end] for start, end in zip(starts, ends)]
 
-        with tqdm(total=self.reader.n_batches) as pbar:
 
-            for batch_id in range(self.reader.n_batches):
+def read_main_channel_wfs(reader, batch_id, spike_index_batch, n_times):
+    '''
+    snippets (n_spikes, n_times) of a batch, centered at the spike times
+    and on the channels in spike_index_batch, gathered in one indexing
+    '''
+    dat = reader.read_data_batch(batch_id, add_buffer=True)
+    offset = reader.idx_list[batch_id, 0] - reader.buffer
 
-                # load residual data
-                dat = self.reader.read_data_batch(batch_id, add_buffer=True)
-                dat = torch.from_numpy(dat).cuda()
+    t_range = np.arange(-(n_times//2), n_times//2+1)
+    t_index = (spike_index_batch[:, 0] - offset)[:, None] + t_range
 
-                # relevant idx
-                idx_in = torch.nonzero(
-                    (self.spike_index[:, 0] > self.reader.idx_list[batch_id][0]) & 
-                    (self.spike_index[:, 0] < self.reader.idx_list[batch_id][1]))[:,0]
+    return dat[t_index, spike_index_batch[:, [1]]]
 
-                spike_index_batch = self.spike_index[idx_in]
-                spike_index_batch[:, 0] -= offsets[batch_id]
 
-                # skip if no spikes
-                if len(spike_index_batch) == 0:
-                    continue
+def denoise_wfs(denoiser, wfs, n_threads=1):
+    '''
+    run the denoiser on wfs (n_spikes, n_times) on the device it lives on.
+    on cpu, large minibatches are split across n_threads threads
+    '''
+    device = next(denoiser.parameters()).device
+    if device.type == 'cpu':
+        n_sample_run = 10000
+    else:
+        n_sample_run = 1000
+        n_threads = 1
 
-                # get residual snippets
-                t_index = spike_index_batch[:, 0][:, None] + t_range
-                c_index = spike_index_batch[:,1].long()
+    def run(start):
+        wfs_torch = torch.from_numpy(
+            wfs[start:start+n_sample_run]).float().to(device)
+        with torch.no_grad():
+            return denoiser(wfs_torch)[0].cpu().numpy()
 
-                dat = torch.cat((dat, torch.zeros((dat.shape[0], 1)).cuda()), 1)
-                wfs = dat[t_index, c_index[:,None]]
-                ptps_raw[idx_in] = (torch.max(wfs, 1)[0] - torch.min(wfs, 1)[0])
+    starts = range(0, len(wfs), n_sample_run)
+    if n_threads > 1:
+        with ThreadPoolExecutor(n_threads) as pool:
+            denoised_wfs = list(pool.map(run, starts))
+    else:
+        denoised_wfs = [run(start) for start in starts]
 
-                if self.denoiser is not None:
-                    n_sample_run = 1000
+    if len(denoised_wfs) == 0:
+        return np.zeros(wfs.shape, 'float32')
+    return np.concatenate(denoised_wfs, axis=0)
 
-                    idx_list = np.hstack((
-                        np.arange(0, wfs.shape[0], n_sample_run), wfs.shape[0]))
-                    denoised_wfs = torch.zeros_like(wfs).cuda()
-                    #print ("denoised_wfs; ", denoised_wfs.shape)
-                    #print ("wfs; ", wfs.shape)
-                    for j in range(len(idx_list)-1):
-                        #print ("idx_list[j], j+1: ", idx_list[j], idx_list[j+1])
-                        denoised_wfs[idx_list[j]:idx_list[j+1]] = self.denoiser(
-                            wfs[idx_list[j]:idx_list[j+1]])[0].data
-                    ptps_denoised[idx_in] = (torch.max(denoised_wfs, 1)[0] - torch.min(denoised_wfs, 1)[0])
 
-                pbar.update()
+class GETPTP(object):
+    def __init__(self, fname_spike_index, reader, CONFIG, denoiser=None):
 
-        ptps_raw_cpu = ptps_raw.cpu().numpy()
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(CONFIG.resources.gpu_id)
 
-        del dat, idx_in, spike_index_batch, t_index, c_index, wfs, ptps_raw
+        self.spike_index = np.load(fname_spike_index).astype('int64')
+        self.reader = reader
+        self.denoiser = denoiser
+        self.n_threads = CONFIG.resources.n_processors
 
-        if self.denoiser is not None:
-            ptps_denoised_cpu = ptps_denoised.cpu().numpy()
-            del denoised_wfs, ptps_denoised
+        if denoiser is not None:
+            self.n_times = denoiser.out.weight.shape[0]
         else:
-            ptps_denoised_cpu = np.copy(ptps_raw_cpu)
+            self.n_times = reader.spike_size
 
-        torch.cuda.empty_cache()
+    def compute_ptps(self):
 
-        return ptps_raw_cpu, ptps_denoised_cpu
-    
-    
-    def compute_wfs(self, idx):
+        ptps_raw = np.zeros(self.spike_index.shape[0], 'float32')
+        ptps_denoised = np.zeros(self.spike_index.shape[0], 'float32')
 
-        t_range = torch.arange(-(self.n_times_nn//2), self.n_times_nn//2+1).cuda()
-        
-        wfs_raw = torch.zeros(len(idx), self.n_times_nn).float().cuda()
-        wfs_denoised = torch.zeros(len(idx), self.n_times_nn).float().cuda()
-        
-        spike_index_in = self.spike_index[idx]
-        with tqdm(total=self.reader.n_batches) as pbar:
+        batches = spikes_in_batches(self.spike_index[:, 0],
+                                    self.reader.idx_list)
+        for batch_id in tqdm(range(self.reader.n_batches)):
 
-            for batch_id in range(self.reader.n_batches):
+            # relevant idx; skip if no spikes
+            idx_in = batches[batch_id]
+            if len(idx_in) == 0:
+                continue
 
-                # load residual data
-                dat = self.reader.read_data_batch(batch_id, add_buffer=True)
-                dat = torch.from_numpy(dat).cuda()
+            # get residual snippets
+            wfs = read_main_channel_wfs(self.reader, batch_id,
+                                        self.spike_index[idx_in],
+                                        self.n_times)
+            ptps_raw[idx_in] = wfs.ptp(1)
 
-                # relevant idx
-                idx_in = torch.nonzero(
-                    (spike_index_in[:, 0] > self.reader.idx_list[batch_id][0]) & 
-                    (spike_index_in[:, 0] < self.reader.idx_list[batch_id][1]))[:,0]
+            if self.denoiser is not None:
+                denoised_wfs = denoise_wfs(self.denoiser, wfs,
+                                           self.n_threads)
+                ptps_denoised[idx_in] = denoised_wfs.ptp(1)
 
-                spike_index_batch = spike_index_in[idx_in] 
-                spike_index_batch[:, 0] -= (self.reader.idx_list[batch_id][0] - 
-                                            self.reader.buffer)
+        if self.denoiser is None:
+            ptps_denoised = np.copy(ptps_raw)
 
-                # get residual snippets
-                t_index = spike_index_batch[:, 0][:, None] + t_range
-                c_index = spike_index_batch[:,1].long()
+        return ptps_raw, ptps_denoised
 
-                dat = torch.cat((dat, torch.zeros((dat.shape[0], 1)).cuda()), 1)
-                wfs = dat[t_index, c_index[:,None]]
 
-                n_sample_run = 1000
+    def compute_wfs(self, idx):
 
-                idx_list = np.hstack((
-                    np.arange(0, wfs.shape[0], n_sample_run), wfs.shape[0]))
-                denoised_wfs = torch.zeros_like(wfs).cuda()
-                for j in range(len(idx_list)-1):
-                    denoised_wfs[idx_list[j]:idx_list[j+1]] = self.denoiser(
-                        wfs[idx_list[j]:idx_list[j+1]])[0]
+        wfs_raw = np.zeros((len(idx), self.n_times), 'float32')
+        wfs_denoised = np.zeros((len(idx), self.n_times), 'float32')
 
-                wfs_raw[idx_in] = wfs.data
-                wfs_denoised[idx_in] = denoised_wfs.data
-                
-                pbar.update()
+        spike_index_in = self.spike_index[idx]
+        batches = spikes_in_batches(spike_index_in[:, 0],
+                                    self.reader.idx_list)
+        for batch_id in tqdm(range(self.reader.n_batches)):
+
+            idx_in = batches[batch_id]
+            if len(idx_in) == 0:
+                continue
+
+            # get residual snippets
+            wfs = read_main_channel_wfs(self.reader, batch_id,
+                                        spike_index_in[idx_in],
+                                        self.n_times)
+
+            wfs_raw[idx_in] = wfs
+            wfs_denoised[idx_in] = denoise_wfs(self.denoiser, wfs,
+                                               self.n_threads)
+
+        return wfs_raw, wfs_denoised
 
-        return wfs_raw.cpu().numpy(), wfs_denoised.cpu().numpy()
 
-    
 class GETCLEANPTP(object):
     def __init__(self, fname_spike_index, fname_labels,
                  fname_templates, fname_shifts, fname_scales,
-                 reader_residual, denoiser=None):
-
-        self.spike_index = np.load(fname_spike_index)
-        self.spike_index = torch.from_numpy(self.spike_index).long().cuda()
-        
-        self.labels = np.load(fname_labels)
-        self.labels = torch.from_numpy(self.labels).long().cuda()
-        
+                 reader_residual, denoiser=None, n_threads=1):
+
+        self.spike_index = np.load(fname_spike_index).astype('int64')
+        self.labels = np.load(fname_labels).astype('int64')
+
         templates = np.load(fname_templates)
         mcs = templates.ptp(1).argmax(1)
         n_units, n_times, n_channels = templates.shape
-        self.templates = np.zeros((n_units, n_times))
-        for k in range(n_units):
-            self.templates[k] = templates[k, :, mcs[k]]
+        self.templates = templates[np.arange(n_units), :, mcs].astype(
+            'float32')
 
-        self.shifts = np.load(fname_shifts)
-        self.shifts = torch.from_numpy(self.shifts).float().cuda()
-
-        self.scales = np.load(fname_scales)
-        self.scales = torch.from_numpy(self.scales).float().cuda()
+        self.shifts = np.load(fname_shifts).astype('float32')
+        self.scales = np.load(fname_scales).astype('float32')
 
         self.reader_residual = reader_residual
         self.denoiser = denoiser
+        self.n_threads = n_threads
 
         if self.denoiser is not None:
             self.n_times = denoiser.out.weight.shape[0]
@@ -179,15 +168,13 @@ class GETCLEANPTP(object):
         else:
             self.n_times = n_times
 
-        self.templates = torch.from_numpy(self.templates).float().cuda()
-
     def crop_templates(self):
-        
+
         n_times_templates = self.templates.shape[1]
         if n_times_templates > self.n_times:
             n_diff = (n_times_templates - self.n_times)//2
             self.templates = self.templates[:, n_diff:-n_diff]
-            
+
         elif n_times_templates < self.n_times:
             n_diff = (self.n_times - n_times_templates)//2
             buffer = np.zeros((self.templates.shape[0], n_diff), 'float32')
@@ -195,76 +182,38 @@ class GETCLEANPTP(object):
 
     def compute_ptps(self):
 
-        t_range = torch.arange(-(self.n_times//2), self.n_times//2+1).cuda()
-        
-        ptps_raw = torch.zeros(self.spike_index.shape[0]).float().cuda()
-        if self.denoiser is not None:
-            ptps_denoised = torch.zeros(self.spike_index.shape[0]).float().cuda()
-        else:
-            ptps_denoised = None
+        ptps_raw = np.zeros(self.spike_index.shape[0], 'float32')
+        ptps_denoised = np.zeros(self.spike_index.shape[0], 'float32')
 
-        # batch offsets
-        offsets = torch.from_numpy(self.reader_residual.idx_list[:, 0]
-                                   - self.reader_residual.buffer).cuda().long()
+        batches = spikes_in_batches(self.spike_index[:, 0],
+                                    self.reader_residual.idx_list)
+        for batch_id in tqdm(range(self.reader_residual.n_batches)):
 
-        with tqdm(total=self.reader_residual.n_batches) as pbar:
+            # relevant idx; skip if no spikes
+            idx_in = batches[batch_id]
+            if len(idx_in) == 0:
+                continue
 
-            for batch_id in range(self.reader_residual.n_batches):
+            # get residual snippets
+            residuals = read_main_channel_wfs(self.reader_residual, batch_id,
+                                              self.spike_index[idx_in],
+                                              self.n_times)
 
-                # load residual data
-                dat = self.reader_residual.read_data_batch(batch_id, add_buffer=True)
-                dat = torch.from_numpy(dat).cuda()
+            # TODO: align residuals
+            #shifts_batch = self.shifts[idx_in]
+            #residuals = shift_chans(residuals, -shifts_batch)
 
-                # relevant idx
-                idx_in = torch.nonzero(
-                    (self.spike_index[:, 0] > self.reader_residual.idx_list[batch_id][0]) & 
-                    (self.spike_index[:, 0] < self.reader_residual.idx_list[batch_id][1]))[:,0]
-                
-                if len(idx_in) == 0:
-                    continue
+            # make clean wfs
+            wfs = residuals + self.scales[idx_in][:, None]*self.templates[
+                self.labels[idx_in]]
+            ptps_raw[idx_in] = wfs.ptp(1)
 
-                spike_index_batch = self.spike_index[idx_in] 
-                spike_index_batch[:, 0] -= offsets[batch_id]
+            if self.denoiser is not None:
+                denoised_wfs = denoise_wfs(self.denoiser, wfs,
+                                           self.n_threads)
+                ptps_denoised[idx_in] = denoised_wfs.ptp(1)
 
-                # get residual snippets
-                t_index = spike_index_batch[:, 0][:, None] + t_range
-                c_index = spike_index_batch[:,1].long()
-
-                dat = torch.cat((dat, torch.zeros((dat.shape[0], 1)).cuda()), 1)
-                residuals = dat[t_index, c_index[:,None]]
-                
-                # TODO: align residuals
-                #shifts_batch = self.shifts[idx_in]
-                #residuals = shift_chans(residuals, -shifts_batch)
-
-                # make clean wfs
-                wfs = residuals + self.scales[idx_in][:, None]*self.templates[self.labels[idx_in]]
-
-                ptps_raw[idx_in] = (torch.max(wfs, 1)[0] - torch.min(wfs, 1)[0])
-
-                if self.denoiser is not None:
-                    n_sample_run = 1000
-
-                    idx_list = np.hstack((
-                        np.arange(0, wfs.shape[0], n_sample_run), wfs.shape[0]))
-                    denoised_wfs = torch.zeros_like(wfs).cuda()
-                    for j in range(len(idx_list)-1):
-                        denoised_wfs[idx_list[j]:idx_list[j+1]] = self.denoiser(
-                            wfs[idx_list[j]:idx_list[j+1]])[0].data
-                    ptps_denoised[idx_in] = (torch.max(denoised_wfs, 1)[0] - torch.min(denoised_wfs, 1)[0])
-
-                pbar.update()
-
-        ptps_raw_cpu = ptps_raw.cpu().numpy()
-
-        del dat, idx_in, spike_index_batch, t_index, c_index, residuals, wfs, ptps_raw
-
-        torch.cuda.empty_cache()
-
-        if self.denoiser is not None:
-            ptps_denoised_cpu = ptps_denoised.cpu().numpy()
-            del denoised_wfs, ptps_denoised
-        else:
-            ptps_denoised_cpu = np.copy(ptps_raw_cpu)
+        if self.denoiser is None:
+            ptps_denoised = np.copy(ptps_raw)
 
-        return ptps_raw_cpu, ptps_denoised_cpu
+        return ptps_raw, ptps_denoised
@@ -2,10 +2,10 @@ import logging
 import os
 import numpy as np
 import parmap
-import networkx as nx
 
 from yass.cluster.getptp import GETPTP, GETCLEANPTP
 from yass import mfm
+from yass.linkage import SingleLinkage
 
 # from yass import read_config
 # CONFIG = read_config()
@@ -55,7 +55,8 @@ def run_split_on_ptp(savedir,
                                   fname_shifts,
                                   fname_scales,
                                   reader_residual,
-                                  denoiser)
+                                  denoiser,
+                                  CONFIG.resources.n_processors)
         ptp_raw, ptp_deno = getcleanptp.compute_ptps()
 
     np.savez(os.path.join(savedir, 'ptps_input.npz'),
@@ -185,10 +186,12 @@ def anneal_clusters(vbParam):
     maha = mfm.calc_mahalonobis(vbParam, vbParam.muhat.transpose((1,0,2)))
     maha = np.maximum(maha, maha.T)
 
-    maha_thresh_min = 0
+    # single-linkage dendrogram of maha: the components for every
+    # k_target are lookups in it
+    linkage = SingleLinkage(maha)
     for k_target in range(K-1, 0, -1):
         # get connected components with k_target number of them
-        cc, maha_thresh_min = get_k_cc(maha, maha_thresh_min, k_target)
+        cc, _ = linkage.k_components(k_target)
         # calculate soft assignment for each cc
         rhat_cc = np.zeros([N,len(cc)])
         for i, units in enumerate(cc):
@@ -216,57 +219,18 @@ def calculate_stability(rhat):
 
 
 def get_cc(maha, maha_thresh):
-    row, column = np.where(maha<maha_thresh)
-    G = nx.DiGraph()
-    for i in range(maha.shape[0]):
-        G.add_node(i)
-    for i, j in zip(row,column):
-        G.add_edge(i, j)
-    cc = [list(units) for units in nx.strongly_connected_components(G)]
-    return cc
+    # maha is symmetric, so strongly connected components of the
+    # directed graph are the connected components of the undirected one
+    return SingleLinkage(maha).components(maha_thresh)
 
 
 def get_k_cc(maha, maha_thresh_min, k_target):
-
-    # it assumes that maha_thresh_min gives 
-    # at least k+1 number of connected components
-    k_now = k_target + 1
-    if len(get_cc(maha, maha_thresh_min)) != k_now:
+    '''
+    connected components of maha < maha_thresh with exactly k_target
+    of them and maha_thresh. maha_thresh_min must give k_target+1
+    '''
+    linkage = SingleLinkage(maha)
+    if linkage.n_components(maha_thresh_min) != k_target + 1:
         raise ValueError("something is not right")
 
-    maha_thresh = maha_thresh_min
-    while k_now > k_target:
-        maha_thresh += 1
-        cc = get_cc(maha, maha_thresh)
-        k_now = len(cc)
-
-    if k_now == k_target:
-        return cc, maha_thresh
-
-    else:
-        maha_thresh_max = maha_thresh
-        maha_thresh_min = maha_thresh - 1
-        if len(get_cc(maha, maha_thresh_min)) <= k_target:
-            raise ValueError("something is not right")
-
-        ctr = 0
-        maha_thresh_max_init = maha_thresh_max
-        while True:
-            ctr += 1
-            maha_thresh = (maha_thresh_max + maha_thresh_min)/2.0
-            cc = get_cc(maha, maha_thresh)
-            k_now = len(cc)
-            if k_now == k_target:
-                return cc, maha_thresh
-            elif k_now > k_target:
-                maha_thresh_min = maha_thresh
-            elif k_now < k_target:
-                maha_thresh_max = maha_thresh
-
-            if ctr > 1000:
-                print(k_now, k_target, maha_thresh, maha_thresh_max_init)
-                print(cc)
-                print(len(get_cc(maha, maha_thresh+0.001)))
-                print(len(get_cc(maha, maha_thresh-0.001)))
-                raise ValueError("something is not right")
-    
+    return linkage.k_components(k_target)
@@ -1,8 +1,7 @@
 import logging
 import numpy as np
 import os
-from tqdm import tqdm
-import parmap
+import torch
 
 from yass import read_config
 from yass.reader import READER
@@ -16,6 +15,8 @@ from yass.cluster.util import (make_CONFIG2,
                                nn_denoise_wf, denoise_wf,
                                denoise_then_estimate_template)
 from yass.cluster.ptp_split import run_split_on_ptp
+from yass.cluster.schedule import (estimate_cluster_jobs, run_jobs,
+                                   save_summary)
 from yass.cluster.sharpen import sharpen_templates
 from yass.neuralnetwork import Denoise
 from yass.template import run_template_computation, fix_template_edges_by_file
@@ -109,7 +110,8 @@ def run(output_directory,
                            CONFIG.neuralnetwork.denoise.filter_sizes,
                            CONFIG.spike_size_nn, CONFIG)
         denoiser.load(CONFIG.neuralnetwork.denoise.filename)
-        denoiser = denoiser.cuda()
+        if torch.cuda.is_available():
+            denoiser = denoiser.cuda()
     else:
         denoiser = None
 
@@ -194,9 +196,10 @@ def run(output_directory,
         if not os.path.exists(tmp_save_dir):
             os.makedirs(tmp_save_dir)
 
-        # Cat: TODO: this parallelization may not be optimally asynchronous
         # make arg list first
         args_in = []
+        fnames_job = []
+        names_job = []
         for ctr, unit in enumerate(units):
 
             # check to see if chunk + channel already completed
@@ -213,19 +216,21 @@ def run(output_directory,
                             reader_resid,
                             filename_postclustering,
                             fnames_input[ctr]])
+            fnames_job.append(fnames_input[ctr])
+            names_job.append(unit)
 
+        # run largest jobs first, within the memory budget of the node
         logger.info("starting clustering")
-        if CONFIG.resources.multi_processing:
-            parmap.map(Cluster, args_in, 
-                       processes=CONFIG.resources.n_processors,
-                       pm_pbar=True)
-
-        else:
-            with tqdm(total=len(args_in)) as pbar:
-                for arg_in in args_in:
-                    Cluster(arg_in)
-                    pbar.update()
-
+        n_spikes, n_channels, cost, memory = estimate_cluster_jobs(
+            fnames_job)
+        wall_time, peak_rss = run_jobs(
+            Cluster, args_in, cost, memory,
+            n_processors=CONFIG.resources.n_processors,
+            multi_processing=CONFIG.resources.multi_processing,
+            memory_budget=CONFIG.resources.memory_budget_gb*1024**3)
+        save_summary(os.path.join(output_directory, 'jobs_summary.csv'),
+                     names_job, n_spikes, n_channels, cost, memory,
+                     wall_time, peak_rss)
 
         # first gather clustering result
         fname_templates_out, fname_spike_train_out = gather_clustering_result(
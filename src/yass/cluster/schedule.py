@@ -0,0 +1,158 @@
+"""
+Scheduling of the per unit clustering jobs
+
+Job costs differ by orders of magnitude, so jobs are started largest first
+and every worker takes the next job as soon as it is free. A job is only
+started if the estimated memory of the running jobs stays within the
+memory budget of the node. Wall time and peak memory of every job are
+written to a summary file, next to the estimates, to refine them.
+"""
+import os
+import csv
+import time
+import queue
+import resource
+import multiprocessing
+
+import numpy as np
+from tqdm import tqdm
+
+from yass.util import npz_array_header
+
+
+# bytes of the waveforms (float32) held at once by a Cluster job, as a
+# multiple of its input waveforms (input, denoised and aligned copies,
+# features), plus a fixed overhead per worker process
+MEMORY_PER_WAVEFORM_BYTE = 6
+MEMORY_PER_JOB = 300*1024**2
+
+
+def estimate_cluster_jobs(fnames_input):
+    '''
+    number of spikes and channels of the input of every Cluster job and
+    its estimated cost (relative) and memory (bytes)
+    '''
+    n_spikes = np.zeros(len(fnames_input), 'int64')
+    n_channels = np.zeros(len(fnames_input), 'int64')
+    n_times = np.zeros(len(fnames_input), 'int64')
+    for j, fname in enumerate(fnames_input):
+        shape, _ = npz_array_header(fname, 'wf')
+        n_spikes[j], n_times[j], n_channels[j] = shape
+
+    cost = n_spikes*n_times*n_channels*np.log2(n_spikes + 2)
+    memory = MEMORY_PER_WAVEFORM_BYTE*4*n_spikes*n_times*n_channels + \
+        MEMORY_PER_JOB
+
+    return n_spikes, n_channels, cost, memory
+
+
+def run_job(function, arg, measure_rss=True):
+    '''
+    run a job and return its wall time (seconds) and the peak resident
+    memory (MB) of the process that ran it. the peak is only the job's own
+    if the job had the process to itself; otherwise pass measure_rss=False
+    and it is NaN
+    '''
+    start = time.time()
+    function(arg)
+    wall_time = time.time() - start
+    # ru_maxrss is in kilobytes on linux
+    if measure_rss:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+    else:
+        peak_rss = np.nan
+
+    return wall_time, peak_rss
+
+
+def run_jobs(function, args, cost, memory, n_processors=1,
+             multi_processing=True, memory_budget=None):
+    '''
+    call function(arg) for every arg, largest cost first.
+
+    with multi_processing, jobs run in n_processors workers and a new job
+    is started whenever a worker is free, picking the largest pending job
+    whose memory fits in memory_budget (bytes; None for no limit) next to
+    the running ones. a job larger than the budget runs alone. every job
+    runs in a fresh process so that its peak memory can be measured.
+
+    returns the wall time and peak memory of every job (see run_job).
+    without multi_processing all jobs share this process, so their peak
+    memory is not measured (NaN)
+    '''
+    if memory_budget is None or memory_budget <= 0:
+        memory_budget = np.inf
+
+    pending = list(np.argsort(-np.asarray(cost), kind='stable'))
+    wall_time = np.zeros(len(args))
+    peak_rss = np.zeros(len(args))
+
+    if not multi_processing:
+        for j in tqdm(pending):
+            wall_time[j], peak_rss[j] = run_job(function, args[j],
+                                                measure_rss=False)
+        return wall_time, peak_rss
+
+    finished = queue.Queue()
+    running = set()
+    pool = multiprocessing.Pool(n_processors, maxtasksperchild=1)
+    try:
+        with tqdm(total=len(args)) as pbar:
+            while pending or running:
+
+                # fill the free workers
+                used = sum(memory[j] for j in running)
+                while pending and len(running) < n_processors:
+                    fits = [j for j in pending
+                            if used + memory[j] <= memory_budget]
+                    if len(fits) == 0 and len(running) == 0:
+                        fits = pending[:1]
+                    if len(fits) == 0:
+                        break
+
+                    j = fits[0]
+                    pending.remove(j)
+                    running.add(j)
+                    used += memory[j]
+                    pool.apply_async(
+                        run_job, (function, args[j]),
+                        callback=lambda result, j=j: finished.put(
+                            (j, result, None)),
+                        error_callback=lambda error, j=j: finished.put(
+                            (j, None, error)))
+
+                # wait for a job to finish
+                j, result, error = finished.get()
+                if error is not None:
+                    raise error
+                running.remove(j)
+                wall_time[j], peak_rss[j] = result
+                pbar.update()
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return wall_time, peak_rss
+
+
+def save_summary(fname, names, n_spikes, n_channels, cost, memory,
+                 wall_time, peak_rss):
+    '''
+    write the estimates and measurements of every job to a csv file,
+    appending to it if it exists
+    '''
+    exists = os.path.exists(fname)
+    with open(fname, 'a') as f:
+        writer = csv.writer(f)
+        if not exists:
+            writer.writerow(['job', 'n_spikes', 'n_channels', 'cost',
+                             'memory_mb', 'wall_time_s', 'peak_rss_mb'])
+        for row in zip(names, n_spikes, n_channels, cost, memory,
+                       wall_time, peak_rss):
+            writer.writerow([row[0], int(row[1]), int(row[2]),
+                             '{:.4g}'.format(row[3]),
+                             '{:.1f}'.format(row[4]/1024**2),
+                             '{:.2f}'.format(row[5]),
+                             '{:.1f}'.format(row[6])])
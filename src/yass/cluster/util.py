@@ -1,6 +1,7 @@
 import numpy as np
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import parmap
 import torch
@@ -10,7 +11,8 @@ from scipy.signal import argrelmin
 
 #from numba import jit
 
-from yass.util import absolute_path_to_asset
+from yass.util import absolute_path_to_asset, npz_array_header
+from yass.arena import SpikeTrainIndex
 from yass.empty import empty
 from yass.geometry import n_steps_neigh_channels
 from yass.template import align_get_shifts_with_ref, shift_chans
@@ -173,14 +175,15 @@ def partition_input(save_dir,
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
-    # load data
-    spike_index = np.load(fname_spike_index, allow_pickle=True)
+    # load data; spikes are grouped per unit with the index saved next
+    # to the spike index
+    spike_train_index = SpikeTrainIndex.load(fname_spike_index)
 
     # re-organize spike times and templates id
-    n_units = np.max(spike_index[:, 1]) + 1
+    n_units = spike_train_index.n_units
     #spike_index_list = [[] for ii in range(n_units)]
 
-    spike_index_list = split_parallel(np.arange(n_units), spike_index)
+    spike_index_list = spike_train_index.split_times()
     #spike_index_list = split_spikes_GPU(spike_index[idx_keep], n_units)
     #spike_index_list = split_spikes_parallel(spike_index_list, spike_index,
     #                                     idx_keep, n_units, CONFIG)
@@ -190,11 +193,8 @@ def partition_input(save_dir,
     if fname_templates_up is not None:
         spike_index_up = np.load(fname_spike_train_up, allow_pickle=True)
         templates_up = np.load(fname_templates_up, allow_pickle=True)
-        up_id_list = [[] for ii in range(n_units)]
-        for j in idx_keep:
-            ii = spike_index[j, 1]
-            up_id = spike_index_up[j, 1]
-            up_id_list[ii].append(up_id)
+        up_id_list = [spike_index_up[spike_train_index.unit_rows(unit), 1]
+                      for unit in range(n_units)]
 
     fnames = []
     units = []
@@ -235,9 +235,51 @@ def partition_input(save_dir,
         
     return units, fnames
 
-def gather_clustering_result(result_dir, out_dir):
+def cluster_result_size(fname):
+    '''
+    number of units and spikes in a clustering result file and the shape
+    and dtype of its templates, read from the npz headers
+    '''
+    template_shape, template_dtype = npz_array_header(fname, 'templates')
+    n_units = template_shape[0] if len(template_shape) > 1 else 0
+
+    try:
+        (n_spikes,), _ = npz_array_header(fname, 'spike_times')
+    except KeyError:
+        # results saved with a list of spike times per unit
+        n_spikes = sum(len(spike_times) for spike_times in
+                       np.load(fname, allow_pickle=True)['spiketime'])
+
+    return n_units, n_spikes, template_shape[1:], template_dtype
+
+
+def load_cluster_result(fname):
+    '''
+    spike times (of all units, concatenated), number of spikes of every
+    unit and templates of a clustering result file
+    '''
+    data = np.load(fname, allow_pickle=True)
+    if 'spike_times' in data.files:
+        return data['spike_times'], data['n_spikes'], data['templates']
+
+    spike_train = list(data['spiketime'])
+    n_spikes = np.array([len(spike_times) for spike_times in spike_train],
+                        'int64')
+    if len(spike_train) > 0:
+        spike_times = np.hstack(spike_train)
+    else:
+        spike_times = np.zeros(0, 'int32')
+
+    return spike_times, n_spikes, data['templates']
+
+
+def gather_clustering_result(result_dir, out_dir, n_threads=8):
 
     '''load clustering results
+
+    sizes are read from the file headers first, so that the spike train
+    and templates are allocated once and filled in place while the files
+    are loaded in n_threads threads
     '''
 
     logger = logging.getLogger(__name__)
@@ -248,37 +290,47 @@ def gather_clustering_result(result_dir, out_dir):
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    # convert clusters to templates
-    templates = []
-    spike_indexes = []
+    fnames = [os.path.join(result_dir, fname)
+              for fname in sorted(os.listdir(result_dir))
+              if fname.endswith('.npz')]
+
+    # first pass: sizes only
+    sizes = [cluster_result_size(fname) for fname in fnames]
+    keep = [j for j in range(len(fnames)) if sizes[j][0] > 0]
+    fnames = [fnames[j] for j in keep]
+    sizes = [sizes[j] for j in keep]
 
-    filenames = sorted(os.listdir(result_dir))
-    for fname in filenames:
-        data = np.load(os.path.join(result_dir, fname), allow_pickle=True)
-        temp_temp = data['templates']
-        if (temp_temp.shape[0]) != 0:
-            templates.append(temp_temp)
-            temp = data['spiketime']
-            for s in range(len(temp)):
-                spike_indexes.append(temp[s])
+    n_units = np.array([size[0] for size in sizes], 'int64')
+    n_spikes = np.array([size[1] for size in sizes], 'int64')
+    unit_offsets = np.hstack((0, np.cumsum(n_units)))
+    spike_offsets = np.hstack((0, np.cumsum(n_spikes)))
 
-    spike_indexes = np.array(spike_indexes)    
-    templates = np.vstack(templates)
+    logger.info("units loaded: {}".format(unit_offsets[-1]))
 
-    logger.info("units loaded: {}".format(len(spike_indexes)))
+    if len(sizes) > 0:
+        template_shape = sizes[0][2]
+        template_dtype = np.result_type(*[size[3] for size in sizes])
+    else:
+        template_shape, template_dtype = (0, 0), 'float32'
+    templates = np.zeros((unit_offsets[-1],) + tuple(template_shape),
+                         template_dtype)
+    spike_train = np.zeros((spike_offsets[-1], 2), 'int32')
+
+    # second pass: fill in place. units are numbered 0..N in file order
+    def fill(j):
+        spike_times, n_spikes_units, templates_ = load_cluster_result(
+            fnames[j])
+        templates[unit_offsets[j]:unit_offsets[j+1]] = templates_
+        spike_train[spike_offsets[j]:spike_offsets[j+1], 0] = spike_times
+        spike_train[spike_offsets[j]:spike_offsets[j+1], 1] = np.repeat(
+            np.arange(unit_offsets[j], unit_offsets[j+1]), n_spikes_units)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(fill, range(len(fnames))))
 
     fname_templates = os.path.join(out_dir, 'templates.npy')
     np.save(fname_templates, templates)
 
-    # rearange spike indees from id 0..N
-    logger.info("reindexing spikes")
-    spike_train = np.zeros((0,2), 'int32')
-    for k in range(spike_indexes.shape[0]):    
-        temp = np.zeros((spike_indexes[k].shape[0],2), 'int32')
-        temp[:,0] = spike_indexes[k]
-        temp[:,1] = k
-        spike_train = np.vstack((spike_train, temp))
-
     fname_spike_train = os.path.join(out_dir, 'spike_train.npy')
     np.save(fname_spike_train, spike_train)
 
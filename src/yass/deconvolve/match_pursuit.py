@@ -1,62 +1,166 @@
 import numpy as np
 import scipy
+import scipy.fft
 import time, os
 import parmap
 import copy
 from tqdm import tqdm
 import time
 import logging
+from collections import OrderedDict
+from scipy.ndimage import maximum_filter1d
 
 # ********************************************************
 # ********************************************************
 # ********************************************************
 
-def parallel_conv_filter(data_in,
-                         n_time,
-                         up_up_map,
-                         unit_overlap,
-                         up_factor,
-                         vis_chan,
-                         approx_rank,
-                         deconv_dir):
-
-    proc_index = data_in[0]
-    unit_array = data_in[1]
-
-    # Cat: must load these structures from disk for multiprocessing step; 
-    #       where there are many templates; due to multiproc 4gb limit 
-    fname = os.path.join(deconv_dir,"svd.npz")
-    data = np.load(fname)
-    temporal_up = data['temporal_up']
-    temporal = data['temporal']
-    singular = data['singular']
-    spatial = data['spatial']
-
-    pairwise_conv_array = []
-    for unit2 in unit_array:
-        conv_res_len = n_time * 2 - 1
-        n_overlap = np.sum(unit_overlap[unit2, :])
-        pairwise_conv = np.zeros([n_overlap, conv_res_len], dtype=np.float32)
-        orig_unit = unit2 // up_factor
-        masked_temp = np.flipud(np.matmul(
-                temporal_up[unit2] * singular[orig_unit][None, :],
-                spatial[orig_unit, :, :]))
-
-        for j, unit1 in enumerate(np.where(unit_overlap[unit2, :])[0]):
-            u, s, vh = temporal[unit1], singular[unit1], spatial[unit1] 
-            vis_chan_idx = vis_chan[:, unit1]
-            mat_mul_res = np.matmul(
-                    masked_temp[:, vis_chan_idx], vh[:approx_rank, vis_chan_idx].T)
-
-            for i in range(approx_rank):
-                pairwise_conv[j, :] += np.convolve(
-                        mat_mul_res[:, i],
-                        s[i] * u[:, i].flatten(), 'full')
-    
-        pairwise_conv_array.append(pairwise_conv)
-        
-    np.save(deconv_dir+'/temp_temp_chunk_'+str(proc_index), 
-                                                pairwise_conv_array)
+def unit_conv_filter(unit2,
+                     n_time,
+                     unit_overlap,
+                     up_factor,
+                     vis_chan,
+                     approx_rank,
+                     temporal_up,
+                     temporal,
+                     singular,
+                     spatial):
+    """Convolution of upsampled unit2 with every original unit it overlaps,
+    using the SVD approximation of the templates.
+
+    Returns array of shape (n_overlap, 2 * n_time - 1).
+    """
+    conv_res_len = n_time * 2 - 1
+    n_overlap = np.sum(unit_overlap[unit2, :])
+    pairwise_conv = np.zeros([n_overlap, conv_res_len], dtype=np.float32)
+    orig_unit = unit2 // up_factor
+    masked_temp = np.flipud(np.matmul(
+            temporal_up[unit2] * singular[orig_unit][None, :],
+            spatial[orig_unit, :, :]))
+
+    for j, unit1 in enumerate(np.where(unit_overlap[unit2, :])[0]):
+        u, s, vh = temporal[unit1], singular[unit1], spatial[unit1] 
+        vis_chan_idx = vis_chan[:, unit1]
+        mat_mul_res = np.matmul(
+                masked_temp[:, vis_chan_idx], vh[:approx_rank, vis_chan_idx].T)
+
+        for i in range(approx_rank):
+            pairwise_conv[j, :] += np.convolve(
+                    mat_mul_res[:, i],
+                    s[i] * u[:, i].flatten(), 'full')
+
+    return pairwise_conv
+
+
+class PairwiseConvStore(object):
+    """Pairwise convolutions of upsampled units with the units they overlap.
+
+    Rows of all (upsampled unit, overlapping unit) pairs are laid out CSR
+    style in one memory mapped file, pairwise_conv_data.npy; rows of
+    upsampled unit u are data[ptr[u]:ptr[u+1]], in the order of
+    np.where(unit_overlap[u])[0]. A unit's rows are computed the first time
+    it is requested (i.e. the first time it spikes), written to the file
+    for every other worker sharing it and kept in an LRU cache, so units
+    that never spike cost nothing.
+    """
+
+    def __init__(self, deconv_dir, n_time, unit_overlap, up_factor,
+                 vis_chan, approx_rank, cache_size=1000):
+
+        self.deconv_dir = deconv_dir
+        self.n_time = n_time
+        self.unit_overlap = unit_overlap
+        self.up_factor = up_factor
+        self.vis_chan = vis_chan
+        self.approx_rank = approx_rank
+        self.cache_size = cache_size
+
+        self.fname_ptr = os.path.join(deconv_dir, "pairwise_conv_ptr.npy")
+        self.fname_data = os.path.join(deconv_dir, "pairwise_conv_data.npy")
+        self.fname_done = os.path.join(deconv_dir, "pairwise_conv_done.npy")
+
+        if os.path.exists(self.fname_ptr) == False:
+            n_unit = unit_overlap.shape[0]
+            ptr = np.zeros(n_unit + 1, dtype=np.int64)
+            ptr[1:] = np.cumsum(np.sum(unit_overlap, axis=1))
+
+            # files are allocated, not written, so they are sparse on disk
+            np.lib.format.open_memmap(
+                self.fname_data, mode='w+', dtype=np.float32,
+                shape=(ptr[-1], n_time * 2 - 1))
+            np.lib.format.open_memmap(
+                self.fname_done, mode='w+', dtype=bool, shape=(n_unit,))
+            # ptr is written last as it marks the store as complete
+            np.save(self.fname_ptr, ptr)
+
+        self.ptr = np.load(self.fname_ptr)
+        self.data = None
+        self.done = None
+        self.svd = None
+        self.cache = OrderedDict()
+
+    def __getstate__(self):
+        # memory maps are reopened in the worker
+        state = self.__dict__.copy()
+        state.update(data=None, done=None, svd=None, cache=OrderedDict())
+        return state
+
+    def __len__(self):
+        return len(self.ptr) - 1
+
+    def __getitem__(self, unit):
+        if unit in self.cache:
+            self.cache.move_to_end(unit)
+            return self.cache[unit]
+
+        if self.data is None:
+            self.data = np.load(self.fname_data, mmap_mode='r+')
+            self.done = np.load(self.fname_done, mmap_mode='r+')
+
+        start, end = self.ptr[unit], self.ptr[unit + 1]
+        if self.done[unit]:
+            pairwise_conv = np.array(self.data[start:end])
+        else:
+            pairwise_conv = self.compute(unit)
+            # the flag is set after the rows so that other workers never
+            # read a unit that is half written
+            self.data[start:end] = pairwise_conv
+            self.done[unit] = True
+
+        self.cache[unit] = pairwise_conv
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return pairwise_conv
+
+    def compute(self, unit):
+        if self.svd is None:
+            # Cat: must load these structures from disk for multiprocessing
+            #      step; where there are many templates; due to multiproc 4gb
+            #      limit
+            data = np.load(os.path.join(self.deconv_dir, "svd.npz"))
+            self.svd = {key: data[key] for key in
+                        ['temporal_up', 'temporal', 'singular', 'spatial']}
+
+        return unit_conv_filter(unit,
+                                self.n_time,
+                                self.unit_overlap,
+                                self.up_factor,
+                                self.vis_chan,
+                                self.approx_rank,
+                                **self.svd)
+
+
+def merge_windows(windows):
+    """Merges overlapping [start, stop) windows given as rows of an
+    (n, 2) array; returns the merged windows sorted by start.
+    """
+    windows = windows[np.argsort(windows[:, 0])]
+    stops = np.maximum.accumulate(windows[:, 1])
+    new_window = np.ones(len(windows), dtype=bool)
+    new_window[1:] = windows[1:, 0] > stops[:-1]
+    last = np.append(np.where(new_window)[0][1:] - 1, len(windows) - 1)
+
+    return np.stack((windows[new_window, 0], stops[last]), axis=1)
 
 
 class MatchPursuit_objectiveUpsample(object):
@@ -127,7 +231,15 @@ class MatchPursuit_objectiveUpsample(object):
         logger.info("computing SVD on templates")
         # Computing SVD for each template.
         self.compress_templates()
-        
+
+        # Objective is computed with overlap-add of rfft blocks of
+        # fft_block_len samples (whole chunk if None) for unit_batch_size
+        # units at a time; spectra of the temporal components are kept
+        # across chunks.
+        self.fft_block_len = None
+        self.unit_batch_size = 64
+        self.temporal_fft = {}
+
         # Compute pairwise convolution of filters
         logger.info("computing temp_temp")
         self.pairwise_filter_conv()
@@ -295,107 +407,48 @@ class MatchPursuit_objectiveUpsample(object):
             self.spatial = data['spatial']
 
 
-    # Cat: TODO: Parallelize this function
-    def pairwise_filter_conv_parallel(self):
-    
-        # Cat: TODO: this may still crash memory in some cases; can split into additional bits
-        units = np.array_split(np.unique(self.up_up_map), self.n_processors)
-        if self.multi_processing:
-            parmap.map(parallel_conv_filter, 
-                            list(zip(np.arange(len(units)),units)), 
-                            self.n_time,
-                            self.up_up_map,
-                            self.unit_overlap,
-                            self.up_factor,
-                            self.vis_chan,
-                            self.approx_rank,
-                            self.deconv_dir,
-                            processes=self.n_processors,
-                            pm_pbar=True)
-        else:
-            units = np.unique(self.up_up_map)
-
-            for k in range(len(units)):
-                parallel_conv_filter( 
-                            [k,[units[k]]],
-                            self.n_time,
-                            self.up_up_map,
-                            self.unit_overlap,
-                            self.up_factor,
-                            self.vis_chan,
-                            self.approx_rank,
-                            self.deconv_dir)
-        
-        # load temp_temp saved files from disk due to memory overload otherwise
-        temp_array = []
-        for i in range(len(units)):
-            fname = os.path.join(self.deconv_dir, 'temp_temp_chunk_'+str(i)+'.npy')
-            temp_pairwise_conv = np.load(fname)
-            temp_array.extend(temp_pairwise_conv)
-            os.remove(fname)
-
-        # initialize empty list and fill only correct locations
-        pairwise_conv=[]
-        for i in range(self.n_unit):
-            pairwise_conv.append(None)
-
-        ctr=0
-        for unit2 in np.unique(self.up_up_map):
-            pairwise_conv[unit2] = temp_array[ctr]
-            ctr+=1
-        
-        pairwise_conv = np.array(pairwise_conv)
-        
-        # save to disk, don't keep in memory
-        np.save(os.path.join(self.deconv_dir, "pairwise_conv.npy"), pairwise_conv)
-
-
-
-    # Cat: TODO: Parallelize this function
     def pairwise_filter_conv(self):
-        """Computes pairwise convolution of templates using SVD approximation."""
-
-        if os.path.exists(
-            os.path.join(self.deconv_dir, "pairwise_conv.npy")) == False:
-
-            # Cat: TODO: original temp_temp computation, do not erase it, keep
-            #           it for debugging and testing pursposes
-            #if not self.multi_processing:
-            ##if True:
-                #print (" turned multi-processing off here")
-                ##print ("  (todo parallelize pairse filter conv)...")
-                #conv_res_len = self.n_time * 2 - 1
-                #self.pairwise_conv = []
-                #for i in range(self.n_unit):
-                    #self.pairwise_conv.append(None)
-                #available_upsampled_units = np.unique(self.up_up_map)
-                #for unit2 in tqdm(available_upsampled_units, '  computing temptemp'):
-                    ## Set up the unit2 conv all overlaping original units.
-                    #n_overlap = np.sum(self.unit_overlap[unit2, :])
-                    #self.pairwise_conv[unit2] = np.zeros([n_overlap, conv_res_len], dtype=np.float32)
-                    #orig_unit = unit2 // self.up_factor
-                    #masked_temp = np.flipud(np.matmul(
-                            #self.temporal_up[unit2] * self.singular[orig_unit][None, :],
-                            #self.spatial[orig_unit, :, :]))
-                    #for j, unit1 in enumerate(np.where(self.unit_overlap[unit2, :])[0]):
-                        #u, s, vh = self.temporal[unit1], self.singular[unit1], self.spatial[unit1] 
-                        #vis_chan_idx = self.vis_chan[:, unit1]
-
-                        #mat_mul_res = np.matmul(
-                                #masked_temp[:, vis_chan_idx], vh[:self.approx_rank, vis_chan_idx].T)
-                        #for i in range(self.approx_rank):
-                            #self.pairwise_conv[unit2][j, :] += np.convolve(
-                                    #mat_mul_res[:, i],
-                                    #s[i] * u[:, i].flatten(), 'full')
-                
-                #self.pairwise_conv = np.array(self.pairwise_conv)
-            #else:        
-        
-            self.pairwise_filter_conv_parallel()
-                
-
-        #else:
-        #    self.pairwise_conv = np.load(self.deconv_dir+'/pairwise_conv.npy')
+        """Sets up the store of pairwise convolution of templates using SVD
+        approximation; pairs are computed lazily when a unit first spikes.
+        """
+        self.pairwise_conv = PairwiseConvStore(self.deconv_dir,
+                                               self.n_time,
+                                               self.unit_overlap,
+                                               self.up_factor,
+                                               self.vis_chan,
+                                               self.approx_rank)
+
+        # Cat: TODO: original temp_temp computation, do not erase it, keep
+        #           it for debugging and testing pursposes
+        #if not self.multi_processing:
+        ##if True:
+            #print (" turned multi-processing off here")
+            ##print ("  (todo parallelize pairse filter conv)...")
+            #conv_res_len = self.n_time * 2 - 1
+            #self.pairwise_conv = []
+            #for i in range(self.n_unit):
+                #self.pairwise_conv.append(None)
+            #available_upsampled_units = np.unique(self.up_up_map)
+            #for unit2 in tqdm(available_upsampled_units, '  computing temptemp'):
+                ## Set up the unit2 conv all overlaping original units.
+                #n_overlap = np.sum(self.unit_overlap[unit2, :])
+                #self.pairwise_conv[unit2] = np.zeros([n_overlap, conv_res_len], dtype=np.float32)
+                #orig_unit = unit2 // self.up_factor
+                #masked_temp = np.flipud(np.matmul(
+                        #self.temporal_up[unit2] * self.singular[orig_unit][None, :],
+                        #self.spatial[orig_unit, :, :]))
+                #for j, unit1 in enumerate(np.where(self.unit_overlap[unit2, :])[0]):
+                    #u, s, vh = self.temporal[unit1], self.singular[unit1], self.spatial[unit1] 
+                    #vis_chan_idx = self.vis_chan[:, unit1]
+
+                    #mat_mul_res = np.matmul(
+                            #masked_temp[:, vis_chan_idx], vh[:self.approx_rank, vis_chan_idx].T)
+                    #for i in range(self.approx_rank):
+                        #self.pairwise_conv[unit2][j, :] += np.convolve(
+                                #mat_mul_res[:, i],
+                                #s[i] * u[:, i].flatten(), 'full')
+            
+            #self.pairwise_conv = np.array(self.pairwise_conv)
 
     def get_sparse_upsampled_templates(self):
         """Returns the fully upsampled sparse version of the original templates.
@@ -538,27 +591,60 @@ class MatchPursuit_objectiveUpsample(object):
         correct_spt[correct_spt[:, 1] % self.up_factor > 0, 0] += 1
         return correct_spt
 
+    def get_temporal_fft(self, n_fft):
+        """Spectra of the temporal components, cached per fft size.
+
+        Returns complex64 array of shape (n_units, approx_rank, n_fft//2 + 1).
+        """
+        if n_fft not in self.temporal_fft:
+            self.temporal_fft[n_fft] = scipy.fft.rfft(
+                np.transpose(self.temporal, (0, 2, 1)), n_fft,
+                axis=2).astype(np.complex64)
+        return self.temporal_fft[n_fft]
+
     def compute_objective(self):
-        """Computes the objective given current state of recording."""
+        """Computes the objective given current state of recording.
+
+        The data is projected on the spatial components of a batch of units
+        at once and convolved with their temporal components by overlap-add
+        of rfft blocks, summing over rank in frequency domain.
+        """
         if self.obj_computed:
             return self.obj
 
+        if self.fft_block_len is None:
+            block_len = self.data_len
+        else:
+            block_len = min(self.fft_block_len, self.data_len)
+        n_fft = scipy.fft.next_fast_len(block_len + self.n_time - 1)
+        filters_fft = self.get_temporal_fft(n_fft)
+
         conv_result = np.zeros(
                 [self.orig_n_unit, self.data_len + self.n_time - 1], dtype=np.float32)
-        for rank in range(self.approx_rank):
+        for batch_start in range(0, self.orig_n_unit, self.unit_batch_size):
+            units = slice(batch_start, batch_start + self.unit_batch_size)
+
+            # (n_units, approx_rank, data_len)
             matmul_result = np.matmul(
-                    self.spatial[:, rank] * self.singular[:, [rank]],
+                    self.spatial[units] * self.singular[units][:, :, None],
                     self.data.T)
 
-            filters = self.temporal[:, :, rank]
-            for unit in range(self.orig_n_unit):
-                conv_result[unit, :] += np.convolve(
-                        matmul_result[unit, :], filters[unit], mode='full')
+            for block_start in range(0, self.data_len, block_len):
+                block = matmul_result[:, :, block_start:block_start+block_len]
+                block_fft = scipy.fft.rfft(block, n_fft, axis=2)
+                conv = scipy.fft.irfft(
+                    np.sum(block_fft * filters_fft[units], axis=1),
+                    n_fft, axis=1)
+                conv_len = block.shape[2] + self.n_time - 1
+                conv_result[units, block_start:block_start+conv_len] += (
+                    conv[:, :conv_len])
+
         self.obj = 2 * conv_result - self.norm
         # Set indicator to true so that it no longer is run
         # for future iterations in case subtractions are done
         # implicitly.
         self.obj_computed = True
+        self.reset_peak_cache()
 
     def high_res_peak(self, times, unit_ids):
         """Finds best matching high resolution template.
@@ -591,6 +677,8 @@ class MatchPursuit_objectiveUpsample(object):
         turn_off_idx = times[invalid_idx] + np.arange(
                 - self.refrac_radius, 1)[:, None]
         self.obj[unit_ids[invalid_idx], turn_off_idx] = - np.inf
+        self.mark_dirty(times[invalid_idx] - self.refrac_radius,
+                        self.refrac_radius + 1)
         valid_idx = np.logical_not(invalid_idx)
         peak_window = peak_window[:, valid_idx]
         if peak_window.shape[1]  == 0:
@@ -630,14 +718,85 @@ class MatchPursuit_objectiveUpsample(object):
         
         # return result, dist_metric[valid_idx]
 
+    def reset_peak_cache(self):
+        """Computes max of the objective across units and its local maxima
+        over the whole chunk. Later changes to the objective are recorded
+        with mark_dirty() and only those windows are recomputed.
+        """
+        self.max_across_temp = np.max(self.obj, axis=0)
+        self.peak_times = self.window_peaks(0, self.obj.shape[1])
+        self.dirty_windows = []
+
+    def mark_dirty(self, start_times, length):
+        """Records that obj[:, t:t+length] changed for t in start_times."""
+        start_times = np.asarray(start_times).ravel()
+        if len(start_times) > 0:
+            self.dirty_windows.append(
+                np.stack((start_times, start_times + length), axis=1))
+
+    def update_peak_cache(self):
+        """Recomputes max across units and local maxima in dirty windows."""
+        if len(self.dirty_windows) == 0:
+            return
+        windows = np.clip(
+            np.concatenate(self.dirty_windows), 0, self.obj.shape[1])
+        self.dirty_windows = []
+
+        for start, stop in merge_windows(windows):
+            self.max_across_temp[start:stop] = np.max(
+                self.obj[:, start:stop], axis=0)
+
+        # local maxima depend on refrac_radius samples on either side
+        r = self.refrac_radius
+        windows[:, 0] -= r
+        windows[:, 1] += r
+        windows = merge_windows(windows)
+
+        # drop the candidates inside the windows and add the recomputed ones
+        window_idx = np.searchsorted(
+            windows[:, 0], self.peak_times, side='right') - 1
+        outside = np.logical_or(
+            window_idx < 0,
+            self.peak_times >= windows[np.maximum(window_idx, 0), 1])
+        new_peaks = [self.window_peaks(start, stop)
+                     for start, stop in windows]
+        self.peak_times = np.sort(
+            np.concatenate([self.peak_times[outside]] + new_peaks))
+
+    def window_peaks(self, start, stop):
+        """Returns the spike times in [start, stop) that would be found by
+        argrelmax over the valid part of max_across_temp (order
+        refrac_radius) and are above threshold.
+        """
+        lo = self.n_time - 1
+        hi = self.obj.shape[1] - self.n_time
+        start, stop = max(start, lo), min(stop, hi)
+        if stop <= start:
+            return np.zeros(0, dtype=np.int64)
+
+        r = self.refrac_radius
+        seg_start, seg_stop = max(start - r, lo), min(stop + r, hi)
+        seg = self.max_across_temp[seg_start:seg_stop]
+
+        # max over [i-r, i-1] and [i+1, i+r], clipped to the valid part
+        # like argrelmax does
+        trailing = maximum_filter1d(seg, r, origin=(r-1)//2, mode='nearest')
+        leading = maximum_filter1d(
+            seg[::-1], r, origin=(r-1)//2, mode='nearest')[::-1]
+        left = np.append(seg[:1], trailing[:-1])
+        right = np.append(leading[1:], seg[-1:])
+
+        is_peak = np.logical_and(seg > left, seg > right)
+        is_peak &= seg > self.threshold
+        is_peak = is_peak[start - seg_start:stop - seg_start]
+
+        return start + np.where(is_peak)[0]
+
     def find_peaks(self):
         """Finds peaks in subtraction differentials of spikes."""
-        max_across_temp = np.max(self.obj, axis=0)
-        spike_times = scipy.signal.argrelmax(
-            max_across_temp[self.n_time-1:self.obj.shape[1] - self.n_time],
-            order=self.refrac_radius)[0] + self.n_time - 1
-        spike_times = spike_times[max_across_temp[spike_times] > self.threshold]
-        dist_metric = max_across_temp[spike_times]
+        self.update_peak_cache()
+        spike_times = self.peak_times.copy()
+        dist_metric = self.max_across_temp[spike_times]
 
         # Upsample the objective and find the best shift (upsampled)
         # template.
@@ -692,6 +851,7 @@ class MatchPursuit_objectiveUpsample(object):
                     2 * self.pairwise_conv[self.up_up_map[i]], len(unit_sp[1::2]))
 
         self.enforce_refractory(spt)
+        self.mark_dirty(spt[:, 0], self.n_time*2 - 1)
         
         
     def get_iteration_spike_train(self):
@@ -700,9 +860,6 @@ class MatchPursuit_objectiveUpsample(object):
 
     def run(self, batch_ids, fnames_out):
 
-        # set default pairwise-conv flag
-        self.pairwise_conv = None
-        
         # loop over each assigned segment
         for batch_id, fname_out in zip(batch_ids, fnames_out):
             
@@ -710,11 +867,6 @@ class MatchPursuit_objectiveUpsample(object):
             if os.path.exists(fname_out):
                 continue
             
-            # load pairwise conv filter only once per core:
-            if self.pairwise_conv is None:
-                self.pairwise_conv = np.load(os.path.join(
-                    self.deconv_dir, "pairwise_conv.npy"))
-                
             start_time = time.time()
             
             # ********* run deconv ************
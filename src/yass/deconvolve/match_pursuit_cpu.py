@@ -0,0 +1,478 @@
+import numpy as np
+import os
+import copy
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+
+import scipy.fft
+from scipy.ndimage import maximum_filter1d
+
+from yass.deconvolve.match_pursuit_gpu_new import deconvGPU
+from yass.deconvolve.utils import reverse_shifts
+
+
+def cubic_bspline_basis(delta):
+    ''' evaluate the 4 cubic b-spline basis functions at fractional offsets
+        delta in [0, 1); this is the same recursion used by the cuda
+        spline subtraction kernel (one pass per leaf of the 2^order tree)
+
+        Input: [n_events] offsets
+        Output: [n_events, 4] basis values
+    '''
+    order = 3
+    delta = np.asarray(delta, 'float32')
+    basis = np.zeros((len(delta), order + 1), 'float32')
+    for leaf in range(2**order):
+        id_ = leaf
+        split = 2**order
+        imj = 0
+        coef = np.ones(len(delta), 'float32')
+        for m in range(1, order + 1):
+            split //= 2
+            if id_ < split:
+                coef *= (m - imj - delta)/m
+                imj += 1
+            else:
+                coef *= (delta + imj)/m
+            id_ = id_ % split
+        basis[:, order - imj] += coef
+
+    return basis
+
+
+def spline_values(coefficients, unit_ids, offsets, time_pts):
+    ''' values of the b-spline templates of unit_ids shifted by offsets, as
+        SplineTemplates.subtract (and the cuda kernel) shift them, at
+        window positions time_pts; positions shifted out of the window are 0
+
+        Input: coefficients [n_units, n_channels, n_times + 4],
+               unit_ids and offsets [n_events],
+               time_pts [n_events, ..., n_channels]
+        Output: values, same shape as time_pts
+    '''
+    n_events = len(unit_ids)
+    n_channels = coefficients.shape[1]
+    expand = (n_events,) + (1,)*(time_pts.ndim - 1)
+
+    # shift the offset into [0, 1)
+    delta = -np.asarray(offsets, 'float32')
+    start = (delta < 0).astype('int64')
+    delta += start
+    basis = cubic_bspline_basis(delta)
+
+    time_pts = time_pts - start.reshape(expand)
+    valid = time_pts >= 0
+    time_pts = np.where(valid, time_pts, 0)
+    units = np.asarray(unit_ids).reshape(expand)
+    chans = np.arange(n_channels)
+
+    values = coefficients[units, chans, time_pts]*basis[:, 0].reshape(expand)
+    for j in range(1, 4):
+        values += coefficients[units, chans, time_pts + j]*basis[
+            :, j].reshape(expand)
+    values *= valid
+
+    return values
+
+
+class SplineTemplates(object):
+    ''' row-sparse b-spline coefficients of the template-template
+        convolutions, stored CSR style: the coefficients of all units are
+        stacked in one (n_rows, n_coef) array and unit k owns the rows
+        ptr[k]:ptr[k+1], each row subtracting from objective row unit_ids[r]
+    '''
+
+    def __init__(self, coefficients, vis_units):
+
+        n_rows = np.array([len(v) for v in vis_units], 'int64')
+        self.ptr = np.hstack(([0], np.cumsum(n_rows)))
+        self.n_rows = n_rows
+        self.data = np.concatenate(
+            [np.asarray(c, 'float32').reshape(len(v), -1)
+             for c, v in zip(coefficients, vis_units)], axis=0)
+        self.unit_ids = np.concatenate(
+            [np.asarray(v, 'int64') for v in vis_units])
+
+        # number of objective time points touched by one row
+        self.n_coef = self.data.shape[1]
+        self.length = self.n_coef - 4
+
+    def subtract(self, obj, times, offsets, unit_ids, scales,
+                 max_rows=200000):
+        ''' obj[unit_ids[r], t + i] -= scale * spline_r(i + offset)
+            for every event and every row of its template
+        '''
+        if len(times) == 0:
+            return
+
+        # same convention as the cuda kernel: shift the offset into [0, 1)
+        times = np.asarray(times, 'int64').copy()
+        delta = -np.asarray(offsets, 'float32')
+        neg = delta < 0
+        delta[neg] += 1
+        times[neg] += 1
+        basis = cubic_bspline_basis(delta)
+        scales = np.asarray(scales, 'float32')
+        unit_ids = np.asarray(unit_ids, 'int64')
+
+        n_time = obj.shape[1]
+        obj_flat = obj.reshape(-1)
+        time_pts = np.arange(self.length)
+
+        # process events in groups to bound the size of the expanded rows
+        counts = self.n_rows[unit_ids]
+        ends = np.cumsum(counts)
+        start_event = 0
+        while start_event < len(times):
+            end_event = np.searchsorted(
+                ends, ends[start_event] - counts[start_event] + max_rows,
+                side='right')
+            end_event = max(end_event, start_event + 1)
+            events = np.arange(start_event, end_event)
+
+            # expand events to template rows
+            event_of_row = np.repeat(events, counts[events])
+            first_row = np.repeat(self.ptr[unit_ids[events]], counts[events])
+            local_row = (np.arange(len(event_of_row)) -
+                         np.repeat(np.cumsum(counts[events]) - counts[events],
+                                   counts[events]))
+            rows = first_row + local_row
+
+            # reconstruct the interpolated values
+            coefs = self.data[rows]
+            b = basis[event_of_row]
+            vals = coefs[:, :self.length]*b[:, [0]]
+            for j in range(1, 4):
+                vals += coefs[:, j:j + self.length]*b[:, [j]]
+            vals *= scales[event_of_row][:, None]
+
+            # scatter into the objective
+            cols = times[event_of_row][:, None] + time_pts
+            valid = np.logical_and(cols >= 0, cols < n_time)
+            flat_idx = self.unit_ids[rows][:, None]*n_time + cols
+            np.subtract.at(obj_flat, flat_idx[valid], vals[valid])
+
+            start_event = end_event
+
+
+class deconvCPU(deconvGPU):
+    ''' cpu version of deconvGPU; same algorithm and interface
+        (shifted svd objective, quadratic peak refinement, height fitting,
+        b-spline subtraction and scd) using numpy instead of the
+        cudaSpline/rowshift extensions
+    '''
+
+    def initialize(self, move_data_to_gpu=False):
+
+        deconvGPU.initialize(self, move_data_to_gpu=False)
+
+        self.data_to_cpu()
+
+    def data_to_cpu(self):
+
+        self.peak_pts = np.arange(-1, 2)
+
+        # norm
+        self.norms = np.sum(np.square(self.temps), (0, 1)).astype('float32')
+
+        # spatial and temporal component of svd
+        self.spat_comp = np.asarray(self.spat_comp, 'float32')
+        self.temp_comp = np.asarray(self.temp_comp, 'float32')
+
+        # visible channels and (reversed) alignment shifts of each unit
+        self.vis_chans = [np.where(np.any(self.spat_comp[unit] != 0, 0))[0]
+                          for unit in range(self.K)]
+        self.unit_shifts = [reverse_shifts(self.align_shifts[unit])
+                            for unit in range(self.K)]
+
+        # flipped temporal components; their spectra are cached per fft size
+        self.temp_comp_flipped = self.temp_comp[:, :, ::-1]
+        self.temp_comp_fft = {}
+
+        # load vis units
+        fname_vis_units = os.path.join(self.init_dir, 'vis_units.npy')
+        vis_units = np.load(fname_vis_units, allow_pickle=True)
+        self.coefficients = SplineTemplates(self.coefficients, vis_units)
+
+        if self.fit_height:
+            self.large_units = np.asarray(self.large_units)
+
+        # n units whose objective is computed in one batched fft
+        self.unit_batch_size = 64
+
+    def data_to_gpu(self):
+        self.data_to_cpu()
+
+    def run(self, chunk_id):
+
+        # rest lists for each segment of time
+        self.spike_array = []
+        self.neuron_array = []
+        self.shift_list = []
+        self.height_list = []
+        self.add_spike_temps = []
+        self.add_spike_times = []
+
+        # save iteration
+        self.chunk_id = chunk_id
+
+        # load raw data and templates
+        self.load_data(chunk_id)
+
+        # make objective function
+        self.make_objective_shifted_svd()
+
+        # run
+        self.subtraction_step()
+
+        # gather results
+        self.gather_results()
+
+    def gather_results(self):
+
+        if len(self.spike_array) > 0:
+            spike_times = np.concatenate(self.spike_array)
+            neuron_ids = np.concatenate(self.neuron_array)
+            spike_train = np.stack((spike_times, neuron_ids), 1)
+
+            # fix spike times
+            spike_train[:, 0] += self.STIME//2 - (2 * self.jitter_diff)
+            spike_train[:, 0] += self.peak_time_residual_offset[
+                spike_train[:, 1]]
+            self.spike_train = spike_train
+
+            # make shifts and heights
+            self.shifts = np.concatenate(self.shift_list)
+            self.heights = np.concatenate(self.height_list)
+
+        # if no spikes are found return empty lists
+        else:
+            self.spike_train = np.zeros((0, 2), 'int32')
+
+            # make shifts and heights
+            self.shifts = np.zeros(0, 'float32')
+            self.heights = np.zeros(0, 'float32')
+
+        self.spike_array = None
+        self.neuron_array = None
+        self.shift_list = None
+        self.height_list = None
+
+    def load_data(self, chunk_id):
+        ''' read a chunk with its buffer as (n_channels, n_times) float32
+            and keep the recording time of its first sample
+        '''
+        self.data = self.reader.read_data_batch(
+            chunk_id, add_buffer=True).T.astype('float32')
+
+        self.offset = self.reader.idx_list[chunk_id, 0] - self.reader.buffer
+
+    def get_temp_comp_fft(self, n_fft):
+        if n_fft not in self.temp_comp_fft:
+            self.temp_comp_fft[n_fft] = scipy.fft.rfft(
+                self.temp_comp_flipped, n_fft, axis=2).astype('complex64')
+        return self.temp_comp_fft[n_fft]
+
+    def make_objective_shifted_svd(self):
+        ''' objective for every unit: spatial svd components applied to the
+            (per channel shifted) data, convolved with the temporal
+            components; convolutions of a batch of units are done with one
+            rfft, summing over rank in frequency domain
+        '''
+        C, T = self.data.shape
+        obj_len = T + self.STIME - 1 + 2*self.jitter_diff
+        n_fft = scipy.fft.next_fast_len(T + self.STIME - 1)
+        temp_fft = self.get_temp_comp_fft(n_fft)
+
+        # pad data on the left so that a right shift is a slice
+        max_shift = int(np.max([s.max() for s in self.unit_shifts]))
+        data_padded = np.zeros((C, T + max_shift), 'float32')
+        data_padded[:, max_shift:] = self.data
+        time_idx = np.arange(T)
+
+        self.obj = np.zeros((self.K, obj_len), 'float32')
+        for batch_start in range(0, self.K, self.unit_batch_size):
+            units = np.arange(batch_start,
+                              min(batch_start + self.unit_batch_size, self.K))
+            mm = np.zeros((len(units), self.RANK, T), 'float32')
+            for ii, unit in enumerate(units):
+                vis = self.vis_chans[unit]
+                if len(vis) == 0:
+                    continue
+                shifts = self.unit_shifts[unit][vis]
+                shifted = data_padded[vis[:, None],
+                                      (max_shift - shifts)[:, None] + time_idx]
+                mm[ii] = np.matmul(self.spat_comp[unit][:, vis], shifted)
+
+            mm_fft = scipy.fft.rfft(mm, n_fft, axis=2)
+            conv = scipy.fft.irfft(
+                np.sum(mm_fft*temp_fft[units], 1), n_fft, axis=1)
+            self.obj[units, :T + self.STIME - 1] = conv[:, :T + self.STIME - 1]
+
+        self.obj = 2*self.obj - self.norms[:, None]
+
+    def save_spikes(self):
+        self.spike_array.append(self.spike_times[:, 0])
+        self.neuron_array.append(self.neuron_ids[:, 0])
+        self.shift_list.append(self.xshifts)
+        self.height_list.append(self.heights)
+
+    def find_shifts(self):
+        ''' subsample shift of every spike (self.xshifts), from a quadratic
+            fit to the objective at its peak and the two points around it
+        '''
+
+        start1 = dt.datetime.now().timestamp()
+
+        self.threePts = self.obj[self.neuron_ids,
+                                 self.spike_times + self.peak_pts]
+        self.shift_from_quad_fit_3pts_flat_equidistant_constants(
+            self.threePts.T)
+
+        return (dt.datetime.now().timestamp() - start1)
+
+    def compute_height(self):
+        ''' amplitude of every spike (self.heights), from the interpolated
+            peak of the objective over the template norm. only large units
+            are scaled, and heights more than max_height_diff away from 1
+            are reset to 1
+        '''
+
+        start1 = dt.datetime.now().timestamp()
+
+        if self.fit_height:
+            # get peak value
+            peak_vals = self.quad_interp_3pt(self.threePts.T, self.xshifts)
+
+            # height
+            height = 0.5*(peak_vals/self.norms[self.neuron_ids[:, 0]] + 1)
+            height[height < 1 - self.max_height_diff] = 1
+            height[height > 1 + self.max_height_diff] = 1
+
+            idx_small_ = ~np.isin(self.neuron_ids[:, 0], self.large_units)
+            height[idx_small_] = 1
+
+            self.heights = height.astype('float32')
+
+        else:
+            self.heights = np.ones(len(self.xshifts), 'float32')
+
+        return (dt.datetime.now().timestamp() - start1)
+
+    def find_peaks(self):
+        ''' same peak search as deconvGPU.find_peaks: max over units, then
+            points that are the (first) maximum of their lockout window
+        '''
+
+        start = dt.datetime.now().timestamp()
+
+        neuron_ids = np.argmax(self.obj, 0)
+        obj_max = self.obj[neuron_ids, np.arange(self.obj.shape[1])]
+
+        # only points above threshold can become spikes
+        candidates = np.where(obj_max > self.deconv_thresh)[0]
+        if len(candidates) > 0:
+            # equivalent of max_pool1d(lockout_window, 1, lockout_window//2)
+            window_max = maximum_filter1d(
+                obj_max, self.lockout_window, mode='constant',
+                cval=-np.inf)
+            candidates = candidates[
+                obj_max[candidates] >= window_max[candidates]]
+
+            # on ties, keep the first point of the window only
+            if len(candidates) > 1:
+                tie = np.hstack((False, np.logical_and(
+                    np.diff(candidates) < self.lockout_window//2,
+                    obj_max[candidates[1:]] == obj_max[candidates[:-1]])))
+                candidates = candidates[~tie]
+
+        # exclude spikes that occur in lock_outwindow at start and end
+        candidates = candidates[np.logical_and(
+            candidates > self.subtraction_offset,
+            candidates < self.obj.shape[1] - self.subtraction_offset)]
+
+        self.spike_times = candidates[:, None]
+        self.neuron_ids = neuron_ids[candidates][:, None]
+
+        return (dt.datetime.now().timestamp() - start)
+
+    def subtract_cpp(self):
+
+        start = dt.datetime.now().timestamp()
+
+        spike_times = self.spike_times[:, 0] - self.subtraction_offset
+        spike_temps = self.neuron_ids[:, 0]
+
+        # zero out shifts if superres shift turned off
+        if not self.superres_shift:
+            self.xshifts = self.xshifts*0
+
+        self.coefficients.subtract(
+            self.obj, spike_times, self.xshifts, spike_temps,
+            self.tempScaling*self.heights)
+
+        # also fill in self-convolution traces with low energy so the
+        #   spikes cannot be detected again (i.e. enforcing refractoriness)
+        if self.refractoriness:
+            self.refrac_fill(spike_times, spike_temps, -self.fill_value)
+
+        return (dt.datetime.now().timestamp() - start)
+
+    def refrac_fill(self, spike_times, spike_ids, fill_value):
+        fill_length = self.refractory*2 + 1
+        fill_offset = self.subtraction_offset - 2 - self.refractory
+
+        cols = spike_times[:, None] + fill_offset + np.arange(fill_length)
+        rows = np.broadcast_to(spike_ids[:, None], cols.shape)
+        valid = np.logical_and(cols >= 0, cols < self.obj.shape[1])
+        np.add.at(self.obj, (rows[valid], cols[valid]), fill_value)
+
+    def add_cpp_allspikes(self):
+
+        # select all spikes from a previous iteration
+        (spike_times, spike_temps,
+         spike_shifts, spike_heights) = self.sample_spikes_allspikes()
+
+        if self.refractoriness:
+            self.refrac_fill(spike_times, spike_temps, self.fill_value)
+
+        # Add spikes back in;
+        self.coefficients.subtract(
+            self.obj, spike_times, spike_shifts, spike_temps,
+            -self.tempScaling*spike_heights)
+
+
+def run_deconv_cpu_chunk(d_cpu, chunk_id):
+    ''' deconvolve one chunk on a shallow copy of the deconv object
+        (read only template data is shared, chunk state is not)
+    '''
+
+    time_index = int((chunk_id+1)*d_cpu.reader.n_sec_chunk +
+                     d_cpu.reader.start/d_cpu.reader.sampling_rate)
+    fname = os.path.join(d_cpu.seg_dir, str(time_index).zfill(6)+'.npz')
+
+    if os.path.exists(fname):
+        return
+
+    d_chunk = copy.copy(d_cpu)
+    d_chunk.run(chunk_id)
+
+    np.savez(fname,
+             spike_train=d_chunk.spike_train,
+             offset=d_chunk.offset,
+             shifts=d_chunk.shifts,
+             heights=d_chunk.heights)
+
+
+def run_core_deconv_cpu(d_cpu, chunk_ids, n_threads):
+    ''' run deconvCPU over chunks with a thread pool; numpy and scipy.fft
+        release the GIL for the heavy operations
+    '''
+    if n_threads <= 1:
+        for chunk_id in chunk_ids:
+            run_deconv_cpu_chunk(d_cpu, chunk_id)
+    else:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(
+                lambda chunk_id: run_deconv_cpu_chunk(d_cpu, chunk_id),
+                chunk_ids))
@@ -13,8 +13,13 @@ from torch import nn
 #from torch.autograd import Variable
 
 # cuda package to do GPU based spline interpolation and subtraction
-import cudaSpline as deconv
-import rowshift as rowshift
+# (not available on cpu-only machines, where deconvCPU is used instead)
+try:
+    import cudaSpline as deconv
+    import rowshift as rowshift
+except ImportError:
+    deconv = None
+    rowshift = None
 
 from yass.postprocess.duplicate import abs_max_dist
 from yass.deconvolve.util import WaveForms
@@ -12,6 +12,7 @@ import torch.multiprocessing as mp
 from yass import read_config
 from yass.reader import READER
 from yass.deconvolve.match_pursuit_gpu_new import deconvGPU
+from yass.deconvolve.match_pursuit_cpu import deconvCPU, run_core_deconv_cpu
 from yass.deconvolve.util import make_CONFIG2
 
 def run(fname_templates_in,
@@ -123,7 +124,10 @@ def deconv_ONgpu(fname_templates_in,
                  run_chunk_sec):
 
     # **************** MAKE DECONV OBJECT *****************
-    d_gpu = deconvGPU(CONFIG, fname_templates_in, output_directory)
+    if CONFIG.deconvolution.deconv_gpu:
+        d_gpu = deconvGPU(CONFIG, fname_templates_in, output_directory)
+    else:
+        d_gpu = deconvCPU(CONFIG, fname_templates_in, output_directory)
 
     # Cat: TODO: read from CONFIG
     d_gpu.max_iter = 1000
@@ -262,6 +266,13 @@ def deconv_ONgpu(fname_templates_in,
 
 def run_core_deconv(d_gpu, CONFIG):
 
+    # cpu deconv: chunks are processed by a thread pool
+    if not CONFIG.deconvolution.deconv_gpu:
+        d_gpu.initialize()
+        chunk_ids = np.arange(d_gpu.reader.n_batches)
+        run_core_deconv_cpu(d_gpu, chunk_ids, CONFIG.resources.n_processors)
+        return d_gpu
+
     os.environ["CUDA_VISIBLE_DEVICES"] = ','.join(
         [str(i) for i in range(torch.cuda.device_count())])
     chunk_ids = np.arange(d_gpu.reader.n_batches)
@@ -13,6 +13,7 @@ from tqdm import tqdm
 from yass.deconvolve._deconvolve_utils import shift_channels_cython
 
 from yass.geometry import n_steps_neigh_channels
+from yass.template import time_windows
 
 class WaveForms(object):
 
@@ -125,25 +126,10 @@ class WaveForms(object):
         --------
         numpy.ndarray of shifted wave forms.
         """
-        unit_time_window = np.arange(
-                self.n_time - 2 * clip_value) + shifts[:, None]
-        default_range = np.arange(self.n_time - 2 * clip_value)
-        sub_shifts = shifts - np.floor(shifts)
-        shifts = np.floor(shifts).astype(np.int)
-
-        def sub(i, shift, sub=None):
-            if sub is None:
-                return self.wave_forms[i, :, default_range + shift]
-            return sub(i, shift) * sub + sub(i, shift + 1) * (1 - sub)
-
-        if sub_shifts.sum() > 0.:
-            # Linear interpolation.
-            np.array(
-                [sub(i, s, sub_shifts[i]) for i, s in enumerate(
-                    shifts)]).transpose([0, 2, 1])
-
-        return np.array(
-                [sub(i, s) for i, s in enumerate(shifts)]).transpose([0, 2, 1])
+        shifts = np.floor(shifts).astype('int64')
+
+        return time_windows(
+            self.wave_forms, shifts, self.n_time - 2 * clip_value)
 
     def align(self, ref_wave_form=None, jitter=3, upsample=1, return_shifts=False):
         """Aligns all the wave forms to the reference wave form.
@@ -851,18 +837,18 @@ def align_templates(temp_, jitter, neigh_chans, ref=None, min_loc_ref=None):
     chans_must_in = np.where(np.abs(temp_).max(1) > 1)[0]
     vis_chan_keep = np.unique(np.hstack((vis_chan_keep, chans_must_in)))
 
-    # choose best among survived ones
+    # choose best among survived ones: the smallest minimum of each channel
+    # (first one on ties), or the global minimum if it has none
     best_shifts = np.zeros(n_chans, 'int32')
-    for c in vis_chan_keep:
-        idx_ = np.where(cc == c)[0]
-        if len(idx_) > 0:
-            best_shifts[c] = tt[idx_][val[idx_].argmin()]
-        else:
-            best_shifts[c] = dist_[c].argmin()
+    best_shifts[vis_chan_keep] = dist_[vis_chan_keep].argmin(1)
+    order = np.lexsort((val, cc))
+    first = np.ones(len(order), 'bool')
+    first[1:] = cc[order][1:] != cc[order][:-1]
+    best_shifts[cc[order][first]] = tt[order][first]
 
     aligned_temp = np.zeros((n_chans, n_time_small), 'float32')
-    for c in vis_chan_keep:
-        aligned_temp[c] = temp_[c][best_shifts[c]:best_shifts[c]+n_time_small]
+    aligned_temp[vis_chan_keep] = time_windows(
+        temp_[vis_chan_keep], best_shifts[vis_chan_keep], n_time_small)
 
     return aligned_temp, best_shifts, vis_chan_keep
 
@@ -11,6 +11,7 @@ from scipy.optimize import linear_sum_assignment
 from scipy.spatial.distance import pdist, squareform, cdist
 from tqdm import tqdm
 
+from yass.arena import SpikeTrainIndex
 from yass.geometry import find_channel_neighbors, parse
 from yass.evaluate.stability_filters import butterworth, whitening
 
@@ -545,11 +546,7 @@ class SpikeSortingEvaluation(object):
         spt: numpy.ndarray
             Shape [N, 2]. Clean spike train where cluster ids are 0, ..., N-1.
         """
-        n_cluster = np.max(spt[:, 1]) + 1
-        counts = np.zeros(n_cluster)
-        for u in range(n_cluster):
-            counts[u] = np.sum(spt[:, 1] == u)
-        return counts
+        return SpikeTrainIndex(spt).n_spikes().astype('float64')
 
     def compute_confusion_matrix(self):
         """Calculates the confusion matrix of two spike trains.
@@ -559,14 +556,14 @@ class SpikeSortingEvaluation(object):
         """
         confusion_matrix = np.zeros(
             [self.n_units, self.n_clusters])
+        spike_times_base = [np.sort(spt) for spt in SpikeTrainIndex(
+            self.spt_base, self.n_units).split_times()]
+        spike_times_clusters = [np.sort(spt) for spt in SpikeTrainIndex(
+            self.spt, self.n_clusters).split_times()]
         for unit in tqdm(range(self.n_units)):
-            idx = self.spt_base[:, 1] == unit
-            spike_times_base = np.sort(self.spt_base[idx, 0])
             for cluster in range(self.n_clusters):
-                idx = self.spt[:, 1] == cluster
-                spike_times_cluster = np.sort(self.spt[idx, 0])
                 confusion_matrix[unit, cluster] = self.count_matches(
-                    spike_times_base, spike_times_cluster)
+                    spike_times_base[unit], spike_times_clusters[cluster])
         self.confusion_matrix = confusion_matrix
 
     def count_matches(self, array1, array2):
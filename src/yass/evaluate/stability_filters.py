@@ -6,9 +6,9 @@ https://github.com/hooshmandshr/yass_visualization/blob/master/src/stability/fil
 """
 
 import numpy as np
-from scipy.signal import butter, lfilter
 
 from yass.geometry import n_steps_neigh_channels
+from yass.preprocess.util import butterworth_filter
 
 # FIXME: these functions were copied from yass when this was in a separate repo
 # the yass versions have been updated, we need to update the stability copied
@@ -31,17 +31,8 @@ def butterworth(ts, low_freq, high_factor, order, sampling_freq):
     sampling_freq: int
         Sampling frequency (Hz)
     """
-    T, C = ts.shape
-
-    low = float(low_freq)/sampling_freq * 2
-    high = float(high_factor) * 2
-    b, a = butter(order, [low, high], btype='band')
-    fts = np.zeros((T, C))
-
-    for i in range(C):
-        fts[:, i] = lfilter(b, a, ts[:, i])
-
-    return fts
+    return butterworth_filter(ts, low_freq, high_factor, order,
+                              sampling_freq, btype='band', zero_phase=False)
 
 
 def whitening(ts, neighbors, spike_size):
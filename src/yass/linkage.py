@@ -0,0 +1,135 @@
+"""
+Connected components of thresholded distance graphs
+
+Two nodes are connected at a threshold t if their distance is < t. The
+components at every threshold are given by a single-linkage dendrogram:
+the edges are sorted by distance once and merged with a disjoint-set, so
+that the components at any threshold (or the threshold giving k
+components) are found by lookup instead of building a graph per query.
+"""
+import numpy as np
+
+
+class DisjointSet(object):
+    '''
+    union-find over nodes 0, ..., n-1 with union by size and path halving
+    '''
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1]*n
+        self.n_components = n
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        '''merge the sets of i and j. returns False if already merged'''
+        i = self.find(i)
+        j = self.find(j)
+        if i == j:
+            return False
+
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+        self.n_components -= 1
+
+        return True
+
+    def labels(self):
+        '''
+        component label of every node. components are numbered by their
+        smallest node
+        '''
+        roots = np.array([self.find(i) for i in range(len(self.parent))],
+                         'int64')
+        _, first, labels = np.unique(roots, return_index=True,
+                                     return_inverse=True)
+        return np.argsort(np.argsort(first))[labels]
+
+
+def group_labels(labels):
+    '''list of nodes (sorted) of every component'''
+    order = np.argsort(labels, kind='stable')
+    ptr = np.searchsorted(labels[order], np.arange(labels.max() + 2))
+    return [list(order[ptr[k]:ptr[k+1]]) for k in range(len(ptr) - 1)]
+
+
+def connected_components(n_nodes, rows, cols):
+    '''
+    components of an undirected graph given by its edges (rows, cols),
+    as lists of nodes
+    '''
+    if n_nodes == 0:
+        return []
+
+    dsu = DisjointSet(n_nodes)
+    for i, j in zip(rows.tolist(), cols.tolist()):
+        dsu.union(i, j)
+
+    return group_labels(dsu.labels())
+
+
+class SingleLinkage(object):
+    '''
+    single-linkage dendrogram of a symmetric (n, n) distance matrix.
+
+    heights[m] is the distance at which the (m+1)-th merge happens, so
+    the graph of edges with distance < t has n - #(heights < t)
+    components. edges with nan or infinite distance never connect nodes
+    '''
+
+    def __init__(self, dist):
+
+        n = dist.shape[0]
+        rows, cols = np.triu_indices(n, 1)
+        weights = dist[rows, cols]
+        keep = np.isfinite(weights)
+        rows, cols, weights = rows[keep], cols[keep], weights[keep]
+        order = np.argsort(weights, kind='stable')
+
+        dsu = DisjointSet(n)
+        merges = []
+        for e in order.tolist():
+            if dsu.union(rows[e], cols[e]):
+                merges.append(e)
+                if dsu.n_components == 1:
+                    break
+
+        self.n_nodes = n
+        self.edges = np.vstack((rows[merges], cols[merges])).T
+        self.heights = weights[merges]
+
+    def n_components(self, thresh):
+        '''number of components of the graph of distances < thresh'''
+        return self.n_nodes - np.searchsorted(self.heights, thresh, 'left')
+
+    def components(self, thresh):
+        '''components of the graph of distances < thresh'''
+        n_merges = np.searchsorted(self.heights, thresh, 'left')
+        return connected_components(self.n_nodes, *self.edges[:n_merges].T)
+
+    def k_components(self, k):
+        '''
+        components when there are exactly k of them and the threshold
+        giving them: the height of the next merge (or inf if there is none).
+        raises ValueError if no threshold gives k components (ties)
+        '''
+        n_merges = self.n_nodes - k
+        if n_merges < 0 or n_merges > len(self.heights):
+            raise ValueError("no threshold gives {} components".format(k))
+
+        if n_merges == len(self.heights):
+            thresh = np.inf
+        else:
+            thresh = self.heights[n_merges]
+        if n_merges > 0 and self.heights[n_merges-1] == thresh:
+            raise ValueError("no threshold gives {} components".format(k))
+
+        return self.components(thresh), thresh
@@ -3,15 +3,18 @@ import numpy as np
 import tqdm
 import parmap
 import scipy
+import scipy.sparse
 import logging
+from collections import OrderedDict
 
 from diptest import diptest as dp
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
-from sklearn.metrics import pairwise_distances
 import networkx as nx
 from scipy.spatial.distance import pdist, squareform
 from sklearn.cluster import AgglomerativeClustering
 
+from yass.arena import SpikeTrainIndex
+from yass.spike_train import soft_counts
 from yass.template import shift_chans, align_get_shifts_with_ref
 from yass.correlograms_phy import compute_correlogram_v2
 from yass.merge.notch import notch_finder
@@ -71,10 +74,15 @@ class TemplateMerge(object):
         self.shifts = self.shifts[idx_in]
         self.scales = self.scales[idx_in]
         self.soft_assignment = self.soft_assignment[idx_in]
+        self.spike_index = SpikeTrainIndex(self.spike_train, self.n_units)
 
         self.multi_processing = multi_processing
         self.n_processors = n_processors
 
+        # clean waveforms of the units in the merge tests of this process
+        self.waveform_cache = OrderedDict()
+        self.waveform_cache_size = 50
+
         logger.info('{} units in'.format(self.n_units))
 
         # effective number of spikes
@@ -99,9 +107,8 @@ class TemplateMerge(object):
 
     def compute_n_spikes_soft(self):
 
-        n_spikes_soft = np.zeros(self.n_units)
-        for j in range(self.spike_train.shape[0]):
-            n_spikes_soft[self.spike_train[j, 1]] += self.soft_assignment[j]
+        n_spikes_soft = soft_counts(
+            self.spike_train[:, 1], self.soft_assignment, self.n_units)
         self.n_spikes_soft = n_spikes_soft.astype('int32')
 
     def get_temproal_whitener(self):
@@ -131,47 +138,8 @@ class TemplateMerge(object):
         # mask out small ptp
         self.ptps[self.ptps < 1] = 0
 
-        # distances of ptps
-        dist_mat = np.square(pairwise_distances(self.ptps))
-
-        # compute distance relative to the norm of ptps
-        norms = np.square(np.linalg.norm(self.ptps, axis=1))
-
-        # exclude comparing to self
-        for i in range(self.n_units):
-            dist_mat[i, i] = np.max(norms)*100
-
-        dist_norm_ratio = dist_mat / np.maximum(
-            norms[np.newaxis], norms[:, np.newaxis])
-        # units need to be close to each other
-        idx1 = dist_norm_ratio < 0.5
-
-        # ptp of both units need to be bigger than 3
-        ptp_max = self.ptps.max(1)
-        smaller_ptps = np.minimum(ptp_max[np.newaxis],
-                                  ptp_max[:, np.newaxis])
-        idx2 = smaller_ptps > 3
-
-        # expect to have at least 10 spikes
-        smaller_n_spikes = np.minimum(self.n_spikes_soft[None],
-                                      self.n_spikes_soft[:, None])
-        idx3 = smaller_n_spikes > 10
-
-        units_1, units_2 = np.where(np.logical_and(
-            np.logical_and(idx1, idx2), idx3))
-        
-        # get unique pairs only for comparison
-        unique_pairs = []
-        for x, y in zip(units_1, units_2):
-            if [x, y] not in unique_pairs and [y, x] not in unique_pairs:
-                ratio = self.n_spikes_soft[x]/self.n_spikes_soft[y]
-                # if the ratio is too bad, ignore it because it will
-                # always try to merge
-                if ((ratio > 1/20 and ratio < 20) or 
-                    (ptp_max[x] > 10 and ptp_max[y] > 10)):
-                    unique_pairs.append([x, y])
-
-        self.merge_candidates = unique_pairs
+        self.merge_candidates = find_ptp_merge_candidates(
+            self.ptps, self.n_spikes_soft).tolist()
 
 
     def xcor_notch_test(self, pairs, templates):
@@ -261,13 +229,17 @@ class TemplateMerge(object):
 
         if not os.path.exists(fname):
 
+            # pairs sorted by unit, so that each worker tests the pairs of
+            # few units and reads their waveforms once
+            pairs = np.asarray(self.merge_candidates, 'int64').reshape(-1, 2)
+            pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+            self.plan_merge_tests(pairs)
+
             if self.multi_processing:
-                # break the list of pairs
-                merge_candidates_partition = []
-                for j in range(self.n_processors):
-                    merge_candidates_partition.append(
-                        self.merge_candidates[
-                            slice(j, len(self.merge_candidates), self.n_processors)])
+                # break the list of pairs into contiguous blocks
+                merge_candidates_partition = [
+                    block.tolist() for block in
+                    np.array_split(pairs, self.n_processors)]
 
                 merge_pairs_ = parmap.map(
                     self.merge_templates_parallel, 
@@ -283,8 +255,7 @@ class TemplateMerge(object):
                     merge_pairs = np.concatenate(np.array(merge_pairs))
             # single core version
             else:
-                merge_pairs = self.merge_templates_parallel(
-                    self.merge_candidates)
+                merge_pairs = self.merge_templates_parallel(pairs.tolist())
                 merge_pairs = np.array(merge_pairs)
 
             np.save(fname, merge_pairs)
@@ -293,10 +264,104 @@ class TemplateMerge(object):
 
         self.merge_pairs = merge_pairs
 
+    def plan_pair(self, unit1, unit2, n_samples=2000):
+        '''
+        number of spikes to sample from each unit, visible channels, main
+        channel and relative shift of unit2 to unit1 of a merge test
+        '''
+        n_spikes1 = self.n_spikes_soft[unit1]
+        n_spikes2 = self.n_spikes_soft[unit2]
+
+        # randomly subsample
+        if n_spikes1 + n_spikes2 > n_samples:
+            ratio1 = n_spikes1/float(n_spikes1+n_spikes2)
+            n_samples1 = np.min((int(n_samples*ratio1), n_spikes1))
+            n_samples2 = n_samples - n_samples1
+        else:
+            n_samples1 = n_spikes1
+            n_samples2 = n_spikes2
+
+        ptp_max = self.ptps[[unit1, unit2]].max(0)
+        mc = ptp_max.argmax()
+        vis_chan = np.where(ptp_max > 1)[0]
+
+        # align two units
+        shift_temp = (self.templates[unit2, :, mc].argmin() -
+                      self.templates[unit1, :, mc].argmin())
+
+        return n_samples1, n_samples2, vis_chan, mc, shift_temp
+
+    def plan_merge_tests(self, pairs):
+        '''
+        number of spikes, channels and time margin of the waveforms of every
+        unit that cover all of its merge tests, so that they are read once
+        '''
+        self.unit_n_samples = {}
+        self.unit_chans = {}
+        self.unit_margin = {}
+        for unit1, unit2 in pairs:
+            n_samples1, n_samples2, vis_chan, _, shift_temp = self.plan_pair(
+                unit1, unit2)
+            for unit, n_samples_, shift in ((unit1, n_samples1, 0),
+                                            (unit2, n_samples2, shift_temp)):
+                self.unit_n_samples[unit] = max(
+                    self.unit_n_samples.get(unit, 0), n_samples_)
+                self.unit_chans[unit] = np.union1d(
+                    self.unit_chans.get(unit, []), vis_chan).astype('int64')
+                self.unit_margin[unit] = max(
+                    self.unit_margin.get(unit, 0), abs(shift))
+
+    def unit_waveforms(self, unit):
+        '''
+        clean (residual + template) waveforms of a random subsample of unit,
+        drawn once and shared by all of its merge tests. windows are
+        padded by the time margin of the unit. returns the waveforms and
+        the positions in the draw of the spikes that were read
+        '''
+        if unit in self.waveform_cache:
+            self.waveform_cache.move_to_end(unit)
+            return self.waveform_cache[unit]
+
+        idx = self.spike_index.unit_rows(unit)
+        prob = self.soft_assignment[idx]
+        idx = idx[np.random.choice(len(idx), self.unit_n_samples[unit],
+                                   replace=False, p=prob/np.sum(prob))]
+        chans = self.unit_chans[unit]
+        margin = self.unit_margin[unit]
+
+        # load residuals
+        wfs, skipped_idx = self.reader_residual.read_waveforms(
+            self.spike_train[idx, 0], self.spike_size + 2*margin, chans)
+        kept = np.delete(np.arange(len(idx)), skipped_idx)
+        idx = idx[kept]
+
+        # align residuals and make clean waveforms
+        wfs = shift_chans(wfs, -self.shifts[idx])
+        wfs[:, margin:margin+self.spike_size] += (
+            self.scales[idx][:, None, None]*self.templates[unit][:, chans])
+
+        self.waveform_cache[unit] = (wfs, kept)
+        if len(self.waveform_cache) > self.waveform_cache_size:
+            self.waveform_cache.popitem(last=False)
+
+        return wfs, kept
+
+    def pair_waveforms(self, unit, n_samples, vis_chan, shift):
+        '''
+        the first n_samples of the cached waveforms of unit on vis_chan,
+        in the window starting shift samples after its spike times
+        '''
+        wfs, kept = self.unit_waveforms(unit)
+        rows = np.where(kept < n_samples)[0]
+        times = self.unit_margin[unit] + shift + np.arange(self.spike_size)
+        chans = np.searchsorted(self.unit_chans[unit], vis_chan)
+
+        return wfs[rows[:, None, None], times[None, :, None],
+                   chans[None, None]]
+
     def merge_templates_parallel(self, pairs):
         """Whether to merge two templates or not.
         """
-        n_samples = 2000
         p_val_threshold = 0.9
         merge_pairs = []
 
@@ -312,95 +377,26 @@ class TemplateMerge(object):
                     merge_pairs.append(pair)
 
             else:
-                
-                # get spikes times and soft assignment
-                idx1 = self.spike_train[:, 1] == unit1
-                spt1 = self.spike_train[idx1, 0]
-                prob1 = self.soft_assignment[idx1]
-                shift1 = self.shifts[idx1]
-                scale1 = self.scales[idx1]
-                n_spikes1 = self.n_spikes_soft[unit1]
-                
-                idx2 = self.spike_train[:, 1] == unit2
-                spt2 = self.spike_train[idx2, 0]
-                prob2 = self.soft_assignment[idx2]
-                shift2 = self.shifts[idx2]
-                scale2 = self.scales[idx2]
-                n_spikes2 = self.n_spikes_soft[unit2]
-                
-                # randomly subsample
-                if n_spikes1 + n_spikes2 > n_samples:
-                    ratio1 = n_spikes1/float(n_spikes1+n_spikes2)
-                    n_samples1 = np.min((int(n_samples*ratio1), n_spikes1))
-                    n_samples2 = n_samples - n_samples1
-
-                else:
-                    n_samples1 = n_spikes1
-                    n_samples2 = n_spikes2
-                idx1_ = np.random.choice(len(spt1), n_samples1, replace=False,
-                                         p=prob1/np.sum(prob1))
-                idx2_ = np.random.choice(len(spt2), n_samples2, replace=False,
-                                         p=prob2/np.sum(prob2))
-                spt1 = spt1[idx1_]
-                spt2 = spt2[idx2_]
-                shift1 = shift1[idx1_]
-                shift2 = shift2[idx2_]
-                scale1 = scale1[idx1_]
-                scale2 = scale2[idx2_]
-
-                ptp_max = self.ptps[[unit1, unit2]].max(0)
-                mc = ptp_max.argmax()
-                vis_chan = np.where(ptp_max > 1)[0]
-
-                # align two units
-                shift_temp = (self.templates[unit2, :, mc].argmin() - 
-                              self.templates[unit1, :, mc].argmin())
-                spt2 += shift_temp
-                
-                # load residuals
-                wfs1, skipped_idx1 = self.reader_residual.read_waveforms(
-                    spt1, self.spike_size, vis_chan)
-                spt1 = np.delete(spt1, skipped_idx1)
-                shift1 = np.delete(shift1, skipped_idx1)
-                scale1 = np.delete(scale1, skipped_idx1)
-                
-                wfs2, skipped_idx2 = self.reader_residual.read_waveforms(
-                    spt2, self.spike_size, vis_chan)
-                spt2 = np.delete(spt2, skipped_idx1)
-                shift2 = np.delete(shift2, skipped_idx2)
-                scale2 = np.delete(scale2, skipped_idx2)
-                
-                # align residuals
-                wfs1 = shift_chans(wfs1, -shift1)
-                wfs2 = shift_chans(wfs2, -shift2)
-
-                # make clean waveforms
-                wfs1 += scale1[:, None, None]*self.templates[[unit1], :, vis_chan].T
-                if shift_temp > 0:
-                    temp_2_shfted = self.templates[[unit2], shift_temp:, vis_chan].T
-                    wfs2[:, :-shift_temp] += scale2[:, None, None]*temp_2_shfted
-                elif shift_temp < 0:
-                    temp_2_shfted = self.templates[[unit2], :shift_temp, vis_chan].T
-                    wfs2[:, -shift_temp:] += scale2[:, None, None]*temp_2_shfted
-                else:
-                    wfs2 += scale2[:, None, None]*self.templates[[unit2],:,vis_chan].T
-
-                
-                # compute spatial covariance
+                n_samples1, n_samples2, vis_chan, _, shift_temp = \
+                    self.plan_pair(unit1, unit2)
+                wfs1 = self.pair_waveforms(unit1, n_samples1, vis_chan, 0)
+                wfs2 = self.pair_waveforms(unit2, n_samples2, vis_chan,
+                                           shift_temp)
+
+                # whitening is linear, so only the means are whitened and
+                # the direction is mapped back to project raw waveforms
                 spatial_whitener = self.get_spatial_whitener(vis_chan)
-                # whiten
-                wfs1_w = np.matmul(wfs1, spatial_whitener)
-                wfs2_w = np.matmul(wfs2, spatial_whitener)
-                wfs1_w = np.matmul(wfs1_w.transpose(0,2,1),
-                                  self.temporal_whitener).transpose(0,2,1)
-                wfs2_w = np.matmul(wfs2_w.transpose(0,2,1),
-                                  self.temporal_whitener).transpose(0,2,1)
-
-
-                temp_diff_w = np.mean(wfs1_w, 0) - np.mean(wfs2_w,0)
-                c_w = np.sum(0.5*(np.mean(wfs1_w, 0) + np.mean(wfs2_w,0))*temp_diff_w)
-                dat1_w = np.sum(wfs1_w*temp_diff_w, (1,2))
-                dat2_w = np.sum(wfs2_w*temp_diff_w, (1,2))
+                mean1_w = np.matmul(np.matmul(self.temporal_whitener.T,
+                                              wfs1.mean(0)), spatial_whitener)
+                mean2_w = np.matmul(np.matmul(self.temporal_whitener.T,
+                                              wfs2.mean(0)), spatial_whitener)
+                temp_diff_w = mean1_w - mean2_w
+                direction = np.matmul(np.matmul(self.temporal_whitener,
+                                                temp_diff_w),
+                                      spatial_whitener.T)
+
+                dat1_w = np.sum(wfs1*direction, (1, 2))
+                dat2_w = np.sum(wfs2*direction, (1, 2))
                 dat_all = np.hstack((dat1_w, dat2_w))
                 p_val = dp(dat_all)[1]
 
@@ -410,14 +406,6 @@ class TemplateMerge(object):
                     merge= False
 
                 centers_dist = np.linalg.norm(temp_diff_w)
-
-
-                if p_val > p_val_threshold:
-                    merge = True
-                else:
-                    merge= False
-                    
-                centers_dist = np.linalg.norm(temp_diff_w)
                 np.savez(fname_out,
                          merge=merge,
                          dat1_w=dat1_w,
@@ -489,11 +477,11 @@ class TemplateMerge(object):
 
     def get_l2_features(self, unit1, unit2, n_samples=2000):
 
-        idx1 = self.spike_train[:, 1] == unit1
+        idx1 = self.spike_index.unit_rows(unit1)
         spt1 = self.spike_train[idx1, 0]
         prob1 = self.soft_assignment[idx1]
 
-        idx2 = self.spike_train[:, 1] == unit2
+        idx2 = self.spike_index.unit_rows(unit2)
         spt2 = self.spike_train[idx2, 0]
         prob2 = self.soft_assignment[idx2]
 
@@ -634,6 +622,54 @@ class TemplateMerge(object):
                 soft_assignment_new, merge_array)
     
     
+def find_ptp_merge_candidates(ptps, n_spikes):
+    '''
+    pairs of units (x < y, sorted) whose ptps are close relative to their
+    norms: |ptp_x - ptp_y|^2 < 0.5 max(|ptp_x|^2, |ptp_y|^2), with both
+    max ptps above 3, both (soft) spike counts above 10 and a spike count
+    ratio within 1/20..20 unless both max ptps are above 10.
+
+    the closeness condition implies ptp_x . ptp_y > 0, so only units whose
+    ptps overlap on some channel (spatially nearby units) can be pairs.
+    their inner products come from one sparse product, which never builds
+    the dense (n_units, n_units) distance matrix
+    '''
+    n_units = ptps.shape[0]
+    ptp_sparse = scipy.sparse.csr_matrix(ptps.astype('float64'))
+    gram = scipy.sparse.triu(ptp_sparse.dot(ptp_sparse.T), k=1).tocoo()
+
+    # unique pairs, sorted by an integer key
+    keys = np.unique(gram.row.astype('int64')*n_units + gram.col)
+    gram = gram.tocsr()
+    units_1, units_2 = keys // n_units, keys % n_units
+    dot = np.asarray(gram[units_1, units_2]).ravel()
+
+    norms = np.square(np.linalg.norm(ptps, axis=1))
+    dist = norms[units_1] + norms[units_2] - 2*dot
+
+    # units need to be close to each other
+    idx1 = dist/np.maximum(norms[units_1], norms[units_2]) < 0.5
+
+    # ptp of both units need to be bigger than 3
+    ptp_max = ptps.max(1)
+    idx2 = np.minimum(ptp_max[units_1], ptp_max[units_2]) > 3
+
+    # expect to have at least 10 spikes
+    idx3 = np.minimum(n_spikes[units_1], n_spikes[units_2]) > 10
+
+    # if the ratio is too bad, ignore it because it will
+    # always try to merge
+    ratio = n_spikes[units_1]/np.maximum(n_spikes[units_2], 1).astype(
+        'float64')
+    idx4 = np.logical_or(
+        np.logical_and(ratio > 1/20, ratio < 20),
+        np.logical_and(ptp_max[units_1] > 10, ptp_max[units_2] > 10))
+
+    keep = idx1 & idx2 & idx3 & idx4
+
+    return np.vstack((units_1[keep], units_2[keep])).T
+
+
 def test_merge(features, assignment,
                lda_threshold=0.7,
                diptest_threshold=0.8):
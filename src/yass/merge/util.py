@@ -2,6 +2,7 @@ import os
 import numpy as np
 import networkx as nx
 
+from yass.arena import SpikeTrainIndex
 from yass.template import shift_chans, align_get_shifts_with_ref
 
 def partition_input(save_dir,
@@ -16,7 +17,7 @@ def partition_input(save_dir,
 
     # load data - only if incomplete files    
     templates = np.load(fname_templates)
-    spike_train = np.load(fname_spike_train)
+    spike_index = SpikeTrainIndex.load(fname_spike_train)
 
     n_units = templates.shape[0]
             
@@ -36,20 +37,16 @@ def partition_input(save_dir,
                 # set flag to false so won't read this data again
                 read_flag=False
 
-                spike_train_list = [[] for ii in range(n_units)]
-                for j in range(spike_train.shape[0]):
-                    tt, ii = spike_train[j]
-                    spike_train_list[ii].append(tt)
+                spike_train_list = [spike_index.unit_times(unit)
+                                    for unit in range(n_units)]
 
                 if fname_templates_up is not None:
                     spike_train_up = np.load(fname_spike_train_up)
                     templates_up = np.load(fname_templates_up)
 
-                    up_id_list = [[] for ii in range(n_units)]
-                    for j in range(spike_train.shape[0]):
-                        ii = spike_train[j, 1]
-                        up_id = spike_train_up[j, 1]
-                        up_id_list[ii].append(up_id)
+                    up_id_list = [
+                        spike_train_up[spike_index.unit_rows(unit), 1]
+                        for unit in range(n_units)]
 
             # proceed to compute partitioning
             if fname_templates_up is not None:
@@ -104,47 +104,43 @@ class maskData:
         N, nfeature, nchannel = score.shape
         uniqueGroup = np.unique(group)
         Ngroup = uniqueGroup.size
-        y = mask[:, np.newaxis, :] * score
-
-        y_temp = y[:, :, np.newaxis, :]
-        ySq = np.matmul(
-            np.transpose(y_temp, [0, 3, 1, 2]),
-            np.transpose(y_temp, [0, 3, 2, 1])).transpose((0, 2, 3, 1))
-
-        score_temp = score[:, :, np.newaxis, :]
-        scoreSq = np.matmul(
-            np.transpose(score_temp, [0, 3, 1, 2]),
-            np.transpose(score_temp, [0, 3, 2, 1])).transpose((0, 2, 3, 1))
-        z = mask[:, np.newaxis, np.newaxis, :] * scoreSq + \
-            (1 - mask)[:, np.newaxis, np.newaxis, :] * \
-            (np.eye(nfeature)[np.newaxis, :, :, np.newaxis])
-        eta = z - ySq
 
         if Ngroup == N:
-            sumY = y
-            sumYSq = ySq
-            sumEta = eta
-            groupMask = mask
-            weight = np.ones(N)
+            def group_sum(x):
+                return x
 
         elif Ngroup < N:
+            # sum the points of every group in one pass over the data
+            # sorted by group (the sort is stable, so points are added in
+            # their original order)
+            order = np.argsort(group, kind='stable')
+            starts = np.flatnonzero(np.diff(group[order], prepend=-1))
 
-            sumY = np.zeros((Ngroup, nfeature, nchannel))
-            sumYSq = np.zeros((Ngroup, nfeature, nfeature, nchannel))
-            sumEta = np.zeros((Ngroup, nfeature, nfeature, nchannel))
-            groupMask = np.zeros((Ngroup, nchannel))
-            weight = np.zeros(Ngroup)
-            for n in range(N):
-                idx = group[n]
-                sumY[idx] += y[n]
-                sumYSq[idx] += ySq[n]
-                sumEta[idx] += eta[n]
-                groupMask[idx] += mask[n]
-                weight[idx] += 1
+            def group_sum(x):
+                sums = np.zeros((Ngroup,) + x.shape[1:])
+                sums[uniqueGroup] = np.add.reduceat(x[order], starts, axis=0)
+                return sums
 
         else:
             raise ValueError(
                 "Number of groups is larger than the size of the data")
+
+        # with y = M * score, E[yy.T] = M^2 score score.T and
+        # eta = M score score.T + (1 - M) I - E[yy.T]
+        mask = mask.astype('float64')
+        scoreSq = np.einsum('nic,njc->nijc', score, score, dtype='float64')
+        sumMask = group_sum(mask)
+        weight = group_sum(np.ones(N))
+        sumY = group_sum(mask[:, np.newaxis] * score)
+        sumScoreSq = group_sum(mask[:, np.newaxis, np.newaxis] * scoreSq)
+        sumYSq = group_sum(
+            np.square(mask)[:, np.newaxis, np.newaxis] * scoreSq)
+        sumUnmasked = weight[:, np.newaxis] - sumMask
+        sumEta = sumScoreSq - sumYSq + \
+            sumUnmasked[:, np.newaxis, np.newaxis, :] * \
+            np.eye(nfeature)[np.newaxis, :, :, np.newaxis]
+        groupMask = sumMask
+
         # self.y = y
         self.sumY = sumY
         self.sumYSq = sumYSq
@@ -879,16 +875,10 @@ def birth_move(maskedData, vbParam, suffStat, param, L):
     return vbParam, suffStat, L
 
 def merge_move(maskedData, vbParam, suffStat, param, L, check_full):
-    n_merged = 0
-    ELBO = ELBO_Class(maskedData, suffStat, vbParam, param)
+    ELBO = ELBO_Class(maskedData, suffStat, vbParam, param).total
     nfeature, K, nchannel = vbParam.muhat.shape
 
-    if K > 1:
-        all_checked = 0
-    else:
-        all_checked = 1
-    ctr_merge_move_outer = 0
-    while (not all_checked) and (K > 1):
+    while K > 1:
         prec = np.transpose(
             vbParam.Vhat * vbParam.nuhat[
                 np.newaxis, np.newaxis, :, np.newaxis],
@@ -901,37 +891,172 @@ def merge_move(maskedData, vbParam, suffStat, param, L, check_full):
                       (2, 3, 4))
 
         maha[np.arange(K), np.arange(K)] = np.Inf
-        merged = 0
         threshold = np.max(np.min(maha, 0))
-        ctr_merge_move_inner = 0
-        while np.min(maha) < threshold and merged == 0:
-            closeset_pair = np.where(maha == np.min(maha))
-            ka = closeset_pair[0][0]
-            kb = closeset_pair[1][0]
-            maha[ka, kb] = np.inf
-            if np.argmin(maha[kb, :]).ravel()[0] == ka:
-                maha[kb, ka] = np.inf
-
-            vbParam, suffStat, merged, L, ELBO = check_merge(
-                maskedData, vbParam, suffStat, ka, kb, param, L, ELBO)
-            if merged:
-                n_merged += 1
-                K -= 1
-            
-            ctr_merge_move_inner+=1
 
-        if not merged:
-            all_checked = 1
-        #if ctr_merge_move_inner>10: 
-        #    print ("ctr_merge_move_inner: ",ctr_merge_move_inner)
-        ctr_merge_move_outer+=1
-    
-    #if ctr_merge_move_outer>10:
-     #   print ("ctr_merge_move_outer: ",ctr_merge_move_outer)
+        # every pair closer than the threshold (in either direction) is a
+        # candidate. the ELBO change of all of them is computed at once and
+        # the best non conflicting merges are accepted one after the other
+        # while they keep increasing the ELBO
+        candidate = maha < threshold
+        ka, kb = np.where(np.triu(candidate | candidate.T, 1))
+        if ka.size == 0:
+            break
+
+        gain, ELBO_now = calc_merge_gain(vbParam, suffStat, param, ka, kb)
+
+        merged = np.zeros(K, 'bool')
+        pairs = []
+        K_now = K
+        for p in np.argsort(-gain, kind='stable'):
+            if merged[ka[p]] or merged[kb[p]]:
+                continue
+            ELBO_amerge = ELBO_now + gain[p] + \
+                constant_ELBO(K_now - 1, suffStat, vbParam, param) - \
+                constant_ELBO(K_now, suffStat, vbParam, param)
+            if ELBO_amerge < ELBO:
+                break
+
+            merged[[ka[p], kb[p]]] = True
+            pairs.append(p)
+            ELBO = ELBO_now = ELBO_amerge
+            K_now -= 1
+
+        if len(pairs) == 0:
+            break
+
+        vbParam, suffStat, L = apply_merges(
+            vbParam, suffStat, param, L, ka[pairs], kb[pairs])
+        K = K_now
 
     return vbParam, suffStat, L
 
 
+def kvarying_ELBO(Nhat, sumY, sumYSq, param):
+    """
+        Cluster dependent part of the ELBO (see ELBO_Class) of clusters
+        with the given sufficient statistics, after the global update (see
+        vbPar.update_global)
+
+        Parameters:
+        -----------
+        Nhat: np.array
+            K numpy array of pseudocounts
+
+        sumY: np.array
+            nfeature x K x nchannel numpy array
+
+        sumYSq: np.array
+            nfeature x nfeature x K x nchannel numpy array
+
+        param: Config object (see config.py)
+    """
+    prior = param.cluster.prior
+    nfeature, Khat, nchannel = sumY.shape
+
+    ahat = prior.a + Nhat
+    lambdahat = prior.lambda0 + Nhat
+    nuhat = prior.nu + Nhat
+    muhat = sumY / lambdahat[:, np.newaxis]
+
+    muhat_temp = np.transpose(muhat, [1, 2, 0])
+    sumY_temp = np.transpose(sumY, [1, 2, 0])
+    invVhat = np.eye(nfeature) / prior.V + \
+        lambdahat[:, np.newaxis, np.newaxis, np.newaxis] * \
+        np.matmul(muhat_temp[..., np.newaxis], muhat_temp[:, :, np.newaxis])
+    temp = np.matmul(muhat_temp[..., np.newaxis], sumY_temp[:, :, np.newaxis])
+    invVhat += - temp - temp.transpose([0, 1, 3, 2])
+    invVhat += sumYSq.transpose([2, 3, 0, 1])
+    Vhat = np.linalg.solve(invVhat, np.eye(nfeature))
+    logdetVhat = np.sum(np.linalg.slogdet(Vhat)[1], axis=1)
+
+    return specsci.gammaln(ahat) + \
+        nfeature * nchannel / 2.0 * np.log(prior.lambda0 / lambdahat) + \
+        logdetVhat * nuhat / 2.0 + \
+        nchannel * specsci.multigammaln(nuhat / 2.0, nfeature)
+
+
+def constant_ELBO(Khat, suffStat, vbParam, param):
+    """
+        Part of the ELBO (see ELBO_Class) that only depends on the number
+        of clusters Khat, after the global update
+    """
+    prior = param.cluster.prior
+    nfeature, _, nchannel = vbParam.muhat.shape
+    sum_ahat = prior.a * Khat + np.sum(suffStat.Nhat)
+
+    return Khat * np.log(prior.beta) - prior.beta - \
+        specsci.gammaln(Khat + 1) - specsci.gammaln(sum_ahat) + \
+        specsci.gammaln(prior.a * Khat) - Khat * specsci.gammaln(prior.a) - \
+        prior.nu * nfeature * Khat * nchannel / 2.0 * np.log(prior.V) - \
+        Khat * nchannel * specsci.multigammaln(prior.nu / 2.0, nfeature) - \
+        nfeature * nchannel * np.log(np.pi) / 2.0 * vbParam.rhat.sum()
+
+
+def calc_merge_gain(vbParam, suffStat, param, ka, kb):
+    """
+        ELBO change of merging clusters ka[i] and kb[i], for every i, apart
+        from the change of constant_ELBO. Sufficient statistics are additive
+        and the rest of the ELBO is a sum over clusters, so every merge is
+        evaluated from the statistics of its two clusters only.
+
+        Returns the gains and the ELBO of the current clusters after the
+        global update
+    """
+    K = vbParam.rhat.shape[1]
+
+    kvarying = kvarying_ELBO(suffStat.Nhat, suffStat.sumY, suffStat.sumYSq,
+                             param)
+    kvarying_ab = kvarying_ELBO(
+        suffStat.Nhat[ka] + suffStat.Nhat[kb],
+        suffStat.sumY[:, ka] + suffStat.sumY[:, kb],
+        suffStat.sumYSq[:, :, ka] + suffStat.sumYSq[:, :, kb], param)
+
+    rhat = vbParam.rhat
+    ikvarying = np.sum(-rhat * np.log(rhat + 1e-200), axis=0)
+    rhat_ab = rhat[:, ka] + rhat[:, kb]
+    ikvarying_ab = np.sum(-rhat_ab * np.log(rhat_ab + 1e-200), axis=0)
+
+    gain = kvarying_ab - kvarying[ka] - kvarying[kb] + \
+        ikvarying_ab - ikvarying[ka] - ikvarying[kb]
+    ELBO = constant_ELBO(K, suffStat, vbParam, param) + kvarying.sum() + \
+        ikvarying.sum()
+
+    return gain, ELBO
+
+
+def apply_merges(vbParam, suffStat, param, L, ka, kb):
+    """
+        Merge clusters ka[i] and kb[i], for every i (all distinct). Merged
+        clusters are appended after the remaining ones, as in check_merge
+    """
+    K = vbParam.rhat.shape[1]
+    keep = np.ones(K, 'bool')
+    keep[ka] = False
+    keep[kb] = False
+
+    vbParamTemp = vbPar(np.concatenate(
+        (vbParam.rhat[:, keep], vbParam.rhat[:, ka] + vbParam.rhat[:, kb]),
+        axis=1))
+    suffStatTemp = suffStatistics()
+    suffStatTemp.Nhat = np.append(suffStat.Nhat[keep],
+                                  suffStat.Nhat[ka] + suffStat.Nhat[kb])
+    suffStatTemp.sumY = np.concatenate(
+        (suffStat.sumY[:, keep], suffStat.sumY[:, ka] + suffStat.sumY[:, kb]),
+        axis=1)
+    for name in ['sumYSq', 'sumYSq1', 'sumYSq2']:
+        stat = getattr(suffStat, name)
+        setattr(suffStatTemp, name, np.concatenate(
+            (stat[:, :, keep], stat[:, :, ka] + stat[:, :, kb]), axis=2))
+
+    vbParamTemp.update_global(suffStatTemp, param)
+
+    L = np.concatenate((L[keep], np.minimum(L[ka], L[kb])), axis=0)
+    if L.size == 1:
+        L = np.asarray([1])
+
+    return vbParamTemp, suffStatTemp, L
+
+
 def check_merge(maskedData, vbParam, suffStat, ka, kb, param, L, ELBO):
     K = vbParam.rhat.shape[1]
     no_kab = np.ones(K).astype(bool)
@@ -10,7 +10,8 @@ class Denoise(nn.Module):
     def __init__(self, n_filters, filter_sizes, spike_size, CONFIG):
         
         #os.environ["CUDA_VISIBLE_DEVICES"] = str(CONFIG.resources.gpu_id)
-        torch.cuda.set_device(CONFIG.resources.gpu_id)
+        if torch.cuda.is_available():
+            torch.cuda.set_device(CONFIG.resources.gpu_id)
         self.CONFIG = CONFIG
 
         super(Denoise, self).__init__()
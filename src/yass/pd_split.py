@@ -1,7 +1,6 @@
 import logging
 import os
 import numpy as np
-import torch
 from tqdm import tqdm
 
 from sklearn.decomposition import PCA
@@ -11,8 +10,9 @@ from diptest import diptest as dp
 import yass
 from yass import read_config
 from yass.reader import READER
-from yass.residual.residual_gpu import RESIDUAL_GPU2
+from yass.arena import SpikeTrainIndex
 from yass.deconvolve.utils import shift_svd_denoise
+from yass.template_update import iter_cleaned_min_max_vals
 from yass import postprocess
 
 def run_post_deconv_split(output_directory,
@@ -54,31 +54,29 @@ def run_post_deconv_split(output_directory,
     shifts = np.load(fname_shifts)
     scales = np.load(fname_scales)
 
+    # spikes outside of the batches of the residual are dropped
+    idx_in = np.logical_and(
+        spike_train[:, 0] > reader_residual.idx_list[0, 0],
+        spike_train[:, 0] <= reader_residual.idx_list[-1, 1])
+    spike_train = spike_train[idx_in]
+    shifts = shifts[idx_in]
+    scales = scales[idx_in]
+
     # get cleaned ptp
     fname_cleaned_ptp = os.path.join(output_directory, 'cleaned_ptp.npy')
-    fname_spike_times = os.path.join(output_directory, 'spike_times.npy')
-    fname_shifts = os.path.join(output_directory, 'shifts_list.npy')
-    fname_scales = os.path.join(output_directory, 'scales_list.npy')
     fname_vis_chans = os.path.join(output_directory, 'vis_chans.npy')
-    if os.path.exists(fname_cleaned_ptp) and os.path.exists(fname_spike_times):
-        
-        cleaned_ptp = np.load(fname_cleaned_ptp, allow_pickle=True)
-        spike_times_list = np.load(fname_spike_times, allow_pickle=True)
-        shifts_list = np.load(fname_shifts, allow_pickle=True)
-        scales_list = np.load(fname_scales, allow_pickle=True)
+    if os.path.exists(fname_cleaned_ptp) and os.path.exists(fname_vis_chans):
+
+        cleaned_ptp = np.load(fname_cleaned_ptp)
         vis_chans = np.load(fname_vis_chans, allow_pickle=True)
     else:
         print('get cleaned ptp')
-        (cleaned_ptp, spike_times_list,
-         shifts_list, scales_list, vis_chans) = get_cleaned_ptp(
+        cleaned_ptp, vis_chans = get_cleaned_ptp(
             templates, spike_train, shifts, scales,
             reader_residual, fname_templates, CONFIG)
 
-        np.save(fname_shifts, shifts_list, allow_pickle=True)
-        np.save(fname_scales, scales_list, allow_pickle=True)
         np.save(fname_vis_chans, vis_chans, allow_pickle=True)
-        np.save(fname_cleaned_ptp, cleaned_ptp, allow_pickle=True)
-        np.save(fname_spike_times, spike_times_list, allow_pickle=True)
+        np.save(fname_cleaned_ptp, cleaned_ptp)
 
     # split units
     fname_templates_updated = os.path.join(
@@ -105,9 +103,8 @@ def run_post_deconv_split(output_directory,
             min_fraction_accept = 0.15
         (templates_updated, spike_train_updated,
          shifts_updated, scales_updated) = run_split(
-            cleaned_ptp, spike_times_list,
-            shifts_list, scales_list, vis_chans,
-            templates, spike_train, reader_raw,
+            cleaned_ptp, vis_chans,
+            templates, spike_train, shifts, scales, reader_raw,
             CONFIG,
             update_original_templates=update_original_templates,
             min_ptp_accept=min_ptp_accept,
@@ -184,146 +181,31 @@ def run_post_deconv_split(output_directory,
 
 def get_cleaned_ptp(templates, spike_train, shifts, scales,
                     reader_residual, fname_templates, CONFIG):
-
+    '''
+    ptp of every cleaned spike (residual + shifted and scaled template) on
+    every channel, measured within 2 samples of the min/max locations of
+    its template. spikes of each batch are found by binary search and
+    their ptps are written into one (n_spikes, n_channels) array, in a
+    single pass over the residual (see iter_cleaned_min_max_vals).
+
+    returns the ptps (rows in spike_train order) and the visible channels
+    of every unit
+    '''
     n_units, n_times, n_channels = templates.shape
 
     ptp = templates.ptp(1)
-    ptp_max = ptp.max(1)
     vis_chans = [None]*n_units
     for k in range(n_units):
         vis_chans[k] = np.where(ptp[k] > 0)[0]
 
-    min_max_loc = np.stack((templates.argmin(1),
-                            templates.argmax(1))).transpose(1, 0, 2)
-    min_max_loc[min_max_loc < 2] = 2
-    min_max_loc[min_max_loc > n_times -3] = n_times - 3
-
-    # move to gpu
-    templates = torch.from_numpy(templates).float().cuda()
-    spike_train = torch.from_numpy(spike_train).long().cuda()
-    shifts = torch.from_numpy(shifts).float().cuda()
-    scales = torch.from_numpy(scales).float().cuda()
-    min_max_loc = torch.from_numpy(min_max_loc).long().cuda()
-    
-    residual_comp = RESIDUAL_GPU2(
-        None, CONFIG, None, None, None,
-        None, None, None, None, None, True)
-    residual_comp.load_templates(fname_templates)
-    residual_comp.make_bsplines_parallel()
-    
-    cleaned_ptp = [None]*n_units
-    spike_times_list = [None]*n_units
-    shifts_list = [None]*n_units
-    scales_list = [None]*n_units
-    for batch_id in tqdm(range(reader_residual.n_batches)):
-        t_start, t_end = reader_residual.idx_list[batch_id]
-        batch_offset = int(t_start - reader_residual.buffer)
-        idx_in = torch.nonzero((spike_train[:, 0] > t_start)&(spike_train[:, 0] <= t_end))[:, 0]
-
-        spike_times_batch = spike_train[idx_in, 0]
-        spike_times_batch -= batch_offset
-        neuron_ids_batch = spike_train[idx_in, 1]
-
-        shifts_batch = shifts[idx_in]
-        scales_batch = scales[idx_in]
-
-        # get residual batch
-        residual = reader_residual.read_data_batch(batch_id, add_buffer=True)
-        residual = torch.from_numpy(residual).cuda()
-
-        # get min/max values
-        # due to memory constraint, find the values 10,000 spikes at a time
-        max_spikes = 5000
-        counter = torch.cat((torch.arange(0, len(spike_times_batch), max_spikes),
-                             torch.tensor([len(spike_times_batch)]))).cuda()
-
-        # get the values near template min/max locations for each channel
-        # min_max_vals_spikes: # spikes x 2 (min/max) x # channels x 5 (-2 to 2 of argmin/argmax)
-        # this will get min/max values of cleaned spikes.
-        # it will first get residual values and then add templates
-        #min_max_vals_spikes = torch.cuda.FloatTensor(len(spike_times_batch), 2, n_channels).fill_(0)
-        #for j in range(len(counter)-1):
-        #    ii_start = counter[j]
-        #    ii_end = counter[j+1]
-
-        #    min_max_loc_spikes = (min_max_loc[neuron_ids_batch[ii_start:ii_end]] + 
-        #                          spike_times_batch[ii_start:ii_end, None, None] - n_times//2)
-        #    min_max_vals_spikes[ii_start:ii_end] = torch.gather(
-        #        residual, 0, min_max_loc_spikes.reshape(-1, n_channels)).reshape(
-        #        -1, 2, n_channels)
-
-        #    shifted_templates = residual_comp.get_shifted_templates(
-        #            neuron_ids_batch[ii_start:ii_end], 
-        #            shifts_batch[ii_start:ii_end], 
-        #            scales_batch[ii_start:ii_end])
-        #    min_max_vals_spikes[ii_start:ii_end] += torch.gather(
-        #        shifted_templates, 1, min_max_loc[neuron_ids_batch[ii_start:ii_end]])
-        #ptp_batch = min_max_vals_spikes[:,1] - min_max_vals_spikes[:,0]
-        min_max_vals_spikes = torch.cuda.FloatTensor(len(spike_times_batch), 2, 5, n_channels).fill_(0)
-        for j in range(len(counter)-1):
-            ii_start = counter[j]
-            ii_end = counter[j+1]
-
-            min_max_loc_spikes = (min_max_loc[neuron_ids_batch[ii_start:ii_end]] + 
-                                  spike_times_batch[ii_start:ii_end, None, None] - n_times//2)
-            min_max_loc_spikes = min_max_loc_spikes[:, :, None] + torch.arange(-2, 3).cuda()[None, None, :, None]
-            min_max_vals_spikes[ii_start:ii_end] = torch.gather(
-                residual, 0, min_max_loc_spikes.reshape(-1, n_channels)).reshape(
-                -1, 2, 5, n_channels)
-
-            shifted_templates = residual_comp.get_shifted_templates(
-                    neuron_ids_batch[ii_start:ii_end], 
-                    shifts_batch[ii_start:ii_end], 
-                    scales_batch[ii_start:ii_end])
-            min_max_loc_spikes = min_max_loc[
-                neuron_ids_batch[ii_start:ii_end]][
-                :, :, None] + torch.arange(-2, 3).cuda()[None, None, :, None]
-            min_max_vals_spikes[ii_start:ii_end] += torch.gather(
-                shifted_templates,
-                1,
-                min_max_loc_spikes.reshape(-1, 10, n_channels)
-            ).reshape(-1, 2, 5, n_channels)
-        ptp_batch = torch.max(min_max_vals_spikes[:,1], 1)[0] - torch.min(min_max_vals_spikes[:,0], 1)[0]
-
-        del min_max_loc_spikes
-        del min_max_vals_spikes
-        del shifted_templates
-        del residual
-        torch.cuda.empty_cache()
-
-        for k in range(n_units):
-            idx_ = neuron_ids_batch == k
-            if cleaned_ptp[k] is not None:
-                cleaned_ptp[k] = np.concatenate(
-                    (cleaned_ptp[k], ptp_batch[idx_].cpu().numpy()[:, vis_chans[k]]),
-                    axis = 0)
-                spike_times_list[k] = np.hstack((spike_times_list[k],
-                                                 spike_times_batch[idx_].cpu().numpy() + batch_offset))
-                shifts_list[k] = np.hstack((shifts_list[k],
-                                            shifts_batch[idx_].cpu().numpy()))
-                scales_list[k] = np.hstack((scales_list[k],
-                                            scales_batch[idx_].cpu().numpy()))
-            else:
-                cleaned_ptp[k] = ptp_batch[idx_].cpu().numpy()[:, vis_chans[k]]
-                spike_times_list[k] = spike_times_batch[idx_].cpu().numpy() + batch_offset
-                shifts_list[k] = shifts_batch[idx_].cpu().numpy()
-                scales_list[k] = scales_batch[idx_].cpu().numpy()
-
-        del ptp_batch
-        del spike_times_batch
-        del shifts_batch
-        del scales_batch
-        torch.cuda.empty_cache()
-
-    del templates
-    del spike_train
-    del shifts
-    del scales
-    del min_max_loc
-    del residual_comp
-    torch.cuda.empty_cache()
-
-    return cleaned_ptp, spike_times_list, shifts_list, scales_list, vis_chans
+    cleaned_ptp = np.zeros((len(spike_train), n_channels), 'float32')
+    for idx, min_max_vals_spikes in iter_cleaned_min_max_vals(
+            templates, spike_train, shifts, scales,
+            reader_residual, fname_templates, CONFIG):
+        cleaned_ptp[idx] = (min_max_vals_spikes[:, 1].max(1) -
+                            min_max_vals_spikes[:, 0].min(1))
+
+    return cleaned_ptp, vis_chans
 
 
 def pca_gmm_and_dip(data, min_data):
@@ -355,9 +237,8 @@ def pca_gmm_and_dip(data, min_data):
     return label, p_val
 
 
-def run_split(cleaned_ptp, spike_times_list,
-              shifts_list, scales_list, vis_chans,
-              templates, spike_train, reader_raw, CONFIG,
+def run_split(cleaned_ptp, vis_chans,
+              templates, spike_train, shifts, scales, reader_raw, CONFIG,
               update_original_templates=False,
               min_ptp_split=5, min_fr_split=1,
               min_ptp_accept=1000, min_fr_accept=1,
@@ -376,30 +257,24 @@ def run_split(cleaned_ptp, spike_times_list,
     max_k_mc = templates[max_k].ptp(0).argmax()
     max_chan_min_loc = templates[max_k, :, max_k_mc].argmin()
 
-    new_temps = np.zeros((0, n_times, n_channels), 'float32')
-    new_spts = []
-    new_shifts = []
-    new_scales = []
-    for k in tqdm(range(len(cleaned_ptp))):
+    # unit of every spike after the split; -1 for dropped spikes
+    spike_index = SpikeTrainIndex(spike_train, n_units)
+    labels_updated = np.copy(spike_train[:, 1])
 
-        spt_ = spike_times_list[k]
+    new_temps = np.zeros((0, n_times, n_channels), 'float32')
+    for k in tqdm(range(n_units)):
 
-        if (ptp_max[k] > min_ptp_split) and (len(spt_) > len_rec*min_fr_split):
+        rows = spike_index.unit_rows(k)
 
-            shifts_ = shifts_list[k]
-            scales_ = scales_list[k]
+        if (ptp_max[k] > min_ptp_split) and (len(rows) > len_rec*min_fr_split):
 
-            idx_sort = np.argsort(spt_)
-            cleaned_ptp_unit = cleaned_ptp[k][idx_sort]
-            spt_ = spt_[idx_sort]
-            shifts_ = shifts_[idx_sort]
-            scales_ = scales_[idx_sort]
+            rows = rows[np.argsort(spike_train[rows, 0], kind='stable')]
+            spt_ = spike_train[rows, 0]
 
             isi_ = np.diff(np.hstack((-1000, spt_)))
-            cleaned_ptp_unit = cleaned_ptp_unit[isi_ > 300]
+            rows = rows[isi_ > 300]
             spt_ = spt_[isi_ > 300]
-            shifts_ = shifts_[isi_ > 300]
-            scales_ = scales_[isi_ > 300]
+            cleaned_ptp_unit = cleaned_ptp[np.ix_(rows, vis_chans[k])]
             #std_ = np.std(cleaned_ptp_unit, 0)
 
             #if std_.max() > 1.2:
@@ -420,7 +295,6 @@ def run_split(cleaned_ptp, spike_times_list,
 
                 mcs = new_temps_k.ptp(1).argmax(1)
                 for ii in range(len(unique_label)):
-                    max_chan_min_loc
                     min_loc_k = new_temps_k[ii, :, mcs[ii]].argmin()
                     if  min_loc_k != max_chan_min_loc:
                         spt_temp = spt_[label == unique_label[ii]]
@@ -447,15 +321,15 @@ def run_split(cleaned_ptp, spike_times_list,
                 split_unit_closest = unique_label[np.sum(np.square(
                     split_units_ptp - original_unit_ptp), 1).argmin()]
 
-                # add spike times
+                # only spikes of the kept split units stay; the closest one
+                # keeps the unit id and the others become new units
+                labels_updated[spike_index.unit_rows(k)] = -1
+                labels_updated[rows[label == split_unit_closest]] = k
                 for ii in unique_label[unique_label != split_unit_closest]:
-                    new_spts.append(spt_[label == ii])
-                    new_shifts.append(shifts_[label == ii])
-                    new_scales.append(scales_[label == ii])
-
-                # save all units other than the closest on as new templates
-                new_temps = np.concatenate(
-                    (new_temps, new_temps_k[unique_label != split_unit_closest]), axis=0)
+                    labels_updated[rows[label == ii]] = (
+                        n_units + new_temps.shape[0])
+                    new_temps = np.concatenate(
+                        (new_temps, new_temps_k[unique_label == ii]), axis=0)
 
                 # if the split unit closest to the orignal has enough spikes,
                 # the new template replaces the original one
@@ -463,38 +337,15 @@ def run_split(cleaned_ptp, spike_times_list,
                 if update_original_templates:
                     templates[k] = new_temps_k[unique_label == split_unit_closest][0]
 
-                spike_times_list[k] = spt_[label == split_unit_closest]
-                shifts_list[k] = shifts_[label == split_unit_closest]
-                scales_list[k] = scales_[label == split_unit_closest]
-
-
     # updated templates
     templates_updated = np.concatenate((templates, new_temps), 0).astype('float32')
 
-    # updated spike train of original units
-    spike_train_updated = np.zeros((0, 2), 'int32')
-    shifts_updated = np.zeros(0, 'float32')
-    scales_updated = np.zeros(0, 'float32')
-    for k in range(n_units):
-        spike_train_temp = np.vstack(
-            (spike_times_list[k], k*np.ones(len(spike_times_list[k]), 'int32'))).T
-        spike_train_updated = np.concatenate(
-            (spike_train_updated, spike_train_temp), axis=0)
-        shifts_updated = np.hstack((shifts_updated, shifts_list[k]))
-        scales_updated = np.hstack((scales_updated, scales_list[k]))
-
-    # add new spike train
-    spike_train_new = np.zeros((0, 2), 'int32')
-    shifts_new = np.zeros(0, 'float32')
-    scales_new = np.zeros(0, 'float32')
-    for k in range(new_temps.shape[0]):
-        spike_train_temp = np.vstack((new_spts[k], k*np.ones(len(new_spts[k]), 'int32'))).T
-        spike_train_new = np.concatenate((spike_train_new, spike_train_temp), axis=0)
-        shifts_new = np.hstack((shifts_new, new_shifts[k]))
-        scales_new = np.hstack((scales_new, new_scales[k]))
-    spike_train_new[:, 1] += n_units
-    spike_train_updated = np.concatenate((spike_train_updated, spike_train_new), axis=0)
-    shifts_updated = np.concatenate((shifts_updated, shifts_new), axis=0)
-    scales_updated = np.concatenate((scales_updated, scales_new), axis=0)
-        
+    # updated spike train, original units first and then the new ones
+    idx_keep = np.where(labels_updated >= 0)[0]
+    idx_keep = idx_keep[np.argsort(labels_updated[idx_keep], kind='stable')]
+    spike_train_updated = np.vstack((spike_train[idx_keep, 0],
+                                     labels_updated[idx_keep])).T
+    shifts_updated = shifts[idx_keep]
+    scales_updated = scales[idx_keep]
+
     return templates_updated, spike_train_updated, shifts_updated, scales_updated
@@ -16,6 +16,7 @@ from yass.postprocess.duplicate_l2 import duplicate_l2
 from yass.postprocess.xcorr_peaks import remove_high_xcorr_peaks
 from yass.postprocess.duplicate_soft_assignment import duplicate_soft_assignment
 from yass.postprocess.util import get_weights
+from yass.spike_train import compact_spike_train
 
 def run(methods = [],
         output_directory=None,
@@ -103,28 +104,18 @@ def run(methods = [],
         # update templates
         templates = templates[units_survived]
 
-        # update spike train
-        spike_train_new = np.copy(spike_train)
-        idx_keep = np.in1d(spike_train[:,1], units_survived)
-        spike_train_new = spike_train_new[idx_keep]
-        dics = {unit: ii for ii, unit in enumerate(units_survived)}
-        for j in range(spike_train_new.shape[0]):
-            spike_train_new[j,1] = dics[spike_train_new[j,1]]
-
-        if fname_noise_soft_assignment is not None:
-            noise_soft_assignment = np.load(fname_noise_soft_assignment)
-            noise_soft_assignment = noise_soft_assignment[idx_keep]
-            np.save(fname_noise_soft_assignment_out, noise_soft_assignment)
-
-        if fname_scales is not None:
-            scales = np.load(fname_scales)
-            scales = scales[idx_keep]
-            np.save(fname_scales_out, scales)
-            
-        if fname_shifts is not None:
-            shifts = np.load(fname_shifts)
-            shifts = shifts[idx_keep]
-            np.save(fname_shifts_out, shifts)
+        # update spike train and per spike arrays
+        fnames_in = [fname_noise_soft_assignment, fname_scales, fname_shifts]
+        fnames_out = [fname_noise_soft_assignment_out, fname_scales_out,
+                      fname_shifts_out]
+        arrays = [None if fname is None else np.load(fname)
+                  for fname in fnames_in]
+        spike_train_new, *arrays = compact_spike_train(
+            spike_train, units_survived, *arrays)
+
+        for fname, array in zip(fnames_out, arrays):
+            if array is not None:
+                np.save(fname, array)
 
     else:
         spike_train_new = np.copy(spike_train)
@@ -3,6 +3,8 @@ import os
 import scipy
 import datetime as dt
 
+from yass.spike_train import soft_counts
+
 def get_weights(out_dir, fname_templates, fname_spike_train,
                 fname_soft_assignment=None):
     '''
@@ -17,16 +19,13 @@ def get_weights(out_dir, fname_templates, fname_spike_train,
     n_units = templates.shape[0]
 
     # compute weights
-    weights = np.zeros(n_units, 'float32')
     if fname_soft_assignment is None:
-        unique_ids, unique_weights = np.unique(spike_train[:, 1],
-                                               return_counts=True)
-        weights[unique_ids] = unique_weights
+        soft_assignment = None
     else:
         soft_assignment = np.load(fname_soft_assignment)
-        for j in range(spike_train.shape[0]):
-            weights[spike_train[j, 1]] += soft_assignment[j]
-    
+    weights = soft_counts(spike_train[:, 1], soft_assignment,
+                          n_units).astype('float32')
+
     # save
     fname_weights = os.path.join(out_dir, 'weights.npy')
     np.save(fname_weights, weights)
@@ -49,6 +49,10 @@ def run(output_directory):
     * ``standardized.yaml`` - Standarized recordings metadata
     * ``whitening.npy`` - Whitening filter
 
+    If ``CONFIG.preprocess.streaming`` is set, every batch is written
+    directly into ``standardized.bin`` at its offset, otherwise batches are
+    saved under ``filtered_files/`` and merged at the end.
+
     Everything is run on CPU.
 
     Examples
@@ -105,6 +109,7 @@ def run(output_directory):
     low_frequency = CONFIG.preprocess.filter.low_pass_freq
     high_factor = CONFIG.preprocess.filter.high_factor
     order = CONFIG.preprocess.filter.order
+    n_threads = CONFIG.preprocess.filter.n_threads
     sampling_rate = CONFIG.recordings.sampling_rate
 
     # estimate std from a small chunk
@@ -120,10 +125,21 @@ def run(output_directory):
     if not os.path.exists(fname_mean_sd):
         get_std(small_batch, sampling_rate,
                 fname_mean_sd, CONFIG.preprocess.apply_filter,
-                low_frequency, high_factor, order)
+                low_frequency, high_factor, order, n_threads)
     # turn it off
     small_batch = None
 
+    if CONFIG.preprocess.streaming:
+        _run_streaming(reader, fname_mean_sd, standardized_path, CONFIG)
+
+        # save yaml file with params
+        path_to_yaml = standardized_path.replace('.bin', '.yaml')
+        with open(path_to_yaml, 'w') as f:
+            logger.info('Saving params...')
+            yaml.dump(standardized_params, f)
+
+        return standardized_path, standardized_params['dtype']
+
     # Make directory to hold filtered batch files:
     filtered_location = os.path.join(output_directory, "filtered_files")
     if not os.path.exists(filtered_location):
@@ -145,6 +161,7 @@ def run(output_directory):
             high_factor,
             order,
             sampling_rate,
+            n_threads,
             processes=n_processors,
             pm_pbar=True)
     else:
@@ -158,6 +175,7 @@ def run(output_directory):
                 high_factor,
                 order,
                 sampling_rate,
+                n_threads,
                 )
 
     # Merge the chunk filtered files and delete the individual chunks
@@ -170,3 +188,42 @@ def run(output_directory):
         yaml.dump(standardized_params, f)
 
     return standardized_path, standardized_params['dtype']
+
+
+def _run_streaming(reader, fname_mean_sd, standardized_path, CONFIG):
+    """Filter and standardize every batch and write it straight into a
+    preallocated standardized.bin, skipping the per batch files
+    """
+    logger = logging.getLogger(__name__)
+
+    # write to a temporary name so that an interrupted run is not mistaken
+    # for a finished one
+    fname_tmp = standardized_path + '.tmp'
+    logger.info('...saving standardized file: %s', standardized_path)
+    allocate_standardized_file(fname_tmp, reader.end - reader.start,
+                               CONFIG.recordings.n_channels,
+                               CONFIG.preprocess.dtype)
+
+    args = (reader,
+            fname_mean_sd,
+            CONFIG.preprocess.apply_filter,
+            CONFIG.preprocess.dtype,
+            fname_tmp,
+            CONFIG.preprocess.filter.low_pass_freq,
+            CONFIG.preprocess.filter.high_factor,
+            CONFIG.preprocess.filter.order,
+            CONFIG.recordings.sampling_rate,
+            CONFIG.preprocess.filter.n_threads)
+
+    if CONFIG.resources.multi_processing:
+        parmap.map(
+            filter_standardize_batch_streaming,
+            [i for i in range(reader.n_batches)],
+            *args,
+            processes=CONFIG.resources.n_processors,
+            pm_pbar=True)
+    else:
+        for batch_id in range(reader.n_batches):
+            filter_standardize_batch_streaming(batch_id, *args)
+
+    os.rename(fname_tmp, standardized_path)
@@ -5,16 +5,61 @@ import logging
 import os
 import numpy as np
 
-from scipy.signal import butter, filtfilt
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
+from scipy.signal import butter, sosfilt, sosfiltfilt
 
-def _butterworth(ts, low_frequency, high_factor, order, sampling_frequency):
-    """Butterworth filter
+
+@lru_cache(maxsize=None)
+def butterworth_sos(order, low_frequency, high_factor, sampling_frequency,
+                    btype='high'):
+    """Design a butterworth filter as second-order sections, the result is
+    cached so every batch (and every caller) reuses the same coefficients
+
+    Parameters
+    ----------
+    order: int
+        Order of Butterworth filter
+    low_frequency: int
+        Low pass frequency (Hz)
+    high_factor: float
+        High pass factor (proportion of sampling rate), only used if
+        btype is 'band'
+    sampling_frequency: int
+        Sampling frequency (Hz)
+    btype: str
+        'high' or 'band'
+
+    Returns
+    -------
+    numpy.ndarray
+        (n_sections, 6) second-order sections
+    """
+    low = float(low_frequency) / sampling_frequency * 2
+    high = float(high_factor) * 2
+
+    if btype == 'high':
+        Wn = low
+    elif btype == 'band':
+        Wn = [low, high]
+    else:
+        raise ValueError('btype must be "high" or "band", got {}'
+                         .format(btype))
+
+    return butter(order, Wn, btype=btype, analog=False, output='sos')
+
+
+def butterworth_filter(ts, low_frequency, high_factor, order,
+                       sampling_frequency, btype='high', zero_phase=True,
+                       n_threads=1, inplace=False):
+    """Butterworth filter applied along time to all channels at once
 
     Parameters
     ----------
     ts: np.array
-        T  numpy array, where T is the number of time samples
+        T or T x C numpy array, where T is the number of time samples and
+        C is the number of channels
     low_frequency: int
         Low pass frequency (Hz)
     high_factor: float
@@ -23,31 +68,82 @@ def _butterworth(ts, low_frequency, high_factor, order, sampling_frequency):
         Order of Butterworth filter
     sampling_frequency: int
         Sampling frequency (Hz)
+    btype: str
+        'high' or 'band'
+    zero_phase: bool
+        If True, filter forward and backward (sosfiltfilt), otherwise
+        apply a causal filter (sosfilt)
+    n_threads: int
+        Number of threads, channels are split in blocks across threads.
+        scipy releases the GIL while filtering so threads run in parallel
+    inplace: bool
+        Write the result into ts, only possible if ts is a writable
+        float32 array
 
-    Notes
-    -----
-    This function can only be applied to a one dimensional array, to apply
-    it to multiple channels use butterworth
-
-    Raises
-    ------
-    NotImplementedError
-        If a multidmensional array is passed
+    Returns
+    -------
+    np.array
+        float32 array of the same shape as ts
     """
-
-    low = float(low_frequency) / sampling_frequency * 2
-    high = float(high_factor) * 2
-    b, a = butter(order, low, btype='high', analog=False)
+    sos = butterworth_sos(order, low_frequency, high_factor,
+                          sampling_frequency, btype)
+    fn = sosfiltfilt if zero_phase else sosfilt
 
     if ts.ndim == 1:
-        return filtfilt(b, a, ts)
+        return fn(sos, ts, axis=0).astype('float32')
+
+    if (inplace and ts.dtype == np.float32 and ts.flags.writeable):
+        output = ts
+    else:
+        output = np.empty(ts.shape, 'float32')
+
+    C = ts.shape[1]
+    n_threads = max(min(int(n_threads), C), 1)
+    blocks = np.array_split(np.arange(C), n_threads)
+
+    def filter_block(block):
+        channels = slice(block[0], block[-1] + 1)
+        output[:, channels] = fn(sos, ts[:, channels], axis=0)
+
+    if n_threads == 1:
+        filter_block(blocks[0])
     else:
-        T, C = ts.shape
-        output = np.zeros((T, C), 'float32')
-        for c in range(C):
-            output[:, c] = filtfilt(b, a, ts[:, c])
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(filter_block, blocks))
+
+    return output
 
-        return output
+
+def _butterworth(ts, low_frequency, high_factor, order, sampling_frequency,
+                 n_threads=1, inplace=False):
+    """Butterworth filter
+
+    Parameters
+    ----------
+    ts: np.array
+        T or T x C numpy array, where T is the number of time samples and
+        C is the number of channels
+    low_frequency: int
+        Low pass frequency (Hz)
+    high_factor: float
+        High pass factor (proportion of sampling rate)
+    order: int
+        Order of Butterworth filter
+    sampling_frequency: int
+        Sampling frequency (Hz)
+    n_threads: int
+        Number of threads used to filter channels
+    inplace: bool
+        Filter ts in place if it is a writable float32 array
+
+    Notes
+    -----
+    This is a zero-phase high pass filter, see butterworth_filter
+    """
+    return butterworth_filter(ts, low_frequency, high_factor, order,
+                              sampling_frequency, btype='high',
+                              zero_phase=True, n_threads=n_threads,
+                              inplace=inplace)
 
 
 def _mean_standard_deviation(rec, centered=False):
@@ -116,7 +212,8 @@ def _standardize(rec, sd=None, centers=None):
 def filter_standardize_batch(batch_id, reader, fname_mean_sd,
                              apply_filter, out_dtype, output_directory,
                              low_frequency=None, high_factor=None,
-                             order=None, sampling_frequency=None):
+                             order=None, sampling_frequency=None,
+                             n_threads=1):
     """Butterworth filter for a one dimensional time series
 
     Parameters
@@ -142,15 +239,78 @@ def filter_standardize_batch(batch_id, reader, fname_mean_sd,
     NotImplementedError
         If a multidmensional array is passed
     """
-    logger = logging.getLogger(__name__)
+    ts = _filter_standardize_data(batch_id, reader, fname_mean_sd,
+                                  apply_filter, low_frequency, high_factor,
+                                  order, sampling_frequency, n_threads)
 
-    
+    # save
+    fname = os.path.join(
+        output_directory,
+        "standardized_{}.npy".format(
+            str(batch_id).zfill(6)))
+    np.save(fname, ts.astype(out_dtype))
+
+    #fname = os.path.join(
+    #    output_directory,
+    #    "standardized_{}.bin".format(
+    #        str(batch_id).zfill(6)))
+    #f = open(fname, 'wb')
+    #f.write(ts.astype(out_dtype))
+
+
+def filter_standardize_batch_streaming(batch_id, reader, fname_mean_sd,
+                                       apply_filter, out_dtype, fname_out,
+                                       low_frequency=None, high_factor=None,
+                                       order=None, sampling_frequency=None,
+                                       n_threads=1):
+    """Filter and standardize a batch and write it in place into the
+    preallocated output binary file (see allocate_standardized_file)
+
+    Parameters
+    ----------
+    batch_id: int
+        Batch index in reader.idx_list
+    reader: yass.reader.READER
+        Reader for the raw recording
+    fname_mean_sd: str
+        npz file with the centers and sd used for standardization
+    apply_filter: bool
+        Whether to apply the butterworth filter
+    out_dtype: str
+        Output dtype
+    fname_out: str
+        Preallocated binary file, the batch is written at the rows
+        corresponding to its position in the recording
+    n_threads: int
+        Number of threads used by the filter
+    """
+    ts = _filter_standardize_data(batch_id, reader, fname_mean_sd,
+                                  apply_filter, low_frequency, high_factor,
+                                  order, sampling_frequency, n_threads)
+
+    # every batch owns a disjoint block of rows, so workers can write
+    # concurrently without locking
+    row_start = int(reader.idx_list[batch_id][0] - reader.start)
+    out = np.memmap(fname_out, dtype=out_dtype, mode='r+',
+                    offset=row_start*ts.shape[1]*np.dtype(out_dtype).itemsize,
+                    shape=ts.shape)
+    out[:] = ts
+    out.flush()
+    del out
+
+
+def _filter_standardize_data(batch_id, reader, fname_mean_sd, apply_filter,
+                             low_frequency, high_factor, order,
+                             sampling_frequency, n_threads=1):
+    """Read a batch, (optionally) filter it and standardize it
+    """
     # filter
     if apply_filter:
         # read a batch
         ts = reader.read_data_batch(batch_id, add_buffer=True)
         ts = _butterworth(ts, low_frequency, high_factor,
-                              order, sampling_frequency)
+                          order, sampling_frequency, n_threads,
+                          inplace=True)
         ts = ts[reader.buffer:-reader.buffer]
     else:
         ts = reader.read_data_batch(batch_id, add_buffer=False)
@@ -159,22 +319,16 @@ def filter_standardize_batch(batch_id, reader, fname_mean_sd,
     temp = np.load(fname_mean_sd)
     sd = temp['sd']
     centers = temp['centers']
-    ts = _standardize(ts, sd, centers)
-    
-    # save
-    fname = os.path.join(
-        output_directory,
-        "standardized_{}.npy".format(
-            str(batch_id).zfill(6)))
-    np.save(fname, ts.astype(out_dtype))
 
-    #fname = os.path.join(
-    #    output_directory,
-    #    "standardized_{}.bin".format(
-    #        str(batch_id).zfill(6)))
-    #f = open(fname, 'wb')
-    #f.write(ts.astype(out_dtype))
+    return _standardize(ts, sd, centers)
+
 
+def allocate_standardized_file(fname, n_observations, n_channels, dtype):
+    """Create the output binary file at its final size so that batches can
+    be written directly at their offsets
+    """
+    with open(fname, 'wb') as f:
+        f.truncate(int(n_observations)*n_channels*np.dtype(dtype).itemsize)
 
 
 def get_std(ts,
@@ -183,7 +337,8 @@ def get_std(ts,
             apply_filter=False, 
             low_frequency=None,
             high_factor=None,
-            order=None):
+            order=None,
+            n_threads=1):
     """Butterworth filter for a one dimensional time series
 
     Parameters
@@ -213,7 +368,7 @@ def get_std(ts,
     # filter
     if apply_filter:
         ts = _butterworth(ts, low_frequency, high_factor,
-                          order, sampling_frequency)
+                          order, sampling_frequency, n_threads)
 
     # standardize
     sd, centers = _mean_standard_deviation(ts)
@@ -1,6 +1,37 @@
 import os
 import numpy as np
 
+
+# memory maps opened in this process, keyed by file identity so that every
+# READER pointing at the same recording shares one mapping
+_MMAPS = {}
+
+
+def get_memmap(bin_file, dtype, n_channels):
+    '''
+    return a read-only (n_times, n_channels) memory map of a binary
+    recording. the map is opened once per process and reused afterwards;
+    it is reopened if the file was replaced or its size changed
+    '''
+    stat = os.stat(bin_file)
+    key = (os.path.abspath(bin_file), np.dtype(dtype).str, n_channels)
+    identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    cached = _MMAPS.get(key)
+    if cached is not None and cached[0] == identity:
+        return cached[1]
+
+    rec_len = int(stat.st_size/np.dtype(dtype).itemsize/n_channels)
+    if rec_len == 0:
+        return np.zeros((0, n_channels), dtype)
+
+    mmap = np.memmap(bin_file, dtype=dtype, mode='r',
+                     shape=(rec_len, n_channels))
+    _MMAPS[key] = (identity, mmap)
+
+    return mmap
+
+
 class READER(object):
 
     def __init__(self, bin_file, dtype, CONFIG,
@@ -64,19 +95,22 @@ class READER(object):
         self.spike_size = CONFIG.spike_size
        
 
+    @property
+    def mmap(self):
+        '''read-only memory map of the whole recording
+        '''
+        return get_memmap(self.bin_file, self.dtype, self.n_channels)
+
     def read_data(self, data_start, data_end, channels=None):
-        with open(self.bin_file, "rb") as fin:
-            # Seek position and read N bytes
-            #fin.seek((data_start-self.offset)*self.dtype.itemsize*self.n_channels, os.SEEK_SET)
-            fin.seek(int((data_start-self.offset)*self.dtype.itemsize*self.n_channels), os.SEEK_SET)
-            data = np.fromfile(
-                fin, dtype=self.dtype,
-                count=int((data_end - data_start)*self.n_channels))
-        fin.close()
-        
-        data = data.reshape(-1, self.n_channels)
-        if channels is not None:
-            data = data[:, channels]
+
+        start = max(int(data_start - self.offset), 0)
+        end = max(int(data_end - self.offset), start)
+
+        # copy out of the memory map so that callers can modify the data
+        if channels is None:
+            data = np.array(self.mmap[start:end])
+        else:
+            data = self.mmap[start:end][:, channels]
 
         return data
 
@@ -178,37 +212,26 @@ class READER(object):
         if n_times % 2 == 0:
             n_times += 1
 
-        # exclude boundary spikes
-        # idx_keep = np.where(np.logical_and(spike_times>n_times//2, 
-                            # spike_times<(self.rec_len-n_times//2)))[0]
-        # spike_times=spike_times[idx_keep]
-
         # read all channels
         if channels is None:
             channels = np.arange(self.n_channels)
+        channels = np.asarray(channels)
 
-        # ***** LOAD RAW RECORDING *****
-        wfs = np.zeros((len(spike_times), n_times, len(channels)),
-                       'float32')
-
-        skipped_idx = []
-        total_size = n_times*self.n_channels
         # spike_times are the centers of waveforms
-        spike_times_shifted = spike_times - n_times//2
-        offsets = spike_times_shifted.astype('int64')*self.dtype.itemsize*self.n_channels
-        with open(self.bin_file, "rb") as fin:
-            for ctr, spike in enumerate(spike_times_shifted):
-                try:
-                    fin.seek(offsets[ctr], os.SEEK_SET)
-                    wf = np.fromfile(fin,
-                                     dtype=self.dtype,
-                                     count=total_size)
-                    wfs[ctr] = wf.reshape(
-                        n_times, self.n_channels)[:,channels]
-                except:
-                    skipped_idx.append(ctr)
-        wfs=np.delete(wfs, skipped_idx, axis=0)
-        fin.close()
+        spike_times_shifted = np.asarray(
+            spike_times).astype('int64') - n_times//2
+
+        # exclude boundary spikes
+        idx_keep = np.logical_and(spike_times_shifted >= 0,
+                                  spike_times_shifted + n_times <= self.rec_len)
+        skipped_idx = np.where(~idx_keep)[0]
+
+        # ***** LOAD RAW RECORDING *****
+        # gather all waveforms with one fancy index on the memory map
+        time_index = (spike_times_shifted[idx_keep][:, None] +
+                      np.arange(n_times))
+        wfs = self.mmap[time_index[:, :, None],
+                        channels[None, None]].astype('float32', copy=False)
 
         return wfs, skipped_idx
 
@@ -3,6 +3,8 @@ import logging
 import numpy as np
 import parmap
 
+from yass import arena
+
 class RESIDUAL(object):
     
     def __init__(self, 
@@ -44,6 +46,9 @@ class RESIDUAL(object):
                 os.path.join(save_dir,
                              'residual_seg{}.npy'.format(batch_id)))
 
+        # index the spike train by time once for all workers
+        arena.register_spike_train(self.fname_spike_train)
+
         #self.logger.info("computing residuals")
         if multi_processing:
             batches_in = np.array_split(batch_ids, n_processors)
@@ -75,8 +80,10 @@ class RESIDUAL(object):
             # load upsampled templates only once per core:
             if templates is None or spike_train is None:
                 #self.logger.info("loading upsampled templates")
-                templates = np.load(self.fname_templates)
-                spike_train = np.load(self.fname_spike_train)
+                templates = arena.attach(self.fname_templates)
+                spike_index = arena.SpikeTrainIndex.load(
+                    self.fname_spike_train)
+                spike_train = spike_index.spike_train
 
                 # do not read spike train again here
                 #self.spike_train = up_data['spike_train_up']
@@ -86,17 +93,16 @@ class RESIDUAL(object):
                 
                 # shift spike time so that it is aligned at
                 # time 0
-                spike_train[:, 0] -= n_time//2
+                time_offset = n_time//2
 
             # get relevantspike times
             start, end = self.reader.idx_list[batch_id]
             start -= self.reader.buffer 
-            idx_in_chunk = np.where(
-                np.logical_and(spike_train[:,0]>=start,
-                               spike_train[:,0]<end))[0]
-            spikes_in_chunk = spike_train[idx_in_chunk]
+            idx_in_chunk = spike_index.window_rows(start + time_offset,
+                                                   end + time_offset)
+            spikes_in_chunk = np.array(spike_train[idx_in_chunk])
             # offset
-            spikes_in_chunk[:,0] -=  start
+            spikes_in_chunk[:,0] -= start + time_offset
 
             #print ("SPIKE train: ", self.spike_train.shape)
             #print ("templates: ", self.templates.shape)
@@ -13,6 +13,7 @@ import networkx as nx
 from pkg_resources import resource_filename
 
 from yass import read_config
+from yass.arena import SpikeTrainIndex
 from yass.template import upsample_resample, shift_chans
 from yass.rf.sta_fit import get_fit_on_sta
 from yass.rf.util import get_rf, get_circle_plotting_data, classifiy_contours
@@ -162,7 +163,8 @@ class RF(object):
         n_pixels = stim_size[0]*stim_size[1]
 
         unique_ids = np.unique(self.sps[:,1])
-        
+        spike_index = SpikeTrainIndex(self.sps, Ncells)
+
         args_in = []
         for i_cell in np.arange(Ncells):
             fname = os.path.join(tmp_dir_sta, 'unit_'+str(i_cell)+'.mat')
@@ -173,7 +175,7 @@ class RF(object):
                 ##################################
 
                 # Get spike times of this cell in seconds
-                idx_ = np.where(self.sps[:,1]==i_cell)[0]
+                idx_ = spike_index.unit_rows(i_cell)
                 these_sps = self.sps[idx_, 0]
                 #spikes before 36000000 are white noise spikes, divide by frame rate to get seconds
                 these_sps = these_sps / float(self.sp_frame_rate)
@@ -2,12 +2,13 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
 import sklearn.decomposition as decomp
-import networkx as nx
 import scipy
 import scipy.signal
 import scipy.ndimage as img
 import scipy.signal as sig
 
+from yass.linkage import connected_components
+
 #there are two steps to getting the rf. The first step is to get a core set of significant pixels using a 2x2 
 # spatial filter. The second step expands the rf around the coreset. This was originally because I was trying to get
 #fatter rfs for the multi-rf splitting project
@@ -30,9 +31,7 @@ def get_seed(image, dim = 2):
     #print (bin_dists)
 
     #compute connected nodes and sum spikes over them
-    G = nx.from_numpy_array(bin_dists)
-    
-    con =  list(nx.connected_components(G))
+    con = connected_components(len(std_pixels), *np.where(bin_dists))
     
     
     cluster_list = [std_pixels[list(con[i])] for i in range(len(con))]
@@ -58,9 +57,7 @@ def expand_rf(image, cluster_list):
     #print (bin_dists)
 
     #compute connected nodes and sum spikes over them
-    G = nx.from_numpy_array(bin_dists)
-    
-    con =  list(nx.connected_components(G))
+    con = connected_components(len(std_pixels), *np.where(bin_dists))
     test_elements = [element[0] for element in cluster_list]
     valid_list = []
     for element in con:
@@ -1,8 +1,18 @@
+import multiprocessing
+
 import numpy as np
 import torch
 from tqdm import tqdm
 
-import cudaSpline as deconv
+from yass.reader import get_memmap
+from yass.deconvolve.match_pursuit_cpu import spline_values
+from yass.deconvolve.match_pursuit_gpu_new import transform_template_parallel
+
+# cuda package to do GPU based spline interpolation
+try:
+    import cudaSpline as deconv
+except ImportError:
+    deconv = None
 from scipy.interpolate import splrep
 
 def fit_spline(curve, knots=None, prepad=0, postpad=0, order=3):
@@ -23,9 +33,71 @@ def transform_template(template, knots=None, prepad=7, postpad=3, order=3):
     return deconv.Template(torch.from_numpy(coefficients).cuda(), template.indices)
 
 
+# detector and templates of a cpu worker process, loaded once by
+# init_worker and reused by every minibatch the process scores
+_WORKER = {}
+
+
+def init_worker(detector, coeffs, channel_index, mcs, bin_file, dtype,
+                n_channels, rec_offset, n_times_extra, n_threads):
+    '''
+    keep the detector and templates of the cpu noise soft assignment in
+    this process and set the number of torch threads it uses
+    '''
+    torch.set_num_threads(n_threads)
+    _WORKER.update(detector=detector.cpu(), coeffs=coeffs,
+                   channel_index=channel_index, mcs=mcs, bin_file=bin_file,
+                   dtype=dtype, n_channels=n_channels,
+                   rec_offset=rec_offset, n_times_extra=n_times_extra)
+
+
+def noise_probs_batch(spike_train, shifts, scales):
+    '''
+    detector output of the clean spikes of a minibatch. residual
+    snippets are gathered from the memory mapped residual (zero outside
+    of the recording and on padded channels) and the shifted, scaled
+    templates are added from their spline coefficients
+    '''
+    detector = _WORKER['detector']
+    channel_index = _WORKER['channel_index']
+    n_times_extra = _WORKER['n_times_extra']
+    n_channels = _WORKER['n_channels']
+    residual = get_memmap(_WORKER['bin_file'], _WORKER['dtype'], n_channels)
+
+    n_times_nn = detector.temporal_filter1[0].weight.shape[2]
+    t_range = np.arange(-(n_times_nn//2), n_times_nn//2+1)
+
+    # residual snippets
+    t_index = spike_train[:, [0]] - _WORKER['rec_offset'] + t_range
+    c_index = channel_index[_WORKER['mcs'][spike_train[:, 1]]]
+    valid = ((t_index >= 0) & (t_index < residual.shape[0]))[:, :, None] & (
+        c_index < n_channels)[:, None]
+    resid_snippets = residual[np.clip(t_index, 0, residual.shape[0]-1)[
+        :, :, None], np.minimum(c_index, n_channels-1)[:, None]]
+    resid_snippets = np.where(valid, resid_snippets, 0)
+
+    # shifted templates
+    time_pts = np.broadcast_to(
+        np.arange(n_times_extra, n_times_extra+n_times_nn)[None, :, None],
+        resid_snippets.shape)
+    clean_wfs = resid_snippets + scales[:, None, None]*spline_values(
+        _WORKER['coeffs'], spike_train[:, 1], shifts, time_pts)
+
+    with torch.no_grad():
+        probs = detector(torch.from_numpy(clean_wfs).float())[0][:, 0]
+
+    return probs.numpy()
+
+
+def _noise_probs_batch(args):
+    return noise_probs_batch(*args)
+
+
 class SOFTNOISEASSIGNMENT(object):
     def __init__(self, fname_spike_train, fname_templates, fname_shifts, fname_scales,
-                 reader_residual, detector, channel_index, large_unit_threshold):
+                 reader_residual, detector, channel_index,
+                 large_unit_threshold, use_gpu=True, batch_size=10000,
+                 n_processors=1, n_threads=1):
         
         self.templates = np.load(fname_templates).astype('float32')
         self.spike_train = np.load(fname_spike_train)
@@ -42,14 +114,26 @@ class SOFTNOISEASSIGNMENT(object):
         self.n_times_nn = self.detector.temporal_filter1[0].weight.shape[2]
         
         self.n_times_extra = 3
+
+        # on cpu, minibatches of batch_size spikes are scored in
+        # n_processors processes with n_threads torch threads each
+        self.use_gpu = use_gpu
+        self.batch_size = batch_size
+        self.n_processors = n_processors
+        self.n_threads = n_threads
         self.n_neigh_chans = self.channel_index.shape[1]
         self.n_total_spikes = self.spike_train.shape[0]
         
         
         self.preprocess_templates_and_spike_times()
         self.exclude_large_units(large_unit_threshold)
-        self.get_bspline_coeffs()
-        self.move_to_torch()
+        if self.use_gpu:
+            self.get_bspline_coeffs()
+            self.move_to_torch()
+        else:
+            self.coeffs = np.stack([
+                transform_template_parallel(template)
+                for template in self.templates_aligned.transpose(0, 2, 1)])
 
     def preprocess_templates_and_spike_times(self):
         
@@ -157,7 +241,10 @@ class SOFTNOISEASSIGNMENT(object):
         return shifted_templates
 
     def compute_soft_assignment(self):
-        
+
+        if not self.use_gpu:
+            return self.compute_soft_assignment_cpu()
+
         probs = torch.zeros(len(self.spike_train)).cuda()
 
         # batch offsets
@@ -221,3 +308,50 @@ class SOFTNOISEASSIGNMENT(object):
         probs[self.idx_included] = probs_included
 
         return probs
+
+    def compute_soft_assignment_cpu(self):
+        '''
+        cpu version of compute_soft_assignment. spikes are sorted by time
+        and cut into contiguous minibatches, so that every minibatch reads
+        a short stretch of the residual
+        '''
+        order = np.argsort(self.spike_train[:, 0], kind='stable')
+        args = [(self.spike_train[idx], self.shifts[idx], self.scales[idx])
+                for idx in np.split(order, np.arange(
+                    self.batch_size, len(order), self.batch_size))]
+
+        initargs = (self.detector, self.coeffs, self.channel_index,
+                    self.mcs, self.reader_residual.bin_file,
+                    self.reader_residual.dtype,
+                    self.reader_residual.n_channels,
+                    self.reader_residual.offset, self.n_times_extra,
+                    self.n_threads)
+
+        if self.n_processors > 1:
+            pool = multiprocessing.Pool(self.n_processors, init_worker,
+                                        initargs)
+            try:
+                probs_batches = list(tqdm(
+                    pool.imap(_noise_probs_batch, args), total=len(args)))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            n_threads = torch.get_num_threads()
+            init_worker(*initargs)
+            try:
+                probs_batches = [_noise_probs_batch(arg)
+                                 for arg in tqdm(args)]
+            finally:
+                torch.set_num_threads(n_threads)
+                _WORKER.clear()
+
+        probs_included = np.zeros(len(self.spike_train), 'float32')
+        if len(order) > 0:
+            probs_included[order] = np.hstack(probs_batches)
+
+        probs = np.ones(self.n_total_spikes, 'float32')
+        probs[self.idx_included] = probs_included
+
+        return probs
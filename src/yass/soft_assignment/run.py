@@ -19,12 +19,45 @@ from yass.neuralnetwork.model_detector import Detect
 from yass.soft_assignment.noise import SOFTNOISEASSIGNMENT
 from yass.soft_assignment.template import TEMPLATE_ASSIGN_OBJECT
 
-def s_score(log_probs):
-    s_score = np.zeros(log_probs.shape[0])
-    for i, row in enumerate(log_probs):
-        col = np.argmin(row[1:3]) + 1
-        s_score[i] = (row[col] - row[0])/np.max([row[0], row[col]])
-    return s_score
+
+def s_score(log_probs, idx_included=None, out=None, block_size=1000000):
+    '''
+    silhouette-like score of every spike: distance to its nearest
+    competing unit (columns 1 and 2) minus the distance to its own unit
+    (column 0), over the larger of the two.
+
+    only the rows in idx_included (row indices or a boolean mask; all rows
+    if None) are scored; the others are spikes left out of the soft
+    assignment and are set to NaN.
+    rows are processed in blocks of block_size, so log_probs and out can
+    be memmaps larger than memory. returns out
+    '''
+    if out is None:
+        out = np.zeros(log_probs.shape[0])
+    if idx_included is None:
+        idx_included = np.arange(log_probs.shape[0])
+    else:
+        idx_included = np.asarray(idx_included)
+        if idx_included.dtype == bool:
+            idx_included = np.flatnonzero(idx_included)
+        else:
+            idx_included = np.sort(idx_included)
+        out[:] = np.nan
+
+    for start in range(0, len(idx_included), block_size):
+        idx_block = idx_included[start:start+block_size]
+        block = np.asarray(log_probs[idx_block])
+
+        # nearest competitor of every row
+        competitors = block[:, 1:3]
+        col = np.argpartition(competitors, 0, axis=1)[:, :1]
+        nearest = np.take_along_axis(competitors, col, axis=1)[:, 0]
+
+        own = block[:, 0]
+        out[idx_block] = (nearest - own)/np.maximum(own, nearest)
+
+    return out
+
 
 def run(template_fname,
         spike_train_fname,
@@ -48,6 +81,8 @@ def run(template_fname,
         output_directory, 'noise_soft_assignment.npy')
     fname_template_soft = os.path.join(
         output_directory, 'template_soft_assignment.npz')
+    fname_silhouette_score = os.path.join(
+        output_directory, 'silhouette_score.npy')
     
     # output folder
     if not os.path.exists(output_directory):
@@ -75,7 +110,8 @@ def run(template_fname,
                               CONFIG.channel_index,
                               CONFIG)
             detector.load(CONFIG.neuralnetwork.detect.filename)
-            detector = detector.cuda()
+            if CONFIG.deconvolution.deconv_gpu:
+                detector = detector.cuda()
 
             # initialize soft assignment calculator
             threshold = CONFIG.deconvolution.threshold/0.1
@@ -85,8 +121,19 @@ def run(template_fname,
                 template_fname_ = os.path.join(template_fname, 'templates_init.npy')
             else:
                 template_fname_ = template_fname
+            if CONFIG.resources.multi_processing:
+                n_processors = CONFIG.resources.n_processors
+            else:
+                n_processors = 1
+            batch_size = CONFIG.resources.soft_assignment_batch_size
+            n_threads = CONFIG.resources.soft_assignment_n_threads
             sna = SOFTNOISEASSIGNMENT(spike_train_fname, template_fname_, shifts_fname, scales_fname,
-                                      reader_resid, detector, CONFIG.channel_index, threshold)
+                                      reader_resid, detector,
+                                      CONFIG.channel_index, threshold,
+                                      use_gpu=CONFIG.deconvolution.deconv_gpu,
+                                      batch_size=batch_size,
+                                      n_processors=n_processors,
+                                      n_threads=n_threads)
 
             # compuate soft assignment
             probs_noise = sna.compute_soft_assignment()
@@ -147,15 +194,22 @@ def run(template_fname,
             lik_window=window_size,
             similar_array=similar_array,
             update_templates=update_templates,
-            template_update_time=CONFIG.deconvolution.template_update_time)
+            template_update_time=CONFIG.deconvolution.template_update_time,
+            use_gpu=CONFIG.deconvolution.deconv_gpu,
+            n_threads=CONFIG.resources.n_processors)
 
         probs_templates, _, logprobs_outliers, units_assignment = TAO.run()
         #outlier spike times/units
         chi2_df = (2*(window_size //2) + 1)*n_chans
         cut_off = chi2(chi2_df).ppf(.999)
 
-        #s_table = s_score(_)
-        #s_table = s_score(probs_templates)
+        # silhouette scores, written in blocks to disk
+        s_table = np.lib.format.open_memmap(
+            fname_silhouette_score, mode='w+', dtype='float32',
+            shape=(logprobs_outliers.shape[0],))
+        s_score(logprobs_outliers, TAO.idx_included, out=s_table)
+        s_table.flush()
+        del s_table
         #logprobs_outliers = logprobs_outliers/chi2_df
 
         cpu_sps = TAO.spike_train_og
@@ -9,12 +9,23 @@ Created on Mon Nov 18 21:39:48 2019
 import os
 import numpy as np 
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 import scipy.spatial.distance as dist
 import torch
-import cudaSpline as deconv
 from scipy.interpolate import splrep
+from scipy.linalg import cholesky, solve_triangular
 from numpy.linalg import inv as inv
 
+from yass.deconvolve.match_pursuit_cpu import spline_values
+from yass.deconvolve.match_pursuit_gpu_new import transform_template_parallel
+
+# cuda package to do GPU based spline interpolation
+# (not available on cpu-only machines, where use_gpu=False is used instead)
+try:
+    import cudaSpline as deconv
+except ImportError:
+    deconv = None
+
 def fit_spline(curve, knots=None, prepad=0, postpad=0, order=3):
     if knots is None:
         knots = np.arange(len(curve) + prepad + postpad)
@@ -61,7 +72,13 @@ class TEMPLATE_ASSIGN_OBJECT(object):
                  reader_residual, spat_cov, temp_cov, channel_idx, geom,
                  large_unit_threshold = 5, n_chans = 5, rec_chans = 512,
                  sim_units = 3, similar_array = None, temp_thresh= np.inf, lik_window = 50,
-                 update_templates=False, template_update_time=None):
+                 update_templates=False, template_update_time=None,
+                 use_gpu=True, n_threads=1):
+
+        # device of the likelihood computation; on cpu, batches are
+        # processed by n_threads threads
+        self.use_gpu = use_gpu
+        self.n_threads = n_threads
 
         #get the variance of the residual:        
         self.temp_thresh = temp_thresh
@@ -126,7 +143,8 @@ class TEMPLATE_ASSIGN_OBJECT(object):
         self.preprocess_spike_times()
 
         #get aligned templatess
-        self.move_to_torch()
+        if self.use_gpu:
+            self.move_to_torch()
 
         self.get_kronecker()
         
@@ -169,9 +187,12 @@ class TEMPLATE_ASSIGN_OBJECT(object):
         self.aligned_template_list.append(self.templates_aligned)
         self.coeff_list.append(self.get_bspline_coeffs(self.templates_aligned))
 
-        self.templates_aligned = [
-            torch.from_numpy(element).float().cuda() 
-            for element in self.aligned_template_list]
+        if self.use_gpu:
+            self.templates_aligned = [
+                torch.from_numpy(element).float().cuda() 
+                for element in self.aligned_template_list]
+        else:
+            self.templates_aligned = self.aligned_template_list
         
     def get_residual_variance(self):
         num = int(60/self.reader_residual.n_sec_chunk)
@@ -182,6 +203,10 @@ class TEMPLATE_ASSIGN_OBJECT(object):
         
     def get_kronecker(self):
 
+        if not self.use_gpu:
+            self.get_whiteners()
+            return
+
         self.cov_list = []
         inv_temp  = inv(self.temp_cov)
         for unit in range(self.n_units):
@@ -193,6 +218,32 @@ class TEMPLATE_ASSIGN_OBJECT(object):
         self.cov_list = np.asarray(self.cov_list)
         self.cov_list = torch.from_numpy(self.cov_list).half().cuda()
     
+    def get_whiteners(self):
+        '''
+        inverse cholesky factors of the temporal covariance and of the
+        spatial covariance on the channels of every unit, so that
+        vec(X)^T kron(inv(S), inv(T)) vec(X) = |W_t X W_s|^2 for a
+        (time, channel) snippet X
+        '''
+        chol_temp = cholesky(self.temp_cov, lower=True)
+        self.temporal_whitener = solve_triangular(
+            chol_temp, np.eye(len(chol_temp)), lower=True).astype('float32')
+
+        self.spatial_whiteners = np.zeros(
+            (self.n_units, self.n_chans, self.n_chans), 'float32')
+        for unit in range(self.n_units):
+            chans = self.chans[unit]
+            spat_cov = self.spat_cov[np.ix_(chans, chans)]
+            try:
+                chol_spat = cholesky(spat_cov, lower=True)
+                self.spatial_whiteners[unit] = solve_triangular(
+                    chol_spat, np.eye(len(chans)), lower=True).T
+            except np.linalg.LinAlgError:
+                # not positive definite; drop the non-positive directions
+                w, v = np.linalg.eigh(spat_cov)
+                w[w <= 0] = 1E-10
+                self.spatial_whiteners[unit] = v/np.sqrt(w)
+
     def compute_units_in(self):
 
         ptps = self.templates.ptp(1)
@@ -326,6 +377,11 @@ class TEMPLATE_ASSIGN_OBJECT(object):
         
     def get_bspline_coeffs(self,  template_aligned):
 
+        if not self.use_gpu:
+            return np.stack([transform_template_parallel(template)
+                             for template in template_aligned.transpose(
+                                 0, 2, 1).astype('float32')])
+
         n_data, n_times, n_channels = template_aligned.shape
 
         channels = torch.arange(n_channels).cuda()
@@ -368,7 +424,10 @@ class TEMPLATE_ASSIGN_OBJECT(object):
         return log_prob
 
     def compute_soft_assignment(self):
-        
+
+        if not self.use_gpu:
+            return self.compute_soft_assignment_cpu()
+
         log_probs = torch.zeros((len(self.spike_train), self.sim_units)).half().cuda()
 
         # batch offsets
@@ -436,6 +495,88 @@ class TEMPLATE_ASSIGN_OBJECT(object):
 
         return log_probs.float().cpu().numpy()
 
+    def compute_soft_assignment_cpu(self):
+        '''
+        cpu version of compute_soft_assignment. batches are processed in
+        a thread pool; templates are (re)loaded between them if they are
+        updated over time
+        '''
+        log_probs = np.zeros((len(self.spike_train), self.sim_units),
+                             'float32')
+
+        # spikes of every batch, [start, end)
+        self.time_order = np.argsort(self.spike_train[:, 0], kind='stable')
+        self.batch_ptr = np.searchsorted(
+            self.spike_train[self.time_order, 0],
+            self.reader_residual.idx_list)
+
+        batch_ids = np.arange(self.reader_residual.n_batches)
+        if self.update_templates:
+            segments = np.split(batch_ids, self.update_chunk[1:])
+        else:
+            segments = [batch_ids]
+
+        with tqdm(total=self.reader_residual.n_batches) as pbar, \
+                ThreadPoolExecutor(self.n_threads) as pool:
+            for segment in segments:
+
+                if self.update_templates:
+                    time_sec_start = (segment[0] *
+                                      self.reader_residual.n_sec_chunk)
+                    fname_templates = os.path.join(
+                        self.templates_dir,
+                        'templates_{}sec.npy'.format(time_sec_start))
+                    self.templates = np.load(fname_templates)
+                    self.get_template_data()
+
+                for idx_in, logs_batch in pool.map(self.log_probs_batch,
+                                                   segment):
+                    log_probs[idx_in] = logs_batch
+                    pbar.update()
+
+        return log_probs
+
+    def log_probs_batch(self, batch_id):
+        '''
+        mahalanobis distances (n_spikes, sim_units) of the spikes of a
+        batch after replacing their template with each similar unit's.
+        the whitening is split into one temporal factor shared by all
+        spikes and the spatial factor of each spike's unit, applied to all
+        spikes at once
+        '''
+        idx_in = self.time_order[self.batch_ptr[batch_id, 0]:
+                                 self.batch_ptr[batch_id, 1]]
+        if len(idx_in) == 0:
+            return idx_in, np.zeros((0, self.sim_units), 'float32')
+
+        # load residual data
+        resid_dat = self.reader_residual.read_data_batch(
+            batch_id, add_buffer=True)
+        offset = (self.reader_residual.idx_list[batch_id, 0] -
+                  self.reader_residual.buffer)
+
+        spike_times = self.spike_train[idx_in, 0] - offset
+        units = self.spike_train[idx_in, 1]
+        shifts = self.shifts[idx_in]
+        chans = self.chans[units]
+
+        # residual snippets in the likelihood window
+        t_window = np.arange(self.offset, self.offset + self.lik_window)
+        t_index = spike_times[:, None] + t_window - self.n_times//2
+        resid_snippets = resid_dat[t_index[:, :, None], chans[:, None]]
+
+        time_pts = np.broadcast_to(t_window[None, :, None],
+                                   resid_snippets.shape)
+        logs_batch = np.zeros((len(idx_in), self.sim_units), 'float32')
+        for i in range(self.sim_units):
+            clean_wfs = resid_snippets + spline_values(
+                self.coeff_list[i], units, shifts, time_pts)
+            clean_wfs = np.matmul(self.temporal_whitener, clean_wfs)
+            clean_wfs = np.matmul(clean_wfs, self.spatial_whiteners[units])
+            logs_batch[:, i] = np.sum(np.square(clean_wfs), (1, 2))
+
+        return idx_in, logs_batch
+
     def clean_wave_forms(self, spike_idx, unit):
         return_wfs = torch.zeros((spike_idx.shape[0],self.templates.shape[1], self.n_chans))
         with tqdm(total=self.reader_residual.n_batches) as pbar:
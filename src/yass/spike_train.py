@@ -0,0 +1,50 @@
+"""
+Bookkeeping kernels on (n_spikes, 2) spike trains (time, unit)
+
+Every function is a single vectorised pass over the spikes, so they stay
+cheap on spike trains of tens of millions of spikes.
+"""
+import numpy as np
+
+
+def soft_counts(units, weights=None, n_units=None):
+    '''
+    (soft) number of spikes of every unit: weighted bincount of unit ids.
+    units with no spikes get 0; the result has n_units entries if given
+    '''
+    if n_units is None:
+        n_units = units.max() + 1 if len(units) > 0 else 0
+
+    return np.bincount(units, weights, minlength=n_units)[:n_units]
+
+
+def relabel_lut(units_kept, n_units):
+    '''
+    lookup array mapping old unit ids to their position in units_kept and
+    every other unit to -1
+    '''
+    lut = np.full(n_units, -1, 'int64')
+    lut[units_kept] = np.arange(len(units_kept))
+
+    return lut
+
+
+def compact_spike_train(spike_train, units_kept, *arrays):
+    '''
+    keep the spikes of units_kept, relabel them to 0, ..., len(units_kept)-1
+    and compact the per spike arrays (shifts, scales, soft assignments, ...)
+    with the same mask.
+
+    returns the new spike train followed by the compacted arrays; None
+    arrays are passed through
+    '''
+    n_units = max(spike_train[:, 1].max() if len(spike_train) > 0 else -1,
+                  np.max(units_kept, initial=-1)) + 1
+    new_ids = relabel_lut(units_kept, n_units)[spike_train[:, 1]]
+    idx_keep = np.flatnonzero(new_ids >= 0)
+
+    spike_train_new = spike_train[idx_keep]
+    spike_train_new[:, 1] = new_ids[idx_keep]
+
+    return (spike_train_new,) + tuple(
+        None if array is None else array[idx_keep] for array in arrays)
@@ -2,7 +2,6 @@
 
 import os
 import numpy as np
-import math
 import logging
 import parmap
 
@@ -11,6 +10,7 @@ from scipy.spatial.distance import pdist, squareform
 from scipy import signal
 
 from yass import read_config
+from yass import arena
 from yass.reader import READER
 from yass.util import absolute_path_to_asset
 
@@ -140,25 +140,10 @@ class WaveForms(object):
         --------
         numpy.ndarray of shifted wave forms.
         """
-        unit_time_window = np.arange(
-                self.n_time - 2 * clip_value) + shifts[:, None]
-        default_range = np.arange(self.n_time - 2 * clip_value)
-        sub_shifts = shifts - np.floor(shifts)
-        shifts = np.floor(shifts).astype(np.int)
-
-        def sub(i, shift, sub=None):
-            if sub is None:
-                return self.wave_forms[i, :, default_range + shift]
-            return sub(i, shift) * sub + sub(i, shift + 1) * (1 - sub)
-
-        if sub_shifts.sum() > 0.:
-            # Linear interpolation.
-            np.array(
-                [sub(i, s, sub_shifts[i]) for i, s in enumerate(
-                    shifts)]).transpose([0, 2, 1])
-
-        return np.array(
-                [sub(i, s) for i, s in enumerate(shifts)]).transpose([0, 2, 1])
+        shifts = np.floor(shifts).astype('int64')
+
+        return time_windows(
+            self.wave_forms, shifts, self.n_time - 2 * clip_value)
 
     def align(self, ref_wave_form=None, jitter=3, upsample=1):
         """Aligns all the wave forms to the reference wave form.
@@ -344,7 +329,8 @@ def run_template_computation(
     #fname_spike_times, n_units = partition_spike_time(
     #    tmp_folder, fname_spike_train)
 
-    n_units = np.max(np.load(fname_spike_train)[:, 1]) + 1
+    # sort spike train by unit once so that workers slice their units
+    n_units = arena.register_spike_train(fname_spike_train)
 
     if unit_ids is None:
         unit_ids = np.arange(n_units)
@@ -370,10 +356,11 @@ def run_template_computation(
                        processes=n_processors,
                        pm_pbar=True)
     else:
-        for ctr in unit_ids:
+        for ctr, unit in enumerate(unit_ids):
             run_template_computation_parallel(
-                fname_spike_train,
+                unit,
                 fnames_out[ctr],
+                fname_spike_train,
                 reader,
                 spike_size)
 
@@ -397,8 +384,8 @@ def run_template_computation_parallel(
         return
 
     # load spike times
-    spike_train = np.load(fname_spike_train)
-    spike_times = spike_train[spike_train[:, 1] == unit_id, 0]
+    spike_times = arena.SpikeTrainIndex.load(
+        fname_spike_train).unit_times(unit_id)
 
     if len(spike_times) > 0:
         template = compute_a_template(spike_times,
@@ -476,6 +463,9 @@ def run_cleaned_template_computation(
                              dtype_residual_recording,
                              CONFIG)
 
+    # sort spike train by unit once so that workers slice their units
+    arena.register_spike_train(fname_spike_train)
+
     # run computing function
     if CONFIG.resources.multi_processing:
         n_processors = CONFIG.resources.n_processors
@@ -526,10 +516,11 @@ def run_cleaned_template_computation_parallel(
     fname_scales,
     reader_residual):
 
-    spike_train = np.load(fname_spike_train)
-    templates = np.load(fname_templates)
-    shifts = np.load(fname_shifts)
-    scales = np.load(fname_scales)
+    spike_index = arena.SpikeTrainIndex.load(fname_spike_train)
+    spike_train = spike_index.spike_train
+    templates = arena.attach(fname_templates)
+    shifts = arena.attach(fname_shifts)
+    scales = arena.attach(fname_scales)
 
     # get the spike size
     _, spike_size, n_channels = templates.shape
@@ -542,7 +533,7 @@ def run_cleaned_template_computation_parallel(
             continue
 
         # get necessary data
-        idx_ = np.where(spike_train[:, 1] == unit)[0]
+        idx_ = spike_index.unit_rows(unit)
         spt_ = spike_train[idx_, 0]
         shift_ = shifts[idx_]
         scale_ = scales[idx_]
@@ -678,40 +669,62 @@ def align_get_shifts_with_ref(wf, ref=None, upsample_factor=5, nshifts=7):
     wlen_trunc = wf_trunc.shape[1]
     
     # align to last chanenl which is largest amplitude channel appended
+    # column i of ref_shifted is the reference lagged by i - nshifts//2
     ref_upsampled = upsample_resample(ref[np.newaxis], upsample_factor)[0]
-    ref_shifted = np.zeros([wf_trunc.shape[1], nshifts])
-    
-    for i,s in enumerate(range(-(nshifts//2), (nshifts//2)+1)):
-        ref_shifted[:,i] = ref_upsampled[s + wf_start: s + wf_end]
+    ref_shifted = ref_upsampled[
+        np.arange(wlen_trunc)[:, None] + np.arange(nshifts)]
 
-    bs_indices = np.matmul(wf_trunc[:,np.newaxis], ref_shifted).squeeze(1).argmax(1)
+    # cross-correlation of every waveform with every lag at once
+    bs_indices = np.matmul(wf_trunc, ref_shifted).argmax(1)
     best_shifts = (np.arange(-int((nshifts-1)/2), int((nshifts-1)/2+1)))[bs_indices]
 
     return best_shifts/np.float32(upsample_factor)
 
 def upsample_resample(wf, upsample_factor):
-    wf = wf.T
-    waveform_len, n_spikes = wf.shape
-    traces = np.zeros((n_spikes, (waveform_len-1)*upsample_factor+1),'float32')
-    for j in range(wf.shape[1]):
-        traces[j] = signal.resample(wf[:,j],(waveform_len-1)*upsample_factor+1)
-    return traces
+    '''
+    upsample (n_spikes, n_times) waveforms to (n_times-1)*upsample_factor+1
+    samples; all waveforms are resampled with one fft along time
+    '''
+    waveform_len = wf.shape[1]
+    return signal.resample(
+        wf, (waveform_len-1)*upsample_factor+1, axis=1).astype('float32')
+
+
+def time_windows(wf, starts, n_times, axis=-1):
+    '''
+    gather windows of n_times samples along axis of wf starting at starts
+    (one start per entry of the first axis, or one per entry of every axis
+    before axis) in a single fancy indexing
+    '''
+    axis = axis % wf.ndim
+    starts = np.asarray(starts)
+    idx = starts.reshape(starts.shape + (1,)*(wf.ndim - starts.ndim)) + \
+        np.arange(n_times).reshape((-1,) + (1,)*(wf.ndim - axis - 1))
+    return np.take_along_axis(wf, idx, axis=axis)
+
 
 def shift_chans(wf, best_shifts):
+    '''
+    shift (n_spikes, n_times, n_channels) waveforms in time (circularly) by
+    best_shifts samples; fractional shifts are linear interpolations of the
+    two neighbouring integer shifts. all spikes are shifted in one gather
+    '''
     # use template feat_channel shifts to interpolate shift of all spikes on all other chans
     # Cat: TODO read this from CNOFIG
-    wfs_final= np.zeros(wf.shape, 'float32')
-    for k, shift_ in enumerate(best_shifts):
-        if int(shift_)==shift_:
-            ceil = int(shift_)
-            temp = np.roll(wf[k],ceil,axis=0)
-        else:
-            ceil = int(math.ceil(shift_))
-            floor = int(math.floor(shift_))
-            temp = np.roll(wf[k],ceil,axis=0)*(shift_-floor)+np.roll(wf[k],floor, axis=0)*(ceil-shift_)
-        wfs_final[k] = temp
-    
-    return wfs_final
+    best_shifts = np.asarray(best_shifts)
+    n_spikes, n_times, n_channels = wf.shape
+    floor = np.floor(best_shifts).astype('int64')
+    frac = (best_shifts - floor).astype('float32')[:, None, None]
+
+    # rolling by shift means reading from (t - shift) mod n_times; gather
+    # whole time samples (all channels) of all spikes at once
+    idx = (np.arange(n_times) - floor[:, None]) % n_times
+    idx += np.arange(n_spikes)[:, None]*n_times
+    wf_floor = wf.reshape(-1, n_channels)[idx.ravel()].reshape(
+        wf.shape).astype('float32', copy=False)
+    wf_ceil = np.roll(wf_floor, 1, axis=1)
+
+    return wf_ceil*frac + wf_floor*(1 - frac)
 
 
 def fix_template_edges(templates, w=None):
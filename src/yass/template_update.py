@@ -4,9 +4,12 @@ import torch
 from tqdm import tqdm
 from scipy.interpolate import interp1d
 
+import parmap
+
 from yass import read_config
 from yass.reader import READER
-from yass.residual.residual_gpu import RESIDUAL_GPU2
+from yass.deconvolve.match_pursuit_cpu import spline_values
+from yass.deconvolve.match_pursuit_gpu_new import transform_template_parallel
 
 def run_template_update(output_directory,
                         fname_templates, fname_spike_train,
@@ -37,17 +40,10 @@ def run_template_update(output_directory,
                                  n_sec_chunk,
                                  offset=residual_offset)
 
-        # residual obj that can shift templates in gpu
-        residual_comp = RESIDUAL_GPU2(
-            None, CONFIG, None, None, None,
-            None, None, None, None, None, True)
-        residual_comp.load_templates(fname_templates)
-        residual_comp.make_bsplines_parallel()
-
         avg_min_max_vals, weights = get_avg_min_max_vals(
-        fname_templates, fname_spike_train,
-        fname_shifts, fname_scales,
-        reader_residual, residual_comp, units_to_update)
+            fname_templates, fname_spike_train,
+            fname_shifts, fname_scales,
+            reader_residual, CONFIG, units_to_update)
 
         templates_updated = update_templates(
             fname_templates, weights,
@@ -60,7 +56,7 @@ def run_template_update(output_directory,
 
 def get_avg_min_max_vals(fname_templates, fname_spike_train,
                          fname_shifts, fname_scales,
-                         reader_residual, residual_comp,
+                         reader_residual, CONFIG,
                          units_to_update=None, min_ptp=5):
     # load input data
     templates = np.load(fname_templates)
@@ -79,122 +75,206 @@ def get_avg_min_max_vals(fname_templates, fname_spike_train,
 
     # get vis chan
     ptp_temps = templates.ptp(1)
-    ptp_max = ptp_temps.max(1)
     vis_chans = [None]*n_units
     for k in range(n_units):
         vis_chans[k] = np.where(ptp_temps[k] > min_ptp)[0]
 
+    # weighted sums of min/max values and weights of every unit, summed
+    # over all spikes of a chunk at once
+    min_max_vals_sum = np.zeros((n_units, 2, 5, n_channels))
+    weights_sum = np.zeros((n_units, n_channels))
+    for idx, min_max_vals_spikes in iter_cleaned_min_max_vals(
+            templates, spike_train, shifts, scales,
+            reader_residual, fname_templates, CONFIG):
+
+        neuron_ids = spike_train[idx, 1]
+
+        # spikes whose ptp is close to the template count
+        ptps_spikes = (min_max_vals_spikes[:, 1].max(1) -
+                       min_max_vals_spikes[:, 0].min(1))
+        diffs = np.abs(ptps_spikes - ptp_temps[neuron_ids])
+        weights_batch = diffs < ptp_temps[neuron_ids]*0.2
+        weights_batch[diffs < 3] = 1
+        weights_batch = weights_batch.astype('float32')
+
+        min_max_vals_spikes *= weights_batch[:, None, None]
+        units, sums = unit_sums(neuron_ids, min_max_vals_spikes)
+        min_max_vals_sum[units] += sums
+        units, sums = unit_sums(neuron_ids, weights_batch)
+        weights_sum[units] += sums
+
+    min_max_vals_avg = [None]*n_units
+    weights = [None]*n_units
+    for k in units_to_update:
+        weights_ = weights_sum[k, vis_chans[k]].astype('float32')
+        weights_[weights_==0] = 0.0000001
+        min_max_vals_avg[k] = min_max_vals_sum[k][:, :, vis_chans[k]]/weights_
+        weights[k] = weights_
+
+    return min_max_vals_avg, weights
+
+
+def unit_sums(neuron_ids, values):
+    '''
+    sum of values (n_spikes, ...) over the spikes of every unit in
+    neuron_ids, as one segmented reduction. returns the units and sums
+    '''
+    order = np.argsort(neuron_ids, kind='stable')
+    units, starts = np.unique(neuron_ids[order], return_index=True)
+
+    return units, np.add.reduceat(values[order], starts, axis=0)
+
+
+def iter_cleaned_min_max_vals(templates, spike_train, shifts, scales,
+                              reader_residual, fname_templates, CONFIG,
+                              max_spikes=5000):
+    '''
+    values of all cleaned spikes (residual + shifted and scaled template)
+    within 2 samples of the min/max locations of their templates, in one
+    pass over the residual with one read per batch. spikes of each batch,
+    (t_start, t_end], are found by binary search and processed
+    max_spikes at a time, on gpu if deconvolution.deconv_gpu is set and
+    on cpu otherwise.
+
+    yields the spike ids and their values, (n_spikes, 2, 5, n_channels)
+    '''
+    n_units, n_times, n_channels = templates.shape
+
     min_max_loc = np.stack((templates.argmin(1),
                             templates.argmax(1))).transpose(1, 0, 2)
     min_max_loc[min_max_loc < 2] = 2
     min_max_loc[min_max_loc > n_times -3] = n_times - 3
 
-    # move to gpu
-    templates = torch.from_numpy(templates).float().cuda()
-    spike_train = torch.from_numpy(spike_train).long().cuda()
-    shifts = torch.from_numpy(shifts).float().cuda()
-    scales = torch.from_numpy(scales).float().cuda()
-    min_max_loc = torch.from_numpy(min_max_loc).long().cuda()
-    ptp_temps = torch.from_numpy(ptp_temps).float().cuda()
+    if CONFIG.deconvolution.deconv_gpu:
+        # residual obj that can shift templates in gpu
+        from yass.residual.residual_gpu import RESIDUAL_GPU2
+        residual_comp = RESIDUAL_GPU2(
+            None, CONFIG, None, None, None,
+            None, None, None, None, None, True)
+        residual_comp.load_templates(fname_templates)
+        residual_comp.make_bsplines_parallel()
+        min_max_loc_gpu = torch.from_numpy(min_max_loc).long().cuda()
+    else:
+        coefficients = template_spline_coefficients(templates, CONFIG)
 
-    min_max_vals_avg = [None]*n_units
-    weights = [None]*n_units
-    for batch_id in tqdm(range(reader_residual.n_batches)):
+    time_order = np.argsort(spike_train[:, 0], kind='stable')
+    batch_ptr = np.searchsorted(spike_train[time_order, 0],
+                                reader_residual.idx_list, 'right')
 
-        t_start, t_end = reader_residual.idx_list[batch_id]
-        batch_offset = int(t_start - reader_residual.buffer)
-        idx_in = torch.nonzero((spike_train[:, 0] > t_start)&(spike_train[:, 0] <= t_end))[:, 0]
+    for batch_id in tqdm(range(reader_residual.n_batches)):
+        idx_in = time_order[batch_ptr[batch_id, 0]:batch_ptr[batch_id, 1]]
+        if len(idx_in) == 0:
+            continue
 
-        spike_times_batch = spike_train[idx_in, 0]
-        spike_times_batch -= batch_offset
+        batch_offset = int(reader_residual.idx_list[batch_id, 0] -
+                           reader_residual.buffer)
+        spike_times_batch = spike_train[idx_in, 0] - batch_offset
         neuron_ids_batch = spike_train[idx_in, 1]
 
-        shifts_batch = shifts[idx_in]
-        scales_batch = scales[idx_in]
-
         # get residual batch
         residual = reader_residual.read_data_batch(batch_id, add_buffer=True)
-        residual = torch.from_numpy(residual).cuda()
-
-        # get min/max values
-        # due to memory constraint, find the values 10,000 spikes at a time
-        max_spikes = 5000
-        counter = torch.cat((torch.arange(0, len(spike_times_batch), max_spikes),
-                             torch.tensor([len(spike_times_batch)]))).cuda()
-
-        # get the values near template min/max locations for each channel
-        # min_max_vals_spikes: # spikes x 2 (min/max) x # channels x 5 (-2 to 2 of argmin/argmax)
-        # this will get min/max values of cleaned spikes.
-        # it will first get residual values and then add templates
-        min_max_vals_spikes = torch.cuda.FloatTensor(len(spike_times_batch), 2, 5, n_channels).fill_(0)
-        for j in range(len(counter)-1):
-            ii_start = counter[j]
-            ii_end = counter[j+1]
-
-            min_max_loc_spikes = (min_max_loc[neuron_ids_batch[ii_start:ii_end]] + 
-                                  spike_times_batch[ii_start:ii_end, None, None] - n_times//2)
-            min_max_loc_spikes = min_max_loc_spikes[:, :, None] + torch.arange(-2, 3).cuda()[None, None, :, None]
-            min_max_vals_spikes[ii_start:ii_end] = torch.gather(
-                residual, 0, min_max_loc_spikes.reshape(-1, n_channels)).reshape(
-                -1, 2, 5, n_channels)
-
-            shifted_templates = residual_comp.get_shifted_templates(
-                    neuron_ids_batch[ii_start:ii_end], 
-                    shifts_batch[ii_start:ii_end], 
-                    scales_batch[ii_start:ii_end])
-            min_max_loc_spikes = min_max_loc[
-                neuron_ids_batch[ii_start:ii_end]][
-                :, :, None] + torch.arange(-2, 3).cuda()[None, None, :, None]
-            min_max_vals_spikes[ii_start:ii_end] += torch.gather(
-                shifted_templates,
-                1,
-                min_max_loc_spikes.reshape(-1, 10, n_channels)
-            ).reshape(-1, 2, 5, n_channels)
-        del min_max_loc_spikes
-        del shifted_templates
-        del residual
-
-        ptps_spikes = torch.max(min_max_vals_spikes[:,1], 1)[0] - torch.min(min_max_vals_spikes[:,0], 1)[0]
-        diffs = torch.abs(ptps_spikes - ptp_temps[neuron_ids_batch])
-        weights_batch = diffs < ptp_temps[neuron_ids_batch]*0.2
-        weights_batch[diffs < 3] = 1
-        weights_batch = weights_batch.float()
 
-        del ptps_spikes
-        del diffs
-
-        for k in units_to_update:
-            idx_ = neuron_ids_batch == k
-            if min_max_vals_avg[k] is not None:
-                min_max_vals_avg[k] += torch.sum(
-                    min_max_vals_spikes[idx_]*weights_batch[idx_][:, None, None], 0)[:,:,vis_chans[k]]
-                weights[k] += torch.sum(weights_batch[idx_], 0)[vis_chans[k]]
+        for ii_start in range(0, len(idx_in), max_spikes):
+            ii = slice(ii_start, ii_start + max_spikes)
+            if CONFIG.deconvolution.deconv_gpu:
+                min_max_vals_spikes = cleaned_min_max_vals_gpu(
+                    residual, spike_times_batch[ii], neuron_ids_batch[ii],
+                    shifts[idx_in[ii]], scales[idx_in[ii]],
+                    min_max_loc_gpu, residual_comp)
             else:
-                min_max_vals_avg[k] = torch.sum(
-                    min_max_vals_spikes[idx_]*weights_batch[idx_][:, None, None], 0)[:,:,vis_chans[k]]
-                weights[k] = torch.sum(weights_batch[idx_], 0)[vis_chans[k]]
-
-        del min_max_vals_spikes
-        del weights_batch
-        del spike_times_batch
-        del neuron_ids_batch
-        del shifts_batch
-        del scales_batch
+                min_max_vals_spikes = cleaned_min_max_vals(
+                    residual, spike_times_batch[ii], neuron_ids_batch[ii],
+                    shifts[idx_in[ii]], scales[idx_in[ii]],
+                    min_max_loc, coefficients)
+
+            yield idx_in[ii], min_max_vals_spikes
+
+    if CONFIG.deconvolution.deconv_gpu:
+        del min_max_loc_gpu
+        del residual_comp
         torch.cuda.empty_cache()
 
-    min_max_vals_avg_cpu = [None]*n_units
-    weights_cpu = [None]*n_units
-    for k in units_to_update:
-        weights_ = weights[k].cpu().data.numpy().astype('float32')
-        weights_[weights_==0] = 0.0000001
-        min_max_vals_avg_ = min_max_vals_avg[k].cpu().data.numpy()
-        min_max_vals_avg_cpu[k] = min_max_vals_avg_/weights_
-        weights_cpu[k] = weights_
 
-    del residual_comp
+def template_spline_coefficients(templates, CONFIG):
+    '''
+    cubic b-spline coefficients (n_units, n_channels, n_times + 4) of the
+    templates, the same ones RESIDUAL_GPU2 uses to shift them
+    '''
+    templates = templates.transpose(0, 2, 1).astype('float32')
+    if CONFIG.resources.multi_processing:
+        coefficients = parmap.map(transform_template_parallel,
+                                  list(templates),
+                                  processes=CONFIG.resources.n_processors,
+                                  pm_pbar=False)
+    else:
+        coefficients = [transform_template_parallel(template)
+                        for template in templates]
+
+    return np.stack(coefficients)
+
+
+def cleaned_min_max_vals(residual, spike_times, neuron_ids, shifts,
+                         scales, min_max_loc, coefficients):
+    '''
+    values of cleaned spikes around the min/max locations of their
+    templates, (n_spikes, 2, 5, n_channels). the shifted templates are
+    evaluated from their spline coefficients only at those locations,
+    following the convention of the gpu spline kernel
+    '''
+    n_channels = residual.shape[1]
+    n_times = coefficients.shape[2] - 4
+    loc = (min_max_loc[neuron_ids][:, :, None] +
+           np.arange(-2, 3)[None, None, :, None])
+    chans = np.arange(n_channels)
+
+    # residual values
+    vals = residual[loc + (spike_times - n_times//2)[:, None, None, None],
+                    chans]
+
+    template_vals = spline_values(coefficients, neuron_ids, shifts, loc)
+    template_vals *= np.asarray(scales, 'float32')[:, None, None, None]
+
+    return vals + template_vals
+
+
+def cleaned_min_max_vals_gpu(residual, spike_times, neuron_ids, shifts,
+                             scales, min_max_loc, residual_comp):
+    '''
+    gpu version of cleaned_min_max_vals, using the spline kernel of
+    residual_comp to make the shifted templates
+    '''
+    n_channels = residual.shape[1]
+    n_times = residual_comp.waveform_len
+
+    residual = torch.from_numpy(residual).cuda()
+    spike_times = torch.from_numpy(spike_times).long().cuda()
+    neuron_ids = torch.from_numpy(neuron_ids).long().cuda()
+    shifts = torch.from_numpy(shifts).float().cuda()
+    scales = torch.from_numpy(scales).float().cuda()
+    t_range = torch.arange(-2, 3).cuda()[None, None, :, None]
+
+    min_max_loc_spikes = (min_max_loc[neuron_ids] +
+                          spike_times[:, None, None] - n_times//2)
+    min_max_loc_spikes = min_max_loc_spikes[:, :, None] + t_range
+    min_max_vals_spikes = torch.gather(
+        residual, 0, min_max_loc_spikes.reshape(-1, n_channels)).reshape(
+        -1, 2, 5, n_channels)
+
+    shifted_templates = residual_comp.get_shifted_templates(
+        neuron_ids, shifts, scales)
+    min_max_loc_spikes = min_max_loc[neuron_ids][:, :, None] + t_range
+    min_max_vals_spikes += torch.gather(
+        shifted_templates,
+        1,
+        min_max_loc_spikes.reshape(-1, 10, n_channels)
+    ).reshape(-1, 2, 5, n_channels)
+
+    min_max_vals_spikes = min_max_vals_spikes.cpu().numpy()
+
+    del residual, min_max_loc_spikes, shifted_templates
     torch.cuda.empty_cache()
 
-    return min_max_vals_avg_cpu, weights_cpu
+    return min_max_vals_spikes
 
 
 def quad_interp_loc(pts):
@@ -32,6 +32,7 @@ import datetime
 import os
 import functools
 import inspect
+import zipfile
 import warnings
 import collections
 from copy import copy
@@ -405,6 +406,29 @@ def file_loader(path):
                          '{}'.format(path.suffix))
 
 
+def npz_array_header(path, name):
+    """Shape and dtype of an array saved in a .npz file, read from its
+    header without loading the array
+
+    Parameters
+    ----------
+    path: str
+        Path to the .npz file
+
+    name: str
+        Name of the array in the file
+    """
+    with zipfile.ZipFile(str(path)) as archive:
+        with archive.open(name + '.npy') as fp:
+            version = np.lib.format.read_magic(fp)
+            if version == (1, 0):
+                shape, _, dtype = np.lib.format.read_array_header_1_0(fp)
+            else:
+                shape, _, dtype = np.lib.format.read_array_header_2_0(fp)
+
+    return shape, dtype
+
+
 def file_saver(obj, path):
     path = Path(path)
 
@@ -24,6 +24,7 @@ from yass.merge.merge import (template_dist_linear_align,
 from yass.util import absolute_path_to_asset
 from yass import read_config
 from yass.reader import READER
+from yass.spike_train import soft_counts
 
 def run():
     """Visualization Package
@@ -184,9 +185,8 @@ class Visualizer(object):
         samplerate = self.sampling_rate
         self.rec_len = np.ptp(self.spike_train[:, 0])/samplerate
 
-        n_spikes_soft = np.zeros(self.n_units)
-        for j in range(self.spike_train.shape[0]):
-            n_spikes_soft[self.spike_train[j, 1]] += self.soft_assignment[j]
+        n_spikes_soft = soft_counts(
+            self.spike_train[:, 1], self.soft_assignment, self.n_units)
         n_spikes_soft = n_spikes_soft.astype('int32')
 
         self.f_rates = n_spikes_soft/self.rec_len
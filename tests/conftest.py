@@ -5,6 +5,7 @@ import os
 from os.path import getsize
 import pytest
 import yaml
+from yass.empty import empty
 from util import PATH_TO_TESTS, seed, dummy_predict_with_threshold
 
 PATH_TO_ASSETS = os.path.join(PATH_TO_TESTS, 'assets')
@@ -73,6 +74,70 @@ def make_tmp_folder():
     shutil.rmtree(temp)
 
 
+@pytest.fixture
+def make_config():
+    """Factory of minimal CONFIG objects for unit tests that build their
+    own synthetic recordings, with cpu only and single process settings
+    """
+    def make(n_channels, spike_size=21, sampling_rate=1000):
+        CONFIG = empty()
+        CONFIG.recordings = empty()
+        CONFIG.recordings.n_channels = n_channels
+        CONFIG.recordings.sampling_rate = sampling_rate
+        CONFIG.resources = empty()
+        CONFIG.resources.multi_processing = False
+        CONFIG.resources.n_processors = 1
+        CONFIG.resources.gpu_id = 0
+        CONFIG.deconvolution = empty()
+        CONFIG.deconvolution.deconv_gpu = False
+        CONFIG.spike_size = spike_size
+        return CONFIG
+
+    return make
+
+
+@pytest.fixture
+def make_templates():
+    """Factory of smooth synthetic templates (n_units, n_times, n_channels)
+    with a trough in the middle and a later bump, scaled per channel
+    """
+    def make(n_units, n_times, n_channels):
+        t = np.arange(n_times) - n_times//2
+        shape = -np.exp(-np.square(t)/4.) + 0.3*np.exp(-np.square(t - 4)/8.)
+        templates = shape[None, :, None]*np.random.uniform(
+            1, 10, (n_units, 1, n_channels))
+        return templates.astype('float32')
+
+    return make
+
+
+@pytest.fixture
+def shift_templates():
+    """Scaled templates of a list of spikes shifted by sub-sample shifts,
+    one spike at a time with the b-spline subtraction kernel emulation
+    """
+    from yass.deconvolve.match_pursuit_cpu import SplineTemplates
+    from yass.deconvolve.match_pursuit_gpu_new import (
+        transform_template_parallel)
+
+    def shift(templates, unit_ids, shifts, scales):
+        n_units, n_times, n_channels = templates.shape
+        splines = SplineTemplates(
+            [transform_template_parallel(template)
+             for template in templates.transpose(0, 2, 1)],
+            [np.arange(n_channels)]*n_units)
+
+        shifted = np.zeros((len(unit_ids), n_times, n_channels), 'float32')
+        for j in range(len(unit_ids)):
+            obj = np.zeros((n_channels, n_times + 10), 'float32')
+            splines.subtract(obj, [5], shifts[[j]], unit_ids[[j]],
+                             scales[[j]])
+            shifted[j] = -obj[:, 5:-5].T
+        return shifted
+
+    return shift
+
+
 @pytest.fixture()
 def path_to_data():
     return os.path.join(PATH_TO_RETINA_DIR, 'data.bin')
@@ -0,0 +1,142 @@
+"""
+Benchmark of the cpu deconvolution engines on a synthetic recording
+
+Reports the realtime factor (seconds of recording deconvolved per second
+of wall time) of deconvCPU and of MatchPursuit_objectiveUpsample on the
+same data. Run it directly:
+
+    python tests/performance/benchmark_deconv_cpu.py [n_units] [n_seconds]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import yass
+from yass.reader import READER
+from yass.deconvolve.util import make_CONFIG2
+from yass.deconvolve.match_pursuit import MatchPursuit_objectiveUpsample
+from yass.deconvolve.match_pursuit_cpu import deconvCPU, run_core_deconv_cpu
+
+
+SAMPLING_RATE = 20000
+N_CHANNELS = 16
+SPIKE_SIZE = 61
+
+
+def make_templates(n_units, geom):
+    """Biphasic waveforms centered on a random channel, decaying with
+    distance to that channel
+    """
+    t = np.arange(SPIKE_SIZE) - SPIKE_SIZE//2
+    templates = np.zeros((n_units, SPIKE_SIZE, N_CHANNELS), 'float32')
+    for k in range(n_units):
+        width = np.random.uniform(2, 4)
+        wave = -np.exp(-t**2/(2*width**2)) + 0.4*np.exp(
+            -(t - 3*width)**2/(2*(2*width)**2))
+        main = np.random.randint(N_CHANNELS)
+        dist = np.linalg.norm(geom - geom[main], axis=1)
+        amp = np.random.uniform(5, 30)*np.exp(-dist/30.)
+        lag = np.round(dist/20.).astype('int32')
+        for c in range(N_CHANNELS):
+            templates[k, :, c] = amp[c]*np.roll(wave, lag[c])
+
+    return templates
+
+
+def make_recording(templates, n_seconds, firing_rate=5):
+    n_units = templates.shape[0]
+    rec_len = n_seconds*SAMPLING_RATE
+    data = np.random.normal(size=(rec_len, N_CHANNELS)).astype('float32')
+    for k in range(n_units):
+        n_spikes = np.random.poisson(firing_rate*n_seconds)
+        times = np.random.randint(SPIKE_SIZE, rec_len - SPIKE_SIZE, n_spikes)
+        for t in times:
+            data[t - SPIKE_SIZE//2:t + SPIKE_SIZE//2 + 1] += templates[k]
+
+    return data
+
+
+def main(n_units=20, n_seconds=10):
+
+    root = tempfile.mkdtemp()
+    geom = np.vstack((np.zeros(N_CHANNELS), 20*np.arange(N_CHANNELS))).T
+    np.savetxt(os.path.join(root, 'geom.txt'), geom)
+
+    templates = make_templates(n_units, geom)
+    fname_templates = os.path.join(root, 'templates.npy')
+    np.save(fname_templates, templates)
+
+    data = make_recording(templates, n_seconds)
+    fname_data = os.path.join(root, 'data.bin')
+    data.tofile(fname_data)
+
+    config = dict(
+        data=dict(root_folder=root, recordings='data.bin',
+                  geometry='geom.txt'),
+        resources=dict(multi_processing=0, n_processors=4, n_sec_chunk=1,
+                       n_sec_chunk_gpu_detect=1, n_sec_chunk_gpu_deconv=1),
+        recordings=dict(dtype='float32', sampling_rate=SAMPLING_RATE,
+                        n_channels=N_CHANNELS, spatial_radius=70,
+                        spike_size_ms=SPIKE_SIZE/SAMPLING_RATE*1000.),
+        deconvolution=dict(deconv_gpu=False))
+    CONFIG = make_CONFIG2(yass.set_config(config, 'tmp'))
+
+    # ************** deconvCPU **************
+    out_dir = os.path.join(root, 'deconv_cpu')
+    os.makedirs(out_dir)
+    reader = READER(fname_data, 'float32', CONFIG,
+                    CONFIG.resources.n_sec_chunk_gpu_deconv)
+    reader.buffer = 1000
+
+    d_cpu = deconvCPU(CONFIG, fname_templates, out_dir)
+    d_cpu.max_iter = 1000
+    d_cpu.deconv_thresh = 50
+    d_cpu.RANK = 5
+    d_cpu.fit_height = True
+    d_cpu.max_height_diff = 0.1
+    d_cpu.fit_height_ptp = 20
+    d_cpu.refractoriness = True
+    d_cpu.scd = True
+    d_cpu.n_scd_stages = 2
+    d_cpu.n_scd_iterations = 10
+    d_cpu.superres_shift = True
+    d_cpu.reader = reader
+    d_cpu.initialize()
+
+    start = time.time()
+    run_core_deconv_cpu(d_cpu, np.arange(reader.n_batches),
+                        CONFIG.resources.n_processors)
+    time_cpu = time.time() - start
+
+    # ************** MatchPursuit_objectiveUpsample **************
+    out_dir = os.path.join(root, 'deconv_mp')
+    os.makedirs(out_dir)
+    reader = READER(fname_data, 'float32', CONFIG, 1)
+
+    mp_object = MatchPursuit_objectiveUpsample(
+        fname_templates, out_dir, reader, threshold=50,
+        conv_approx_rank=5)
+    batch_ids = np.arange(reader.n_batches)
+    fnames_out = [os.path.join(out_dir, 'seg_{}.npz'.format(
+        str(batch_id).zfill(6))) for batch_id in batch_ids]
+
+    start = time.time()
+    mp_object.run(batch_ids, fnames_out)
+    time_mp = time.time() - start
+
+    print("{} units, {} channels, {} seconds".format(
+        n_units, N_CHANNELS, n_seconds))
+    print("deconvCPU:                      {:.2f} x realtime".format(
+        n_seconds/time_cpu))
+    print("MatchPursuit_objectiveUpsample: {:.2f} x realtime".format(
+        n_seconds/time_mp))
+
+    shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,72 @@
+"""
+Benchmark of the spike train bookkeeping kernels on a synthetic spike train
+
+Compares yass.spike_train against the per spike Python loops they replace.
+Loops are timed on the first n_loop spikes and scaled to the full train.
+Run it directly:
+
+    python tests/performance/benchmark_spike_train.py [n_spikes] [n_units]
+"""
+import sys
+import time
+
+import numpy as np
+
+from yass.spike_train import soft_counts, compact_spike_train
+
+
+def soft_counts_loop(spike_train, soft_assignment, n_units):
+    counts = np.zeros(n_units)
+    for j in range(spike_train.shape[0]):
+        counts[spike_train[j, 1]] += soft_assignment[j]
+    return counts
+
+
+def compact_loop(spike_train, units_kept, *arrays):
+    idx_keep = np.in1d(spike_train[:, 1], units_kept)
+    spike_train_new = spike_train[idx_keep]
+    dics = {unit: ii for ii, unit in enumerate(units_kept)}
+    for j in range(spike_train_new.shape[0]):
+        spike_train_new[j, 1] = dics[spike_train_new[j, 1]]
+    return (spike_train_new,) + tuple(array[idx_keep] for array in arrays)
+
+
+def timeit(fun, *args, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fun(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(n_spikes=20000000, n_units=2000, n_loop=1000000):
+
+    spike_train = np.stack((np.sort(np.random.randint(0, 2**31-1, n_spikes)),
+                            np.random.randint(0, n_units, n_spikes)), axis=1)
+    soft_assignment = np.random.rand(n_spikes).astype('float32')
+    shifts = np.random.randn(n_spikes).astype('float32')
+    scales = np.random.rand(n_spikes).astype('float32')
+    units_kept = np.sort(np.random.choice(n_units, n_units//2, replace=False))
+
+    scale = n_spikes/float(n_loop)
+    print("{} spikes, {} units".format(n_spikes, n_units))
+
+    time_loop = scale*timeit(soft_counts_loop, spike_train[:n_loop],
+                             soft_assignment[:n_loop], n_units)
+    time_kernel = timeit(soft_counts, spike_train[:, 1], soft_assignment,
+                         n_units)
+    print("soft counts:  loop {:.2f}s, kernel {:.3f}s".format(
+        time_loop, time_kernel))
+
+    time_loop = scale*timeit(compact_loop, spike_train[:n_loop], units_kept,
+                             soft_assignment[:n_loop], shifts[:n_loop],
+                             scales[:n_loop])
+    time_kernel = timeit(compact_spike_train, spike_train, units_kept,
+                         soft_assignment, shifts, scales)
+    print("relabel and compact:  loop {:.2f}s, kernel {:.3f}s".format(
+        time_loop, time_kernel))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+
+from yass import arena
+
+
+def test_unit_rows_match_scan(make_tmp_folder):
+    spike_train = np.stack((np.random.randint(0, 10000, 500),
+                            np.random.randint(0, 7, 500)), axis=1)
+    spike_train[spike_train[:, 1] == 4, 1] = 5
+    fname = os.path.join(make_tmp_folder, 'spike_train.npy')
+    np.save(fname, spike_train)
+
+    n_units = arena.register_spike_train(fname)
+
+    assert n_units == 7
+    for unit in range(8):
+        np.testing.assert_array_equal(
+            arena.unit_rows(fname, unit),
+            np.where(spike_train[:, 1] == unit)[0])
+
+
+def test_attach_reopens_rewritten_file(make_tmp_folder):
+    fname = os.path.join(make_tmp_folder, 'templates.npy')
+    np.save(fname, np.zeros((3, 4)))
+    assert arena.attach(fname).shape == (3, 4)
+    assert arena.attach(fname) is arena.attach(fname)
+
+    np.save(fname, np.ones((5, 4)))
+    np.testing.assert_array_equal(arena.attach(fname), np.ones((5, 4)))
+
+
+def test_spike_train_index_queries():
+    spike_train = np.stack((np.random.randint(0, 1000, 300),
+                            np.random.randint(0, 5, 300)), axis=1)
+    spike_index = arena.SpikeTrainIndex(spike_train, n_units=6)
+
+    np.testing.assert_array_equal(
+        spike_index.n_spikes(), np.bincount(spike_train[:, 1], minlength=6))
+    for unit, times in enumerate(spike_index.split_times()):
+        np.testing.assert_array_equal(
+            times, spike_train[spike_train[:, 1] == unit, 0])
+
+    rows = spike_index.window_rows(200, 450)
+    assert np.all(np.diff(spike_train[rows, 0]) >= 0)
+    np.testing.assert_array_equal(
+        np.sort(rows), np.where(np.logical_and(
+            spike_train[:, 0] >= 200, spike_train[:, 0] < 450))[0])
+
+
+def test_spike_train_index_is_rebuilt_for_new_spike_train(make_tmp_folder):
+    fname = os.path.join(make_tmp_folder, 'spike_train.npy')
+    np.save(fname, np.array([[10, 0], [5, 1], [7, 0]]))
+    np.testing.assert_array_equal(
+        arena.SpikeTrainIndex.load(fname).unit_times(0), [10, 7])
+
+    np.save(fname, np.array([[3, 1], [4, 1]]))
+    os.utime(fname, (os.path.getatime(fname),
+                     os.path.getmtime(fname) + 10))
+    spike_index = arena.SpikeTrainIndex.load(fname)
+    assert spike_index.n_units == 2
+    np.testing.assert_array_equal(spike_index.unit_times(1), [3, 4])
@@ -4,10 +4,14 @@ some configurations
 """
 import os
 
+import numpy as np
+
 import yass
 from yass import preprocess
 from yass import detect
 from yass import cluster
+from yass.cluster.cluster import coreset, nearest_center, save_units
+from yass.cluster.util import gather_clustering_result
 
 
 def test_cluster_nnet(path_to_config, make_tmp_folder):
@@ -30,6 +34,50 @@ def test_cluster_nnet(path_to_config, make_tmp_folder):
         True)
 
 
+def test_coreset_is_reproducible_and_chunk_independent():
+    np.random.seed(0)
+    data = np.random.randn(5000, 5)
+
+    idx = coreset(data, 500, random_state=1)
+    assert len(np.unique(idx)) == 500
+    np.testing.assert_array_equal(idx, coreset(data, 500, random_state=1))
+    np.testing.assert_array_equal(
+        idx, coreset(data, 500, random_state=1, chunk_size=333))
+
+    centers = data[:3]
+    label, dists = nearest_center(data, centers, chunk_size=1000)
+    dists_all = np.sum(np.square(data[:, None] - centers[None]), axis=2)
+    np.testing.assert_array_equal(label, dists_all.argmin(1))
+    np.testing.assert_allclose(dists, dists_all.min(1), atol=1e-10)
+
+
+def test_gather_clustering_result(make_tmp_folder):
+    result_dir = os.path.join(make_tmp_folder, 'cluster_result')
+    os.makedirs(result_dir)
+
+    times = [np.array([5, 1, 3]), np.array([7]), np.array([2, 4])]
+    templates = np.random.randn(3, 11, 4).astype('float32')
+    save_units(os.path.join(result_dir, 'cluster_result_0.npz'),
+               times[:2], templates[:2])
+    save_units(os.path.join(result_dir, 'cluster_result_1.npz'), [],
+               [])
+    # list of spike times per unit
+    spiketime = np.empty(1, object)
+    spiketime[0] = times[2]
+    np.savez(os.path.join(result_dir, 'cluster_result_2.npz'),
+             spiketime=spiketime, templates=templates[2:])
+    with open(os.path.join(result_dir, 'jobs_summary.csv'), 'w') as f:
+        f.write('job')
+
+    fname_templates, fname_spike_train = gather_clustering_result(
+        result_dir, make_tmp_folder)
+
+    np.testing.assert_array_equal(np.load(fname_templates), templates)
+    np.testing.assert_array_equal(
+        np.load(fname_spike_train),
+        [[5, 0], [1, 0], [3, 0], [7, 1], [2, 2], [4, 2]])
+
+
 # def test_cluster_threshold(path_to_config_threshold, make_tmp_folder):
 #     yass.set_config(path_to_config_threshold, make_tmp_folder)
 
@@ -1,6 +1,16 @@
 import os
+import pickle
+
+import numpy as np
+import pytest
+import scipy.signal
+
 import yass
 from yass import preprocess, cluster, deconvolve, detect
+from yass.reader import READER
+from yass.deconvolve.match_pursuit_cpu import deconvCPU
+from yass.deconvolve.match_pursuit import (MatchPursuit_objectiveUpsample,
+                                           unit_conv_filter)
 
 
 def test_deconvolution(patch_triage_network, path_to_config,
@@ -32,3 +42,160 @@ def test_deconvolution(patch_triage_network, path_to_config,
                      'deconv'),
         standardized_path,
         standardized_params['dtype'])
+
+
+def test_fft_objective_matches_direct_convolution(make_tmp_folder):
+    templates = np.random.normal(size=(5, 21, 4)).astype('float32')
+    fname_templates = os.path.join(make_tmp_folder, 'templates.npy')
+    np.save(fname_templates, templates)
+
+    mp_object = MatchPursuit_objectiveUpsample(
+        fname_templates, make_tmp_folder, reader=None, vis_su=0.,
+        conv_approx_rank=3)
+    mp_object.data = np.random.normal(size=(1000, 4))
+    mp_object.update_data()
+
+    expected = np.zeros((5, 1020))
+    for rank in range(3):
+        matmul_result = np.matmul(
+            mp_object.spatial[:, rank]*mp_object.singular[:, [rank]],
+            mp_object.data.T)
+        for unit in range(5):
+            expected[unit] += np.convolve(
+                matmul_result[unit], mp_object.temporal[unit, :, rank])
+    expected = 2*expected - mp_object.norm
+
+    mp_object.fft_block_len = 300
+    mp_object.unit_batch_size = 2
+    mp_object.compute_objective()
+
+    np.testing.assert_allclose(mp_object.obj, expected, atol=1e-3)
+
+
+def test_incremental_peaks_match_full_rescan(make_tmp_folder):
+    templates = np.random.normal(size=(5, 21, 4)).astype('float32')
+    fname_templates = os.path.join(make_tmp_folder, 'templates.npy')
+    np.save(fname_templates, templates)
+
+    mp_object = MatchPursuit_objectiveUpsample(
+        fname_templates, make_tmp_folder, reader=None, vis_su=0.,
+        conv_approx_rank=3, threshold=5.)
+    mp_object.data = 3*np.random.normal(size=(2000, 4))
+    for t in np.random.randint(0, 1950, 50):
+        mp_object.data[t:t+21] += templates[np.random.randint(5)]
+    mp_object.update_data()
+    mp_object.compute_objective()
+
+    for _ in range(5):
+        spt, _ = mp_object.find_peaks()
+        if len(spt) == 0:
+            break
+        mp_object.subtract_spike_train(spt)
+
+        mp_object.update_peak_cache()
+        max_across_temp = np.max(mp_object.obj, axis=0)
+        lo = mp_object.n_time - 1
+        spike_times = scipy.signal.argrelmax(
+            max_across_temp[lo:mp_object.obj.shape[1] - mp_object.n_time],
+            order=mp_object.refrac_radius)[0] + lo
+        spike_times = spike_times[
+            max_across_temp[spike_times] > mp_object.threshold]
+
+        np.testing.assert_array_equal(
+            mp_object.max_across_temp, max_across_temp)
+        np.testing.assert_array_equal(mp_object.peak_times, spike_times)
+
+
+def test_pairwise_conv_store_computes_units_lazily(make_tmp_folder):
+    templates = np.random.normal(size=(4, 21, 6)).astype('float32')
+    fname_templates = os.path.join(make_tmp_folder, 'templates.npy')
+    np.save(fname_templates, templates)
+
+    mp_object = MatchPursuit_objectiveUpsample(
+        fname_templates, make_tmp_folder, reader=None, vis_su=0.,
+        conv_approx_rank=3)
+    store = mp_object.pairwise_conv
+    svd = np.load(os.path.join(make_tmp_folder, 'svd.npz'))
+
+    expected = unit_conv_filter(2, mp_object.n_time, mp_object.unit_overlap,
+                                mp_object.up_factor, mp_object.vis_chan, 3,
+                                svd['temporal_up'], svd['temporal'],
+                                svd['singular'], svd['spatial'])
+    np.testing.assert_array_equal(store[2], expected)
+    assert list(store.cache) == [2]
+
+    # a worker gets the rows from the shared file instead of computing them
+    worker_store = pickle.loads(pickle.dumps(store))
+    assert worker_store.data is None and len(worker_store.cache) == 0
+    worker_store.compute = None
+    np.testing.assert_array_equal(worker_store[2], expected)
+    assert not worker_store.done[1]
+
+
+@pytest.mark.parametrize('scd', [False, True])
+def test_deconv_cpu_recovers_injected_spikes(make_tmp_folder, make_config,
+                                             scd):
+    n_channels, n_times, sampling_rate = 6, 61, 20000
+    CONFIG = make_config(n_channels, n_times, sampling_rate)
+    CONFIG.deconvolution.threshold = 50
+    CONFIG.geom = np.c_[np.zeros(n_channels), 20*np.arange(n_channels)]
+    CONFIG.neigh_channels = np.abs(np.subtract.outer(
+        np.arange(n_channels), np.arange(n_channels))) <= 1
+    CONFIG.center_spike_size = 41
+
+    # three biphasic units on different channels
+    t = np.arange(n_times) - n_times//2
+    templates = np.zeros((3, n_times, n_channels), 'float32')
+    for unit, (main, width) in enumerate([(1, 2.), (3, 3.), (4, 2.5)]):
+        wave = -np.exp(-t**2/(2*width**2)) + 0.4*np.exp(
+            -(t - 3*width)**2/(2*(2*width)**2))
+        templates[unit] = 20*wave[:, None]*np.exp(
+            -np.abs(np.arange(n_channels) - main)/1.5)
+    fname_templates = os.path.join(make_tmp_folder, 'templates.npy')
+    np.save(fname_templates, templates)
+
+    # isolated spikes on top of unit variance noise
+    rec_len = 2*sampling_rate
+    data = np.random.randn(rec_len, n_channels).astype('float32')
+    times = np.arange(300, rec_len - 300, 700)
+    units = np.arange(len(times)) % 3
+    for time, unit in zip(times, units):
+        data[time - n_times//2:time + n_times//2 + 1] += templates[unit]
+    fname_data = os.path.join(make_tmp_folder, 'data.bin')
+    data.tofile(fname_data)
+    reader = READER(fname_data, 'float32', CONFIG, 1)
+    reader.buffer = 1000
+
+    out_dir = os.path.join(make_tmp_folder, 'deconv')
+    os.makedirs(out_dir)
+    d_cpu = deconvCPU(CONFIG, fname_templates, out_dir)
+    d_cpu.max_iter = 1000
+    d_cpu.RANK = 5
+    d_cpu.fit_height = True
+    d_cpu.max_height_diff = 0.1
+    d_cpu.fit_height_ptp = 20
+    d_cpu.refractoriness = True
+    d_cpu.scd = scd
+    # with one iteration per scd stage the spikes of the first pass are
+    # added back and deconvolved again on the next iteration
+    d_cpu.n_scd_stages = 2
+    d_cpu.n_scd_iterations = 1
+    d_cpu.superres_shift = True
+    d_cpu.reader = reader
+    d_cpu.initialize()
+
+    # keep the spikes outside of the buffer of every chunk, as deconv_ONgpu
+    spike_train, heights = [], []
+    for chunk_id in range(reader.n_batches):
+        d_cpu.run(chunk_id)
+        keep = np.logical_and(
+            d_cpu.spike_train[:, 0] >= reader.buffer,
+            d_cpu.spike_train[:, 0] < reader.batch_size + reader.buffer)
+        spike_train.append(d_cpu.spike_train[keep] + [d_cpu.offset, 0])
+        heights.append(d_cpu.heights[keep])
+    spike_train = np.concatenate(spike_train)
+    heights = np.concatenate(heights)
+    order = np.argsort(spike_train[:, 0])
+
+    np.testing.assert_array_equal(spike_train[order], np.c_[times, units])
+    np.testing.assert_allclose(heights, 1, atol=0.1)
@@ -0,0 +1,116 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from yass.reader import READER
+from yass.neuralnetwork import Denoise
+from yass.cluster.getptp import GETPTP, GETCLEANPTP
+
+
+SPIKE_SIZE = 21
+
+
+def make_denoiser(CONFIG):
+    torch.manual_seed(0)
+    return Denoise([4, 4, 4], [5, 5, 5], SPIKE_SIZE, CONFIG)
+
+
+def make_recording(folder, CONFIG, rec_len=10000):
+    fname = os.path.join(folder, 'data.bin')
+    recording = np.random.randn(
+        rec_len, CONFIG.recordings.n_channels).astype('float32')
+    recording.tofile(fname)
+
+    # spikes on the edges of batches are in the batch they start
+    times = np.hstack((np.random.randint(20, rec_len - 20, 300),
+                       [2000, 4000, 5999]))
+    spike_index = np.c_[times, np.random.randint(
+        CONFIG.recordings.n_channels, size=len(times))]
+    fname_spike_index = os.path.join(folder, 'spike_index.npy')
+    np.save(fname_spike_index, spike_index)
+
+    reader = READER(fname, 'float32', CONFIG, n_sec_chunk=2)
+
+    return recording, spike_index, fname_spike_index, reader
+
+
+def snippets(recording, spike_index):
+    t_range = np.arange(-(SPIKE_SIZE//2), SPIKE_SIZE//2 + 1)
+    return recording[spike_index[:, [0]] + t_range, spike_index[:, [1]]]
+
+
+def denoise(denoiser, wfs):
+    with torch.no_grad():
+        return denoiser(torch.from_numpy(wfs))[0].numpy()
+
+
+@pytest.fixture
+def CONFIG(make_config):
+    CONFIG = make_config(4, SPIKE_SIZE)
+    CONFIG.resources.n_processors = 2
+    return CONFIG
+
+
+def test_getptp_matches_per_spike_snippets(make_tmp_folder, CONFIG):
+    recording, spike_index, fname_spike_index, reader = make_recording(
+        make_tmp_folder, CONFIG)
+    denoiser = make_denoiser(CONFIG)
+
+    wfs = snippets(recording, spike_index)
+    ptp_raw, ptp_deno = GETPTP(fname_spike_index, reader, CONFIG,
+                               denoiser).compute_ptps()
+
+    np.testing.assert_allclose(ptp_raw, wfs.ptp(1), rtol=1e-6)
+    np.testing.assert_allclose(ptp_deno, denoise(denoiser, wfs).ptp(1),
+                               rtol=1e-4, atol=1e-5)
+
+    ptp_raw, ptp_deno = GETPTP(fname_spike_index, reader,
+                               CONFIG).compute_ptps()
+    np.testing.assert_array_equal(ptp_raw, ptp_deno)
+    np.testing.assert_allclose(ptp_raw, wfs.ptp(1), rtol=1e-6)
+
+
+def test_getcleanptp_matches_per_spike_snippets(make_tmp_folder, CONFIG):
+    recording, spike_index, fname_spike_index, reader = make_recording(
+        make_tmp_folder, CONFIG)
+    denoiser = make_denoiser(CONFIG)
+
+    n_units = 5
+    templates = np.random.randn(n_units, SPIKE_SIZE, 4).astype('float32')
+    labels = np.random.randint(n_units, size=len(spike_index))
+    scales = np.random.uniform(0.8, 1.2, len(spike_index)).astype('float32')
+    fnames = []
+    for name, array in [('templates', templates), ('labels', labels),
+                        ('shifts', np.zeros(len(spike_index))),
+                        ('scales', scales)]:
+        fnames.append(os.path.join(make_tmp_folder, name + '.npy'))
+        np.save(fnames[-1], array)
+    fname_templates, fname_labels, fname_shifts, fname_scales = fnames
+
+    mcs = templates.ptp(1).argmax(1)
+    wfs = snippets(recording, spike_index) + scales[:, None]*templates[
+        labels, :, mcs[labels]]
+
+    ptp_raw, ptp_deno = GETCLEANPTP(
+        fname_spike_index, fname_labels, fname_templates, fname_shifts,
+        fname_scales, reader, denoiser, n_threads=2).compute_ptps()
+
+    np.testing.assert_allclose(ptp_raw, wfs.ptp(1), rtol=1e-5)
+    np.testing.assert_allclose(ptp_deno, denoise(denoiser, wfs).ptp(1),
+                               rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='requires a gpu')
+def test_getptp_cpu_matches_gpu(make_tmp_folder, CONFIG):
+    _, _, fname_spike_index, reader = make_recording(make_tmp_folder, CONFIG)
+    denoiser = make_denoiser(CONFIG)
+
+    ptp_raw, ptp_deno = GETPTP(fname_spike_index, reader, CONFIG,
+                               denoiser).compute_ptps()
+    ptp_raw_gpu, ptp_deno_gpu = GETPTP(fname_spike_index, reader, CONFIG,
+                                       denoiser.cuda()).compute_ptps()
+
+    np.testing.assert_array_equal(ptp_raw, ptp_raw_gpu)
+    np.testing.assert_allclose(ptp_deno, ptp_deno_gpu, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,38 @@
+import numpy as np
+import networkx as nx
+
+from yass.linkage import SingleLinkage, connected_components
+
+
+def nx_components(dist, thresh):
+    G = nx.Graph()
+    G.add_nodes_from(range(dist.shape[0]))
+    G.add_edges_from(zip(*np.where(dist < thresh)))
+    return sorted(sorted(cc) for cc in nx.connected_components(G))
+
+
+def test_single_linkage_components_match_graph_search():
+    np.random.seed(0)
+
+    for n in [1, 2, 5, 12]:
+        dist = np.random.uniform(0, 10, (n, n))
+        dist = np.maximum(dist, dist.T)
+        linkage = SingleLinkage(dist)
+
+        for thresh in [0, 0.5, 2, 5, 9.5, 11]:
+            expected = nx_components(dist, thresh)
+            assert linkage.n_components(thresh) == len(expected)
+            assert sorted(linkage.components(thresh)) == expected
+
+        for k in range(1, n+1):
+            cc, thresh = linkage.k_components(k)
+            assert len(cc) == k
+            assert sorted(cc) == nx_components(dist, thresh)
+
+
+def test_connected_components_of_edge_list():
+    rows = np.array([0, 1, 4, 5])
+    cols = np.array([1, 2, 5, 4])
+
+    assert connected_components(7, rows, cols) == [[0, 1, 2], [3], [4, 5],
+                                                   [6]]
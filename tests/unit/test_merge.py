@@ -0,0 +1,117 @@
+import os
+
+import numpy as np
+
+from yass.reader import READER
+from yass.merge.merge import TemplateMerge, find_ptp_merge_candidates
+
+
+def test_ptp_merge_candidates_match_dense_search():
+    np.random.seed(0)
+
+    n_units, n_channels = 200, 32
+    main = np.random.randint(n_channels, size=n_units)
+    width = np.random.uniform(1, 3, n_units)
+    ptps = np.random.uniform(3, 30, n_units)[:, None] * np.exp(
+        -np.abs(np.arange(n_channels) - main[:, None])/width[:, None])
+    ptps[ptps < 1] = 0
+    n_spikes = np.random.randint(0, 3000, n_units)
+
+    norms = np.square(np.linalg.norm(ptps, axis=1))
+    dist = np.square(ptps[:, None] - ptps[None]).sum(2)
+    ptp_max = ptps.max(1)
+    ratio = n_spikes[:, None]/np.maximum(n_spikes[None], 1)
+    close = dist/np.maximum(norms[:, None], norms[None]) < 0.5
+    close &= np.minimum(ptp_max[:, None], ptp_max[None]) > 3
+    close &= np.minimum(n_spikes[:, None], n_spikes[None]) > 10
+    close &= ((ratio > 1/20) & (ratio < 20)) | (
+        (ptp_max[:, None] > 10) & (ptp_max[None] > 10))
+    expected = np.vstack(np.where(np.triu(close, 1))).T
+
+    pairs = find_ptp_merge_candidates(ptps, n_spikes)
+
+    assert len(expected) > 0
+    np.testing.assert_array_equal(pairs, expected)
+
+
+def whitened_merge_test(tm, reader, unit1, unit2):
+    """Reference merge test: read every pair at its own window and whiten
+    every waveform
+    """
+    _, _, vis_chan, _, shift_temp = tm.plan_pair(unit1, unit2)
+    spatial_whitener = tm.get_spatial_whitener(vis_chan)
+
+    dats = []
+    for unit, shift in ((unit1, 0), (unit2, shift_temp)):
+        spt = tm.spike_train[tm.spike_train[:, 1] == unit, 0]
+        wfs, _ = reader.read_waveforms(spt + shift, tm.spike_size, vis_chan)
+        template = np.roll(tm.templates[unit][:, vis_chan], -shift, axis=0)
+        if shift > 0:
+            template[-shift:] = 0
+        elif shift < 0:
+            template[:-shift] = 0
+        wfs = wfs + template
+        wfs = np.matmul(wfs, spatial_whitener)
+        wfs = np.matmul(wfs.transpose(0, 2, 1),
+                        tm.temporal_whitener).transpose(0, 2, 1)
+        dats.append(wfs)
+
+    temp_diff_w = dats[0].mean(0) - dats[1].mean(0)
+    return (np.sum(dats[0]*temp_diff_w, (1, 2)),
+            np.sum(dats[1]*temp_diff_w, (1, 2)))
+
+
+def test_cached_merge_tests_match_whitened_waveforms(make_tmp_folder,
+                                                     make_config):
+    np.random.seed(0)
+
+    n_channels, spike_size, rec_len = 5, 21, 20000
+    geom = np.c_[np.zeros(n_channels), np.arange(n_channels)*20.]
+    fname_bin = os.path.join(make_tmp_folder, 'residual.bin')
+    np.random.randn(rec_len, n_channels).astype('float32').tofile(fname_bin)
+
+    CONFIG = make_config(n_channels, spike_size, sampling_rate=20000)
+    reader = READER(fname_bin, 'float32', CONFIG)
+
+    # three units with the same shape on overlapping channels and peaks
+    # at different times
+    shape = -np.exp(-np.square(np.arange(spike_size) - 10)/8.)
+    templates = np.zeros((3, spike_size, n_channels), 'float32')
+    for unit, (peak, chan) in enumerate([(0, 2), (2, 2), (-3, 1)]):
+        templates[unit] = 20*np.roll(shape, peak)[:, None]*np.exp(
+            -np.abs(np.arange(n_channels) - chan))
+    spike_train = np.c_[np.random.randint(100, rec_len - 100, 600),
+                        np.random.randint(3, size=600)]
+
+    fnames = {}
+    for name, array in [('templates', templates),
+                        ('spike_train', spike_train),
+                        ('shifts', np.zeros(600)),
+                        ('scales', np.ones(600)),
+                        ('soft_assignment', np.ones(600)),
+                        ('spatial_cov', np.c_[[1, 0.3, 0.1],
+                                              [0, 20, 40]]),
+                        ('temporal_cov', np.exp(-np.abs(np.subtract.outer(
+                            np.arange(spike_size),
+                            np.arange(spike_size)))/3.))]:
+        fnames[name] = os.path.join(make_tmp_folder, name + '.npy')
+        np.save(fnames[name], array)
+
+    tm = TemplateMerge(os.path.join(make_tmp_folder, 'merge'), reader,
+                       fnames['templates'], fnames['spike_train'],
+                       fnames['shifts'], fnames['scales'],
+                       fnames['soft_assignment'], fnames['spatial_cov'],
+                       fnames['temporal_cov'], geom)
+    tm.merge_candidates = [[0, 1], [0, 2], [1, 2]]
+    tm.get_merge_pairs()
+
+    for unit1, unit2 in tm.merge_candidates:
+        result = np.load(os.path.join(
+            tm.save_dir, 'unit_{}_{}.npz'.format(unit1, unit2)))
+        dat1_w, dat2_w = whitened_merge_test(tm, reader, unit1, unit2)
+
+        # every spike is used, in the order of the random draw
+        np.testing.assert_allclose(np.sort(result['dat1_w']),
+                                   np.sort(dat1_w), rtol=1e-4, atol=1e-3)
+        np.testing.assert_allclose(np.sort(result['dat2_w']),
+                                   np.sort(dat2_w), rtol=1e-4, atol=1e-3)
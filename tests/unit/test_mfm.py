@@ -0,0 +1,107 @@
+import numpy as np
+
+from yass import mfm
+from yass.empty import empty
+
+
+def masked_data_loop(score, mask, group):
+    """Per point reference implementation of maskData
+    """
+    N, nfeature, nchannel = score.shape
+    Ngroup = np.unique(group).size
+
+    sumY = np.zeros((Ngroup, nfeature, nchannel))
+    sumYSq = np.zeros((Ngroup, nfeature, nfeature, nchannel))
+    sumEta = np.zeros((Ngroup, nfeature, nfeature, nchannel))
+    groupMask = np.zeros((Ngroup, nchannel))
+    weight = np.zeros(Ngroup)
+    for n in range(N):
+        y = mask[n] * score[n]
+        ySq = y[:, np.newaxis] * y[np.newaxis]
+        scoreSq = score[n][:, np.newaxis] * score[n][np.newaxis]
+        z = mask[n] * scoreSq + (1 - mask[n]) * \
+            np.eye(nfeature)[:, :, np.newaxis]
+
+        sumY[group[n]] += y
+        sumYSq[group[n]] += ySq
+        sumEta[group[n]] += z - ySq
+        groupMask[group[n]] += mask[n]
+        weight[group[n]] += 1
+
+    return sumY, sumYSq, sumEta, groupMask/weight[:, np.newaxis], weight
+
+
+def test_masked_data_matches_per_point_sums():
+    np.random.seed(0)
+
+    for N, Ngroup in [(50, 50), (200, 17), (300, 1)]:
+        nfeature, nchannel = 3, 4
+        score = np.random.randn(N, nfeature, nchannel).astype('float32')
+        mask = np.random.uniform(size=(N, nchannel)).astype('float32')
+        mask[mask < 0.3] = 0
+        if Ngroup == N:
+            group = np.arange(N)
+        else:
+            group = np.random.permutation(
+                np.hstack((np.arange(Ngroup),
+                           np.random.randint(Ngroup, size=N - Ngroup))))
+
+        maskedData = mfm.maskData(score, mask, group)
+        sumY, sumYSq, sumEta, groupMask, weight = masked_data_loop(
+            score, mask, group)
+
+        np.testing.assert_allclose(maskedData.sumY, sumY, atol=1e-5)
+        np.testing.assert_allclose(maskedData.sumYSq, sumYSq, atol=1e-5)
+        np.testing.assert_allclose(maskedData.sumEta, sumEta, atol=1e-5)
+        np.testing.assert_allclose(maskedData.groupMask, groupMask,
+                                   atol=1e-6)
+        np.testing.assert_array_equal(maskedData.weight, weight)
+        np.testing.assert_allclose(
+            maskedData.meanYSq,
+            sumYSq/weight[:, np.newaxis, np.newaxis, np.newaxis], atol=1e-5)
+
+
+def make_param():
+    param = empty()
+    param.cluster = empty()
+    param.cluster.prior = empty()
+    param.cluster.prior.a = 1
+    param.cluster.prior.beta = 1
+    param.cluster.prior.lambda0 = 0.01
+    param.cluster.prior.nu = 5
+    param.cluster.prior.V = 2
+    return param
+
+
+def test_merge_gain_matches_check_merge():
+    np.random.seed(1)
+    param = make_param()
+
+    centers = np.random.randn(4, 3, 2) * 4
+    score = (centers[np.random.randint(4, size=400)] +
+             np.random.randn(400, 3, 2))
+    maskedData = mfm.maskData(score, np.ones((400, 2)), np.arange(400))
+    vbParam, _, suffStat = mfm.fit_with_given_k(maskedData, 7, param)
+    ELBO = mfm.ELBO_Class(maskedData, suffStat, vbParam, param)
+
+    K = vbParam.rhat.shape[1]
+    ka, kb = np.triu_indices(K, 1)
+    gain, ELBO_now = mfm.calc_merge_gain(vbParam, suffStat, param, ka, kb)
+    np.testing.assert_allclose(ELBO_now, ELBO.total)
+
+    for p in range(len(ka)):
+        _, _, merged, _, ELBO_check = mfm.check_merge(
+            maskedData, vbParam, suffStat, ka[p], kb[p], param, np.ones(K),
+            ELBO)
+        ELBO_amerge = ELBO_now + gain[p] + \
+            mfm.constant_ELBO(K - 1, suffStat, vbParam, param) - \
+            mfm.constant_ELBO(K, suffStat, vbParam, param)
+        if merged:
+            np.testing.assert_allclose(ELBO_amerge, ELBO_check.total)
+        else:
+            assert ELBO_amerge < ELBO.total
+
+    vbParam, suffStat, L = mfm.merge_move(maskedData, vbParam, suffStat,
+                                          param, np.ones(K), 1)
+    assert vbParam.rhat.shape[1] == L.size
+    assert vbParam.rhat.shape[1] < K
@@ -0,0 +1,49 @@
+import os
+
+import numpy as np
+
+from yass.reader import READER
+from yass.pd_split import get_cleaned_ptp
+
+
+def test_get_cleaned_ptp_in_one_pass(make_tmp_folder, make_config,
+                                     make_templates, shift_templates):
+    np.random.seed(1)
+    n_units, n_times, n_channels, rec_len = 5, 21, 3, 10000
+
+    CONFIG = make_config(n_channels)
+    templates = make_templates(n_units, n_times, n_channels)
+    fname_templates = os.path.join(make_tmp_folder, 'templates.npy')
+    np.save(fname_templates, templates)
+
+    residual = np.random.randn(rec_len, n_channels).astype('float32')
+    fname_residual = os.path.join(make_tmp_folder, 'residual.bin')
+    residual.tofile(fname_residual)
+    reader = READER(fname_residual, 'float32', CONFIG, n_sec_chunk=2)
+
+    spike_train = np.c_[np.random.randint(20, rec_len - 20, 400),
+                        np.random.randint(n_units, size=400)]
+    spike_train[:2, 0] = [2000, 2001]
+    # half of the spikes with sub-sample shifts
+    shifts = np.random.uniform(-1, 1, len(spike_train)).astype('float32')
+    shifts[::2] = 0
+    scales = np.random.uniform(0.8, 1.2, len(spike_train)).astype('float32')
+    shifted_templates = shift_templates(templates, spike_train[:, 1],
+                                        shifts, scales)
+
+    cleaned_ptp, vis_chans = get_cleaned_ptp(
+        templates, spike_train, shifts, scales, reader, fname_templates,
+        CONFIG)
+
+    min_loc = np.clip(templates.argmin(1), 2, n_times - 3)
+    max_loc = np.clip(templates.argmax(1), 2, n_times - 3)
+    for j, (t, k) in enumerate(spike_train):
+        wf = residual[t - n_times//2:t + n_times//2 + 1] + \
+            shifted_templates[j]
+        for c in range(n_channels):
+            expected = (wf[max_loc[k, c] - 2:max_loc[k, c] + 3, c].max() -
+                        wf[min_loc[k, c] - 2:min_loc[k, c] + 3, c].min())
+            np.testing.assert_allclose(cleaned_ptp[j, c], expected,
+                                       rtol=1e-4, atol=1e-4)
+
+    assert all(len(vis_chans[k]) == n_channels for k in range(n_units))
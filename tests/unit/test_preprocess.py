@@ -1,11 +1,19 @@
 import os
 
+import numpy as np
+import pytest
+
 try:
     from pathlib2 import Path
 except ImportError:
     from pathlib import Path
 
-from yass.preprocess.util import _butterworth
+from yass.reader import READER
+from yass.preprocess.util import (_butterworth, get_std,
+                                  filter_standardize_batch,
+                                  filter_standardize_batch_streaming,
+                                  allocate_standardized_file,
+                                  merge_filtered_files)
 from yass.util import load_yaml
 
 import yass
@@ -80,3 +88,61 @@ def test_can_preprocess_without_filtering(path_to_config,
     (standardized_path,
      standardized_params) = preprocess.run(
         os.path.join(make_tmp_folder, 'preprocess'))
+
+
+def test_butterworth_matches_per_channel_filtfilt(data):
+    from scipy.signal import butter, filtfilt
+
+    ts = data[:5000].astype('float32')
+    b, a = butter(3, 300/10000., btype='high')
+    expected = np.stack([filtfilt(b, a, ts[:, c])
+                         for c in range(ts.shape[1])], axis=1)
+
+    filtered = _butterworth(ts, low_frequency=300, high_factor=0.1,
+                            order=3, sampling_frequency=20000, n_threads=2)
+
+    np.testing.assert_allclose(filtered, expected, atol=1e-4)
+
+
+@pytest.mark.parametrize('apply_filter', [True, False])
+def test_streaming_matches_merged_batch_files(make_tmp_folder, make_config,
+                                              apply_filter):
+    n_channels, sampling_rate = 4, 20000
+    CONFIG = make_config(n_channels, sampling_rate=sampling_rate)
+
+    fname_raw = os.path.join(make_tmp_folder, 'raw.bin')
+    raw = 100*np.random.randn(int(3.5*sampling_rate), n_channels)
+    raw.astype('int16').tofile(fname_raw)
+    reader = READER(fname_raw, 'int16', CONFIG, n_sec_chunk=1)
+    assert reader.n_batches > 1
+
+    filter_args = (300, 0.1, 3, sampling_rate)
+    fname_mean_sd = os.path.join(make_tmp_folder, 'mean_sd.npz')
+    get_std(reader.read_data(0, sampling_rate), sampling_rate,
+            fname_mean_sd, apply_filter, *filter_args[:3])
+
+    # per batch files merged at the end
+    merged_location = os.path.join(make_tmp_folder, 'merged')
+    filtered_location = os.path.join(merged_location, 'filtered_files')
+    os.makedirs(filtered_location)
+    for batch_id in range(reader.n_batches):
+        filter_standardize_batch(batch_id, reader, fname_mean_sd,
+                                 apply_filter, 'float32', filtered_location,
+                                 *filter_args)
+    merge_filtered_files(filtered_location, merged_location)
+
+    # batches written in place, out of order
+    fname_streamed = os.path.join(make_tmp_folder, 'standardized.bin')
+    allocate_standardized_file(fname_streamed, reader.end - reader.start,
+                               n_channels, 'float32')
+    for batch_id in range(reader.n_batches)[::-1]:
+        filter_standardize_batch_streaming(batch_id, reader, fname_mean_sd,
+                                           apply_filter, 'float32',
+                                           fname_streamed, *filter_args)
+
+    with open(os.path.join(merged_location, 'standardized.bin'), 'rb') as f:
+        expected = f.read()
+    with open(fname_streamed, 'rb') as f:
+        streamed = f.read()
+    assert len(expected) == reader.rec_len*n_channels*4
+    assert streamed == expected
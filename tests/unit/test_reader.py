@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import pytest
+
+from yass.config import FrozenJSON
+from yass.reader import READER
+
+
+@pytest.fixture
+def recording(make_tmp_folder):
+    data = np.random.normal(size=(1000, 7)).astype('float32')
+    path = os.path.join(make_tmp_folder, 'data.bin')
+    data.tofile(path)
+
+    CONFIG = FrozenJSON(dict(
+        recordings=dict(n_channels=7, sampling_rate=100),
+        spike_size=11))
+
+    return data, READER(path, 'float32', CONFIG, n_sec_chunk=1)
+
+
+def test_read_data_batch_pads_buffer(recording):
+    data, reader = recording
+
+    batch = reader.read_data_batch(0, add_buffer=True)
+
+    expected = np.concatenate((np.zeros((reader.buffer, 7), 'float32'),
+                               data[:100 + reader.buffer]))
+    np.testing.assert_array_equal(batch, expected)
+
+
+def test_read_waveforms_skips_boundary_spikes(recording):
+    data, reader = recording
+    spike_times = np.array([3, 5, 100, 994, 995])
+    channels = np.array([1, 3])
+
+    wfs, skipped_idx = reader.read_waveforms(spike_times, channels=channels)
+
+    np.testing.assert_array_equal(skipped_idx, [0, 4])
+    assert wfs.shape == (3, 11, 2)
+    for wf, t in zip(wfs, spike_times[[1, 2, 3]]):
+        np.testing.assert_array_equal(wf, data[t-5:t+6][:, channels])
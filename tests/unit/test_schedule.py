@@ -0,0 +1,87 @@
+import os
+import time
+
+import numpy as np
+
+from yass.util import npz_array_header
+from yass.cluster.schedule import (run_jobs, save_summary,
+                                   estimate_cluster_jobs)
+
+
+def sleep_job(arg):
+    folder, job = arg
+    start = time.time()
+    time.sleep(0.2)
+    np.save(os.path.join(folder, '{}.npy'.format(job)), [start, time.time()])
+
+
+def load_times(folder, n_jobs):
+    return np.array([np.load(os.path.join(folder, '{}.npy'.format(job)))
+                     for job in range(n_jobs)])
+
+
+def test_run_jobs_largest_first(make_tmp_folder):
+    cost = np.array([1, 5, 3, 4, 2])
+    memory = np.array([1, 3, 2, 2, 1])
+    args = [(make_tmp_folder, job) for job in range(len(cost))]
+
+    # a single worker starts the jobs in the order they are dispatched
+    run_jobs(sleep_job, args, cost, memory, n_processors=1,
+             memory_budget=4)
+
+    times = load_times(make_tmp_folder, len(cost))
+    np.testing.assert_array_equal(np.argsort(times[:, 0]),
+                                  np.argsort(-cost))
+
+
+def test_run_jobs_in_process_does_not_measure_memory(make_tmp_folder):
+    cost = np.array([1, 3, 2])
+    args = [(make_tmp_folder, job) for job in range(len(cost))]
+
+    wall_time, peak_rss = run_jobs(sleep_job, args, cost, cost,
+                                   multi_processing=False)
+
+    assert np.all(wall_time >= 0.2)
+    assert np.all(np.isnan(peak_rss))
+    times = load_times(make_tmp_folder, len(cost))
+    np.testing.assert_array_equal(np.argsort(times[:, 0]),
+                                  np.argsort(-cost))
+
+
+def test_run_jobs_within_memory_budget(make_tmp_folder):
+    cost = np.array([1, 5, 3, 4, 2])
+    memory = np.array([1, 3, 2, 2, 1])
+    args = [(make_tmp_folder, job) for job in range(len(cost))]
+
+    wall_time, peak_rss = run_jobs(sleep_job, args, cost, memory,
+                                   n_processors=3, memory_budget=4)
+
+    assert np.all(wall_time >= 0.2)
+    assert np.all(peak_rss > 0)
+
+    times = load_times(make_tmp_folder, len(cost))
+
+    # memory of the jobs running at every start never exceeds the budget
+    for start in times[:, 0]:
+        running = (times[:, 0] <= start) & (times[:, 1] > start)
+        assert memory[running].sum() <= 4
+
+
+def test_summary_and_estimates(make_tmp_folder):
+    fname_input = os.path.join(make_tmp_folder, 'partition_0.npz')
+    np.savez(fname_input, wf=np.zeros((100, 31, 7), 'float32'), channel=0)
+    shape, dtype = npz_array_header(fname_input, 'wf')
+    assert shape == (100, 31, 7) and dtype == np.dtype('float32')
+
+    n_spikes, n_channels, cost, memory = estimate_cluster_jobs([fname_input])
+    assert n_spikes[0] == 100 and n_channels[0] == 7
+
+    fname = os.path.join(make_tmp_folder, 'jobs_summary.csv')
+    save_summary(fname, [0], n_spikes, n_channels, cost, memory, [1.5],
+                 [200.])
+    save_summary(fname, [1], n_spikes, n_channels, cost, memory, [2.5],
+                 [300.])
+    with open(fname) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 3
+    assert lines[0].startswith('job,n_spikes,n_channels')
@@ -0,0 +1,173 @@
+import os
+
+import numpy as np
+import torch
+
+from yass.reader import READER
+from yass.neuralnetwork.model_detector import Detect
+from yass.soft_assignment.noise import SOFTNOISEASSIGNMENT
+from yass.soft_assignment.run import s_score
+from yass.soft_assignment.template import (TEMPLATE_ASSIGN_OBJECT,
+                                           get_cov_matrix)
+
+
+def test_blocked_s_score_matches_row_loop(make_tmp_folder):
+    np.random.seed(0)
+    log_probs = np.random.uniform(0, 100, (1000, 3))
+    log_probs[::7, 2] = log_probs[::7, 1]
+
+    expected = np.zeros(len(log_probs))
+    for i, row in enumerate(log_probs):
+        col = np.argmin(row[1:3]) + 1
+        expected[i] = (row[col] - row[0])/np.max([row[0], row[col]])
+
+    np.testing.assert_allclose(s_score(log_probs), expected)
+
+    out = np.lib.format.open_memmap(
+        os.path.join(make_tmp_folder, 's_score.npy'), mode='w+',
+        dtype='float32', shape=(len(log_probs),))
+    s_score(log_probs, out=out, block_size=64)
+    np.testing.assert_allclose(out, expected, rtol=1e-6)
+
+    # rows left out of the soft assignment are all zero and set to NaN
+    excluded = np.arange(3, len(log_probs), 10)
+    log_probs[excluded] = 0
+    idx_included = np.setdiff1d(np.arange(len(log_probs)), excluded)
+    with np.errstate(all='raise'):
+        scores = s_score(log_probs, idx_included[::-1], block_size=64)
+    assert np.all(np.isnan(scores[excluded]))
+    np.testing.assert_allclose(scores[idx_included], expected[idx_included])
+
+    # boolean mask, as TEMPLATE_ASSIGN_OBJECT.idx_included, over more rows
+    # than a block
+    mask = np.ones(len(log_probs), bool)
+    mask[excluded] = False
+    with np.errstate(all='raise'):
+        scores = s_score(log_probs, mask, block_size=64)
+    assert np.all(np.isnan(scores[excluded]))
+    np.testing.assert_allclose(scores[mask], expected[mask])
+
+
+def test_cpu_template_soft_assignment_matches_kronecker_form(
+        make_tmp_folder, make_config):
+    np.random.seed(0)
+    n_units, n_times, n_channels, rec_len = 6, 21, 6, 8000
+    n_chans, lik_window = 4, 11
+
+    CONFIG = make_config(n_channels, n_times)
+    geom = np.c_[np.zeros(n_channels), np.arange(n_channels)*20.]
+    channel_index = np.array([[c - 1, c, c + 1] for c in range(n_channels)])
+    channel_index[channel_index < 0] = n_channels
+    channel_index[channel_index >= n_channels] = n_channels
+
+    shape = -np.exp(-np.square(np.arange(n_times) - n_times//2)/4.)
+    templates = np.zeros((n_units, n_times, n_channels), 'float32')
+    for unit in range(n_units):
+        templates[unit] = np.random.uniform(2, 8)*np.roll(
+            shape, np.random.randint(-2, 3))[:, None]*np.exp(
+            -np.abs(np.arange(n_channels) - unit)/2.)
+    spike_train = np.c_[np.random.randint(50, rec_len - 50, 300),
+                        np.random.randint(n_units, size=300)]
+    spike_train = spike_train[np.argsort(spike_train[:, 0])]
+
+    fnames = []
+    for name, array in [('templates', templates),
+                        ('spike_train', spike_train),
+                        ('shifts', np.zeros(len(spike_train)))]:
+        fnames.append(os.path.join(make_tmp_folder, name + '.npy'))
+        np.save(fnames[-1], array)
+    fname_templates, fname_spike_train, fname_shifts = fnames
+    residual = np.random.randn(rec_len, n_channels).astype('float32')
+    fname_residual = os.path.join(make_tmp_folder, 'residual.bin')
+    residual.tofile(fname_residual)
+    reader = READER(fname_residual, 'float32', CONFIG, n_sec_chunk=2)
+
+    spat_cov = np.c_[[1, 0.3, 0.05], [0, 20, 40]]
+    temp_cov = np.exp(-np.abs(np.subtract.outer(np.arange(n_times),
+                                                np.arange(n_times)))/3.)
+
+    TAO = TEMPLATE_ASSIGN_OBJECT(
+        fname_spike_train, fname_templates, fname_shifts, reader,
+        spat_cov, temp_cov, channel_index, geom,
+        large_unit_threshold=100000, n_chans=n_chans,
+        rec_chans=n_channels, sim_units=3, lik_window=lik_window,
+        use_gpu=False, n_threads=2)
+    log_probs = TAO.compute_soft_assignment()
+
+    # reference: quadratic form with the kronecker product precision
+    inv_temp = np.linalg.inv(TAO.temp_cov)
+    spat_cov_matrix = get_cov_matrix(spat_cov, geom)
+    assert len(TAO.spike_train) > 0
+    for j, (t, k) in enumerate(TAO.spike_train):
+        chans = TAO.chans[k]
+        precision = np.kron(
+            np.linalg.inv(spat_cov_matrix[np.ix_(chans, chans)]), inv_temp)
+        snippet = residual[t - n_times//2:t + n_times//2 + 1][:, chans]
+        for i in range(3):
+            wf = (snippet + TAO.aligned_template_list[i][k])[
+                TAO.offset:TAO.offset + lik_window]
+            x = wf.T.ravel()
+            np.testing.assert_allclose(log_probs[j, i], x @ precision @ x,
+                                       rtol=1e-3)
+
+
+def test_cpu_noise_soft_assignment_matches_per_spike_detector(
+        make_tmp_folder, make_config):
+    np.random.seed(0)
+    torch.manual_seed(0)
+    n_units, n_times, n_channels, rec_len, n_times_nn = 4, 21, 5, 6000, 11
+
+    CONFIG = make_config(n_channels, n_times)
+    channel_index = np.array([[c, c - 1, c + 1] for c in range(n_channels)])
+    channel_index[channel_index < 0] = n_channels
+    channel_index[channel_index >= n_channels] = n_channels
+
+    shape = -np.exp(-np.square(np.arange(n_times) - n_times//2)/4.)
+    templates = np.zeros((n_units, n_times, n_channels), 'float32')
+    for unit in range(n_units):
+        templates[unit] = 5*np.roll(shape, unit % 3 - 1)[:, None]*np.exp(
+            -np.abs(np.arange(n_channels) - unit))
+    spike_train = np.c_[np.hstack((np.random.randint(20, rec_len - 20, 200),
+                                   [3, rec_len - 4])),
+                        np.random.randint(n_units, size=202)]
+    scales = np.random.uniform(0.8, 1.2, len(spike_train))
+
+    fnames = []
+    for name, array in [('spike_train', spike_train),
+                        ('templates', templates),
+                        ('shifts', np.zeros(len(spike_train))),
+                        ('scales', scales)]:
+        fnames.append(os.path.join(make_tmp_folder, name + '.npy'))
+        np.save(fnames[-1], array)
+    residual = np.random.randn(rec_len, n_channels).astype('float32')
+    fname_residual = os.path.join(make_tmp_folder, 'residual.bin')
+    residual.tofile(fname_residual)
+    reader = READER(fname_residual, 'float32', CONFIG, n_sec_chunk=2)
+
+    detector = Detect([4, 4, 4], n_times_nn, channel_index, CONFIG)
+    sna = SOFTNOISEASSIGNMENT(*fnames, reader, detector, channel_index,
+                              large_unit_threshold=np.inf, use_gpu=False,
+                              batch_size=64)
+    probs = sna.compute_soft_assignment()
+
+    # reference: one spike at a time, zero padded residual
+    n_extra = sna.n_times_extra
+    residual = np.concatenate((np.zeros((20, n_channels), 'float32'),
+                               residual, np.zeros((20, n_channels))), 0)
+    residual = np.concatenate((residual, np.zeros((len(residual), 1))), 1)
+    wfs = []
+    for (t, k), scale in zip(sna.spike_train, sna.scales):
+        snippet = residual[t + 20 - n_times_nn//2:
+                           t + 20 + n_times_nn//2 + 1][
+            :, channel_index[sna.mcs[k]]]
+        wfs.append(snippet + scale*sna.templates_aligned[k][
+            n_extra:-n_extra])
+    with torch.no_grad():
+        expected = detector(torch.from_numpy(
+            np.array(wfs)).float())[0][:, 0].numpy()
+
+    np.testing.assert_allclose(probs, expected, rtol=1e-4, atol=1e-5)
+
+    sna.n_processors = 2
+    np.testing.assert_allclose(sna.compute_soft_assignment(), probs,
+                               rtol=1e-5, atol=1e-6)
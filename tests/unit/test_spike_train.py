@@ -0,0 +1,29 @@
+import numpy as np
+
+from yass.spike_train import soft_counts, compact_spike_train
+
+
+def test_soft_counts_matches_loop():
+    units = np.random.randint(0, 5, 200)
+    weights = np.random.rand(200)
+
+    expected = np.zeros(7)
+    for unit, weight in zip(units, weights):
+        expected[unit] += weight
+
+    np.testing.assert_allclose(soft_counts(units, weights, 7), expected)
+    np.testing.assert_array_equal(soft_counts(units),
+                                  np.bincount(units, minlength=5))
+
+
+def test_compact_spike_train_relabels_and_masks():
+    spike_train = np.array([[1, 0], [2, 3], [3, 1], [4, 3], [5, 2]])
+    shifts = np.arange(5)*0.1
+
+    spike_train_new, shifts_new, missing = compact_spike_train(
+        spike_train, np.array([1, 3]), shifts, None)
+
+    np.testing.assert_array_equal(spike_train_new,
+                                  [[2, 1], [3, 0], [4, 1]])
+    np.testing.assert_array_equal(shifts_new, shifts[[1, 2, 3]])
+    assert missing is None
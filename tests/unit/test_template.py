@@ -0,0 +1,39 @@
+import numpy as np
+from scipy import signal
+
+from yass.template import (shift_chans, upsample_resample,
+                           align_get_shifts_with_ref)
+
+
+def test_shift_chans_interpolates_rolls():
+    wf = np.random.normal(size=(6, 21, 3)).astype('float32')
+    shifts = np.array([0, 2, -3, 1.4, -0.6, 2.2])
+
+    shifted = shift_chans(wf, shifts)
+
+    for k, shift in enumerate(shifts):
+        floor = int(np.floor(shift))
+        frac = shift - floor
+        expected = ((1 - frac)*np.roll(wf[k], floor, axis=0) +
+                    frac*np.roll(wf[k], floor + 1, axis=0))
+        np.testing.assert_allclose(shifted[k], expected, atol=1e-5)
+
+
+def test_upsample_resample_matches_per_spike_resample():
+    wf = np.random.normal(size=(4, 21))
+
+    expected = np.stack([signal.resample(w, 101) for w in wf])
+
+    np.testing.assert_allclose(upsample_resample(wf, 5), expected,
+                               atol=1e-5)
+
+
+def test_align_get_shifts_recovers_integer_lags():
+    t = np.arange(41)
+    lags = np.array([-2, -1, 0, 1, 2])
+    wf = np.exp(-np.square(t - 20 - lags[:, None])/8.)
+
+    shifts = align_get_shifts_with_ref(wf, wf[2], upsample_factor=5,
+                                       nshifts=7)
+
+    np.testing.assert_allclose(shifts, -lags)
@@ -0,0 +1,122 @@
+import os
+
+import numpy as np
+
+from yass.reader import READER
+from yass.deconvolve.match_pursuit_cpu import SplineTemplates
+from yass.template_update import (get_avg_min_max_vals,
+                                  template_spline_coefficients,
+                                  cleaned_min_max_vals)
+
+
+def test_cleaned_min_max_vals_match_spline_kernel(make_config,
+                                                  make_templates):
+    np.random.seed(0)
+    n_units, n_times, n_channels, n_spikes = 4, 21, 3, 50
+
+    CONFIG = make_config(n_channels)
+    templates = make_templates(n_units, n_times, n_channels)
+    coefficients = template_spline_coefficients(templates, CONFIG)
+    splines = SplineTemplates(list(coefficients),
+                              [np.arange(n_channels)]*n_units)
+
+    residual = np.random.randn(1000, n_channels).astype('float32')
+    spike_times = np.random.randint(50, 950, n_spikes)
+    neuron_ids = np.random.randint(n_units, size=n_spikes)
+    shifts = np.random.uniform(-1, 1, n_spikes).astype('float32')
+    shifts[:5] = 0
+    scales = np.random.uniform(0.8, 1.2, n_spikes).astype('float32')
+
+    min_max_loc = np.stack((templates.argmin(1),
+                            templates.argmax(1))).transpose(1, 0, 2)
+    min_max_loc = np.clip(min_max_loc, 2, n_times - 3)
+    vals = cleaned_min_max_vals(residual, spike_times, neuron_ids, shifts,
+                                scales, min_max_loc, coefficients)
+
+    for j in range(n_spikes):
+        # shifted template as made by the spline subtraction kernel
+        obj = np.zeros((n_channels, n_times + 10), 'float32')
+        splines.subtract(obj, [5], shifts[[j]], neuron_ids[[j]],
+                         scales[[j]])
+        wf = residual[spike_times[j] - n_times//2:
+                      spike_times[j] + n_times//2 + 1] - obj[:, 5:-5].T
+
+        loc = min_max_loc[neuron_ids[j]][:, None] + np.arange(-2, 3)[:, None]
+        expected = wf[loc, np.arange(n_channels)]
+        np.testing.assert_allclose(vals[j], expected, rtol=1e-5, atol=1e-5)
+
+    # unshifted templates are reproduced exactly
+    np.testing.assert_allclose(
+        vals[:5] - residual[min_max_loc[neuron_ids[:5]][:, :, None] +
+                            np.arange(-2, 3)[:, None] +
+                            (spike_times[:5] - n_times//2)[:, None, None,
+                                                           None],
+                            np.arange(n_channels)],
+        scales[:5, None, None, None]*templates[
+            neuron_ids[:5, None, None, None],
+            min_max_loc[neuron_ids[:5]][:, :, None] +
+            np.arange(-2, 3)[:, None], np.arange(n_channels)],
+        atol=1e-4)
+
+
+def test_avg_min_max_vals_match_per_unit_sums(make_tmp_folder, make_config,
+                                              make_templates,
+                                              shift_templates):
+    np.random.seed(2)
+    n_units, n_times, n_channels, rec_len = 6, 21, 3, 10000
+
+    CONFIG = make_config(n_channels)
+    templates = make_templates(n_units, n_times, n_channels)
+    residual = np.random.randn(rec_len, n_channels).astype('float32')
+    spike_train = np.c_[np.random.randint(20, rec_len - 20, 500),
+                        np.random.randint(n_units, size=500)]
+    # half of the spikes with sub-sample shifts
+    shifts = np.random.uniform(-1, 1, len(spike_train)).astype('float32')
+    shifts[::2] = 0
+    scales = np.random.uniform(0.5, 1.5, len(spike_train)).astype('float32')
+    shifted_templates = shift_templates(templates, spike_train[:, 1],
+                                        shifts, scales)
+
+    fnames = []
+    for name, array in [('templates', templates),
+                        ('spike_train', spike_train),
+                        ('shifts', shifts), ('scales', scales)]:
+        fnames.append(os.path.join(make_tmp_folder, name + '.npy'))
+        np.save(fnames[-1], array)
+    fname_residual = os.path.join(make_tmp_folder, 'residual.bin')
+    residual.tofile(fname_residual)
+    reader = READER(fname_residual, 'float32', CONFIG, n_sec_chunk=2)
+
+    units_to_update = np.array([0, 2, 3, 5])
+    avg_min_max_vals, weights = get_avg_min_max_vals(
+        *fnames, reader, CONFIG, units_to_update, min_ptp=2)
+
+    ptp_temps = templates.ptp(1)
+    min_max_loc = np.stack((templates.argmin(1),
+                            templates.argmax(1))).transpose(1, 0, 2)
+    min_max_loc = np.clip(min_max_loc, 2, n_times - 3)
+    for k in range(n_units):
+        if k not in units_to_update:
+            assert avg_min_max_vals[k] is None
+            continue
+
+        vis_chan = np.where(ptp_temps[k] > 2)[0]
+        vals_sum = np.zeros((2, 5, n_channels))
+        weights_sum = np.zeros(n_channels)
+        for j in np.where(spike_train[:, 1] == k)[0]:
+            t = spike_train[j, 0]
+            wf = residual[t - n_times//2:t + n_times//2 + 1] + \
+                shifted_templates[j]
+            loc = min_max_loc[k][:, None] + np.arange(-2, 3)[:, None]
+            vals = wf[loc, np.arange(n_channels)]
+            diff = np.abs(vals[1].max(0) - vals[0].min(0) - ptp_temps[k])
+            weight = np.logical_or(diff < 0.2*ptp_temps[k], diff < 3)
+            vals_sum += vals*weight
+            weights_sum += weight
+
+        weights_sum = weights_sum[vis_chan]
+        weights_sum[weights_sum == 0] = 0.0000001
+        np.testing.assert_allclose(weights[k], weights_sum)
+        np.testing.assert_allclose(avg_min_max_vals[k],
+                                   vals_sum[:, :, vis_chan]/weights_sum,
+                                   rtol=1e-4, atol=1e-4)